@@ -0,0 +1,159 @@
+"""Admission control and resource limits.
+
+- Connections: at most max_connections sessions run at once. The
+  connections accepted beyond that wait in a queue of CONNECTION_QUEUE_SIZE
+  for a session to end, and are turned away after CONNECTION_QUEUE_TIMEOUT
+  seconds. While the queue is full, the 'thread' mode stops accepting, so
+  new connections wait in the listen backlog (the 'async' mode turns them
+  away).
+- Queries: a user runs at most max_user_queries statements at once, over
+  all of its sessions. Statements beyond that fail at once: waiting for
+  a slot would hold an 'async' worker thread.
+- Statement timeout: a progress handler aborts a statement running for
+  longer than statement_timeout seconds, fetching and sending its rows
+  included.
+- Result size: a result stops once max_result_size bytes have been sent.
+
+0 (or None for the timeout) means no limit.
+"""
+
+import collections
+import sqlite3
+import threading
+import time
+
+from config import *
+
+
+class ConnectionGate:
+    """Sessions running at once, and connections waiting for one to end."""
+    # What enter() returns
+    RUN, WAIT, FULL = 'run', 'wait', 'full'
+
+    def __init__(self, max_connections=MAX_CONNECTIONS,
+            queue_size=CONNECTION_QUEUE_SIZE,
+            queue_timeout=CONNECTION_QUEUE_TIMEOUT):
+        self._max_connections = max_connections
+        self._queue_size = queue_size
+        self._queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        # (item, time it came)
+        self._waiting = collections.deque()
+        self._rejected = 0
+
+    def _full(self) -> bool:
+        """Lock must be held."""
+        return self._max_connections > 0 and \
+            self._active >= self._max_connections and \
+            len(self._waiting) >= self._queue_size
+
+    def wait_room(self, timeout:float) -> bool:
+        """Wait until a new connection can run or wait. Returns False on
+        timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._full(), timeout)
+
+    def enter(self, item) -> str:
+        """A connection came. Returns RUN if its session can start, WAIT
+        if item was queued (it is returned by leave() when its turn
+        comes), or FULL if it must be turned away."""
+        with self._cond:
+            if self._max_connections <= 0 or \
+                    self._active < self._max_connections:
+                self._active += 1
+                return self.RUN
+            if len(self._waiting) < self._queue_size:
+                self._waiting.append((item, time.monotonic()))
+                return self.WAIT
+            self._rejected += 1
+            return self.FULL
+
+    def leave(self):
+        """A session ended. Returns the item of the connection which takes
+        its place, or None."""
+        with self._cond:
+            self._cond.notify_all()
+            if self._waiting:
+                return self._waiting.popleft()[0]
+            self._active -= 1
+            return None
+
+    def expired(self) -> list:
+        """Remove and returns the items waiting for too long."""
+        deadline = time.monotonic() - self._queue_timeout
+        expired = []
+        with self._cond:
+            while self._waiting and self._waiting[0][1] < deadline:
+                expired.append(self._waiting.popleft()[0])
+            if expired:
+                self._rejected += len(expired)
+                self._cond.notify_all()
+        return expired
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {'active': self._active, 'waiting': len(self._waiting),
+                'rejected': self._rejected}
+
+
+class QuerySlots:
+    """Statements running at once for each user."""
+    def __init__(self, max_user_queries=MAX_USER_QUERIES):
+        self._max_user_queries = max_user_queries
+        self._lock = threading.Lock()
+        self._running = collections.Counter()
+        self._rejected = 0
+
+    def acquire(self, username:str):
+        """Raises sqlite3.Error if the user already runs too many."""
+        with self._lock:
+            if 0 < self._max_user_queries <= self._running[username]:
+                self._rejected += 1
+                raise sqlite3.Error(ERROR['too-many-queries'] %
+                    (username, self._max_user_queries))
+            self._running[username] += 1
+
+    def release(self, username:str):
+        with self._lock:
+            self._running[username] -= 1
+            if self._running[username] <= 0:
+                del self._running[username]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'running': sum(self._running.values()),
+                'rejected': self._rejected}
+
+
+class StatementTimeout:
+    """Context manager aborting what a connection runs once timeout
+    seconds have passed. sqlite3 raises OperationalError('interrupted'),
+    replaced by a clearer error."""
+    __slots__ = ('_conn', '_timeout', '_deadline', '_fired')
+
+    def __init__(self, conn:sqlite3.Connection, timeout):
+        self._conn = conn
+        self._timeout = timeout
+        self._fired = False
+
+    def _check(self) -> int:
+        if time.perf_counter() > self._deadline:
+            self._fired = True
+            return 1
+        return 0
+
+    def __enter__(self):
+        if self._timeout:
+            self._deadline = time.perf_counter() + self._timeout
+            self._conn.set_progress_handler(self._check,
+                PROGRESS_HANDLER_STEPS)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self._timeout:
+            self._conn.set_progress_handler(None, 0)
+        if self._fired and isinstance(exc, sqlite3.OperationalError):
+            raise sqlite3.OperationalError(ERROR['statement-timeout'] %
+                self._timeout) from exc
+        return False
@@ -0,0 +1,115 @@
+"""Login fast path: session tokens and cached credential checks.
+
+A client logging in with its password gets a session token back. After a
+reconnection it can log in with the token instead of the password, until
+the token expires (SESSION_TOKEN_TTL seconds):
+
+    username:expiry:signature
+
+The signature is an HMAC of the user name, the expiry time and the hash
+of the password of the user, keyed by a secret of the server. Tokens are
+not stored, are valid in every process of the server, and are no longer
+valid once the user is deleted or added again with another password.
+
+Passwords checked recently are kept in a bounded LRU cache for
+CREDENTIAL_CACHE_TTL seconds. Entries are keyed by a keyed digest of the
+password, never by the password itself, and are only used while the user
+still has the password hash they were checked against. DELETE USER drops
+the entries of the user.
+"""
+
+import collections
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+import utils
+from config import *
+
+
+class Authenticator:
+    def __init__(self, metadata, secret=None, token_ttl=SESSION_TOKEN_TTL,
+            cache_size=CREDENTIAL_CACHE_SIZE, cache_ttl=CREDENTIAL_CACHE_TTL):
+        """secret signs the tokens: processes sharing it accept the tokens
+        of each other."""
+        self._metadata = metadata
+        self._secret = secret or os.urandom(32)
+        self._token_ttl = token_ttl
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        # (username, digest of the password) -> (expiry, password hash)
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _digest(self, username:str, password:str) -> bytes:
+        return hashlib.blake2b(("%s\0%s" % (username, password)).encode(
+            "utf-8"), key=self._secret[:64], digest_size=16).digest()
+
+    def check_password(self, username:str, password:str) -> bool:
+        """Checks the password of a user."""
+        expected = self._metadata.password_hash(username)
+        if expected is None:
+            return False
+        key = (username, self._digest(username, password))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > now and entry[1] == expected:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                return True
+            self._misses += 1
+        if not self._metadata.check_user(username,
+                utils.hash_password('sha512', password)):
+            return False
+        if self._cache_size > 0:
+            with self._lock:
+                self._cache[key] = (now + self._cache_ttl, expected)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return True
+
+    def forget(self, username:str):
+        """Drop the cached passwords of a user."""
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == username]:
+                del self._cache[key]
+
+    def _sign(self, username:str, expiry:int, password_hash:str) -> str:
+        message = "%s:%d:%s" % (username, expiry, password_hash)
+        return hmac.new(self._secret, message.encode("utf-8"),
+            hashlib.sha256).hexdigest()
+
+    def issue_token(self, username:str) -> str:
+        """Returns a new token of a user, '' if there is no such user."""
+        password_hash = self._metadata.password_hash(username)
+        if password_hash is None:
+            return ''
+        expiry = int(time.time()) + self._token_ttl
+        return "%s:%d:%s" % (username, expiry,
+            self._sign(username, expiry, password_hash))
+
+    def check_token(self, username:str, token:str) -> bool:
+        """Checks a token issued to a user."""
+        try:
+            name, expiry, signature = token.split(':')
+            expiry = int(expiry)
+        except ValueError:
+            return False
+        if name != username or expiry < time.time():
+            return False
+        password_hash = self._metadata.password_hash(username)
+        # Bytes: comparing str with non-ASCII characters raises TypeError
+        return password_hash is not None and hmac.compare_digest(
+            signature.encode("utf-8"),
+            self._sign(username, expiry, password_hash).encode("utf-8"))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'cached': len(self._cache), 'hits': self._hits,
+                'misses': self._misses}
@@ -0,0 +1,211 @@
+"""Online backups and restores of the databases.
+
+    BACKUP DATABASE shop TO 'shop-monday.db';
+    RESTORE DATABASE shop FROM 'shop-monday.db';
+
+Both copy the pages of a database with the SQLite backup API, BACKUP_PAGES
+pages at a time. Between two steps the source is not locked, so sessions
+go on reading and writing while a backup runs, and a backup sleeps
+BACKUP_THROTTLE seconds to leave them the disk. A backup is written to a
+'.part' file, renamed once complete: a backup file is never torn.
+
+A step after a write by another connection starts the copy again. After
+BACKUP_MAX_RESTARTS of them, the database is copied in one step, holding
+a read lock for the whole copy (which does not stop writers in the WAL
+journal mode).
+
+A restore replaces the content of a database in one write transaction,
+committed at the end: sessions see the old content, then the new one.
+It is not throttled, as writers wait for it.
+
+Backup files are in BACKUPS_DIR. SHOW BACKUPS shows the progress of the
+copies run since the server started.
+"""
+
+import collections
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from config import *
+
+# Names of the backup files: no directory
+name_regex = re.compile(r"^\w[\w.-]*$")
+# Status of a step which found the database locked (SQLITE_BUSY,
+# SQLITE_LOCKED): it is tried again
+_BUSY = (5, 6)
+
+
+def backup_path(name:str) -> str:
+    """Path of a backup file, checking its name."""
+    if not name_regex.match(name) or name.endswith('.part'):
+        raise sqlite3.Error(ERROR['invalid-backup-name'] % name)
+    return BACKUPS_DIR + name
+
+def backup_file(name:str) -> str:
+    """Path of an existing backup file."""
+    path = backup_path(name)
+    if not os.path.isfile(path):
+        raise sqlite3.Error(ERROR['unknown-backup'] % name)
+    return path
+
+
+class _Restarted(Exception):
+    """The copy started again too many times."""
+
+
+class _Cancelled(Exception):
+    """The client cancelled the copy."""
+
+
+class Copy:
+    """A backup or restore, and its progress."""
+    def __init__(self, kind:str, dbname:str, name:str):
+        self.kind = kind
+        self.dbname = dbname
+        self.name = name
+        self.state = 'running'
+        self.pages = 0
+        self.remaining = 0
+        self.restarts = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def done(self) -> int:
+        return self.pages - self.remaining
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def percent(self) -> float:
+        return 100.0 * self.done / self.pages if self.pages else 0.0
+
+
+class BackupManager:
+    """Runs the copies and remembers the BACKUP_HISTORY last ones."""
+    def __init__(self, metrics, pages=BACKUP_PAGES, throttle=BACKUP_THROTTLE,
+            max_restarts=BACKUP_MAX_RESTARTS):
+        self._metrics = metrics
+        self._pages = pages
+        self._throttle = throttle
+        self._max_restarts = max_restarts
+        self._lock = threading.Lock()
+        self._copies = collections.deque(maxlen=BACKUP_HISTORY)
+
+    def _start(self, kind:str, dbname:str, name:str) -> Copy:
+        with self._lock:
+            for other in self._copies:
+                if other.state == 'running' and (other.name == name or
+                        kind == 'restore' and other.dbname == dbname):
+                    raise sqlite3.Error(ERROR['backup-running'] %
+                        (other.dbname, other.name))
+            copy = Copy(kind, dbname, name)
+            self._copies.append(copy)
+        return copy
+
+    def _copy(self, copy:Copy, source, target, throttle:float, cancelled):
+        """Copy the pages of source into target."""
+        def progress(status, remaining, pages):
+            if status not in _BUSY:
+                if copy.pages and remaining < copy.remaining:
+                    copied = copy.remaining - remaining
+                else:
+                    if copy.pages:
+                        copy.restarts += 1
+                        self._metrics.inc('backup_restarts')
+                    copied = pages - remaining
+                copy.pages, copy.remaining = pages, remaining
+                self._metrics.inc('backup_pages', copied)
+            if cancelled is not None and cancelled():
+                raise _Cancelled()
+            if copy.restarts > self._max_restarts:
+                raise _Restarted()
+            # Locked steps are tried again after a sleep anyway
+            if remaining and throttle and status not in _BUSY:
+                time.sleep(throttle)
+
+        try:
+            try:
+                source.backup(target, pages=self._pages, progress=progress)
+            except _Restarted:
+                source.backup(target)
+                self._metrics.inc('backup_pages', copy.pages)
+        except _Cancelled:
+            copy.state = 'cancelled'
+        except:
+            copy.state = 'failed'
+            raise
+        else:
+            copy.state = 'done'
+            copy.remaining = 0
+        finally:
+            copy.finished = time.monotonic()
+            self._metrics.inc('backups_' + copy.state)
+
+    def backup(self, pool, name:str, cancelled=None) -> Copy:
+        """Copy the database of the pool to a backup file. The copy
+        stops if cancelled() becomes true."""
+        path = backup_path(name)
+        copy = self._start('backup', pool.dbname, name)
+        os.makedirs(BACKUPS_DIR, exist_ok=True)
+        part = path + '.part'
+        conn = None
+        try:
+            conn = pool.acquire()
+            target = sqlite3.connect(part)
+            try:
+                self._copy(copy, conn, target, self._throttle, cancelled)
+                if copy.state == 'done':
+                    # One file, without the -wal and -shm ones of a copy
+                    # of a database in the WAL journal mode
+                    target.execute("PRAGMA journal_mode=delete")
+            finally:
+                target.close()
+            if copy.state == 'done':
+                os.replace(part, path)
+        except:
+            if copy.state == 'running':
+                copy.state = 'failed'
+            raise
+        finally:
+            if conn is not None:
+                pool.release(conn)
+            if os.path.exists(part):
+                os.remove(part)
+        return copy
+
+    def restore(self, pool, name:str, cancelled=None) -> Copy:
+        """Replace the content of the database of the pool by a backup
+        file. A cancelled restore leaves the database as it was."""
+        path = backup_file(name)
+        copy = self._start('restore', pool.dbname, name)
+        conn = None
+        try:
+            source = sqlite3.connect(path)
+            try:
+                conn = pool.acquire()
+                self._copy(copy, source, conn, 0, cancelled)
+            finally:
+                source.close()
+        except:
+            if copy.state == 'running':
+                copy.state = 'failed'
+            raise
+        finally:
+            if conn is not None:
+                pool.release(conn)
+        return copy
+
+    def copies(self) -> list:
+        with self._lock:
+            return list(self._copies)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'running': sum(copy.state == 'running'
+                for copy in self._copies)}
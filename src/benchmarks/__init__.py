@@ -0,0 +1,4 @@
+"""Benchmarks.
+
+Run them from the 'src' folder, e.g. python3 -m benchmarks.bench_router
+"""
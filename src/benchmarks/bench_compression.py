@@ -0,0 +1,82 @@
+"""Benchmark of the per-frame compression of results.
+
+Encodes a wide and a tall result set in chunks of FETCH_BATCH_SIZE rows,
+as a SELECT does, then sends them over a socket pair with each
+compression method. Reports the bytes sent, the time taken to send,
+receive and decompress every chunk, and this time plus the one needed
+to carry the bytes on a link of the given bandwidth (a socket pair has
+none).
+"""
+
+import socket
+import threading
+import time
+from argparse import ArgumentParser
+
+import protocol
+import encoders
+from config import *
+
+def wide_rows(nb_rows:int) -> tuple:
+    columns = ['column_%d' % i for i in range(40)]
+    rows = [[i * 40 + j if j % 2 else 'value %d' % (i + j) for j in range(40)]
+        for i in range(nb_rows)]
+    return columns, rows
+
+def tall_rows(nb_rows:int) -> tuple:
+    columns = ['id', 'name', 'score', 'comment']
+    rows = [[i, 'user%d' % (i % 1000), i * 0.5, None if i % 3 else 'ok']
+        for i in range(nb_rows)]
+    return columns, rows
+
+def encode(output_format:str, columns:list, rows:list) -> list:
+    encoder = encoders.create_encoder(output_format, columns)
+    chunks = []
+    for i in range(0, len(rows), FETCH_BATCH_SIZE):
+        chunk = encoder.encode(rows[i:i + FETCH_BATCH_SIZE])
+        chunks.append(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+    return chunks
+
+def transfer(chunks:list, compression) -> tuple:
+    """Returns the bytes sent and the elapsed time."""
+    left, right = socket.socketpair()
+    with left, right:
+        sender = protocol.Channel(left)
+        sender.compression = compression
+        receiver = protocol.Channel(right)
+        start = time.perf_counter()
+        thread = threading.Thread(target=lambda: [sender.send(MSG_ROWS, chunk)
+            for chunk in chunks])
+        thread.start()
+        for chunk in chunks:
+            receiver.recv()
+        thread.join()
+        return sender.bytes_sent, time.perf_counter() - start
+
+def main(nb_rows:int, levels:list, bandwidth:float):
+    cases = [('wide', wide_rows(nb_rows // 10)), ('tall', tall_rows(nb_rows))]
+    for name, (columns, rows) in cases:
+        for output_format in ('text', 'binary'):
+            chunks = encode(output_format, columns, rows)
+            raw = sum(len(chunk) for chunk in chunks)
+            print("%s result, %d rows, %s format, %d bytes" %
+                (name, len(rows), output_format, raw))
+            settings = [('none', None)] + [('%s-%d' % (method, level),
+                protocol.Compression(method, level))
+                for method in COMPRESSION_METHODS for level in levels]
+            for label, compression in settings:
+                size, elapsed = transfer(chunks, compression)
+                on_link = elapsed + size * 8 / (bandwidth * 1e6)
+                print("  %-8s %10d bytes %6.1f%% %8.1f ms %8.1f ms on link" %
+                    (label, size, 100.0 * size / raw, elapsed * 1000,
+                    on_link * 1000))
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--rows', dest='rows', default=100000, type=int)
+    parser.add_argument('-l', '--levels', dest='levels', default='1,6',
+        type=lambda value: [int(level) for level in value.split(',')])
+    parser.add_argument('-b', '--bandwidth', dest='bandwidth', default=100,
+        type=float, help="link bandwidth in Mbit/s")
+    args = parser.parse_args()
+    main(args.rows, args.levels, args.bandwidth)
@@ -0,0 +1,92 @@
+"""Benchmark of a reconnect burst.
+
+Starts a server as benchmarks.load_test does, then --clients clients
+connect and log in at the same time, --rounds times: first with their
+password, then with the session token they got. Reports the connect to
+ready (login reply received) latency of each kind of login.
+
+    python3 -m benchmarks.bench_login --clients 1000
+"""
+
+import multiprocessing
+import threading
+import time
+from argparse import ArgumentParser
+
+import connection
+from benchmarks.load_test import serve, summarize, USERNAME, PASSWORD
+from config import *
+
+def burst(port:int, clients:int, token=None) -> tuple:
+    """All clients log in at once. Returns their latencies and the last
+    token received."""
+    latencies = []
+    tokens = []
+    errors = []
+    barrier = threading.Barrier(clients)
+
+    def login():
+        conn = connection.Connection('127.0.0.1', port)
+        barrier.wait()
+        start = time.perf_counter()
+        try:
+            conn.connect()
+            if token is None:
+                conn.login(USERNAME, PASSWORD)
+            else:
+                conn.login(USERNAME, token=token)
+            latencies.append(time.perf_counter() - start)
+            tokens.append(conn.token)
+        except (OSError, connection.LoginError) as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=login) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        print("%d errors, first one: %s" % (len(errors), errors[0]))
+    return latencies, tokens[-1] if tokens else None
+
+def main(args):
+    port_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    process = multiprocessing.Process(target=serve,
+        args=(args.mode, args.processes, port_queue, stop_event, result_queue))
+    process.start()
+    try:
+        port = port_queue.get(timeout=30)
+        print("%d clients, %s mode, %d processes" % (args.clients, args.mode,
+            args.processes))
+        print("%-8s %9s %9s %9s %9s %9s" % ('', 'logins', 'mean ms',
+            'p50 ms', 'p95 ms', 'p99 ms'))
+        for kind in ('password', 'token'):
+            latencies = []
+            token = None
+            if kind == 'token':
+                token = burst(port, 1)[1]
+            for i in range(args.rounds):
+                latencies += burst(port, args.clients, token)[0]
+            stats = summarize(latencies, 1.0)
+            print("%-8s %9d %9.3f %9.3f %9.3f %9.3f" % (kind,
+                stats['requests'], stats['mean_ms'], stats['p50_ms'],
+                stats['p95_ms'], stats['p99_ms']))
+    finally:
+        stop_event.set()
+        result_queue.get(timeout=30)
+        process.join()
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--clients', dest='clients', default=1000,
+        type=int)
+    parser.add_argument('-r', '--rounds', dest='rounds', default=3, type=int)
+    parser.add_argument('-m', '--mode', dest='mode', choices=SERVER_MODES,
+        default=DEFAULT_SERVER_MODE)
+    parser.add_argument('-p', '--processes', dest='processes', default=1,
+        type=int, help="server processes")
+    main(parser.parse_args())
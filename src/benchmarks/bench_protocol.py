@@ -0,0 +1,51 @@
+"""Benchmark of the frame transport (protocol.Channel).
+
+Sends frames of the given sizes over a socket pair, from one thread to
+another, and reports the frames and megabytes per second. Small frames
+show the cost per frame (system calls, allocations), large ones the
+cost per byte (copies).
+"""
+
+import socket
+import threading
+import time
+from argparse import ArgumentParser
+
+import protocol
+from config import *
+
+def transfer(size:int, count:int) -> float:
+    """Returns the time taken to send and receive count frames."""
+    payload = b'x' * size
+    left, right = socket.socketpair()
+    with left, right:
+        sender = protocol.Channel(left)
+        receiver = protocol.Channel(right)
+        start = time.perf_counter()
+        thread = threading.Thread(target=lambda: [sender.send(MSG_ROWS,
+            payload, i) for i in range(count)])
+        thread.start()
+        for i in range(count):
+            frame = receiver.recv()
+        thread.join()
+        elapsed = time.perf_counter() - start
+        assert len(frame.payload) == size
+        return elapsed
+
+def main(sizes:list, total:int, repeat:int):
+    for size in sizes:
+        count = max(10, total // size)
+        elapsed = min(transfer(size, count) for i in range(repeat))
+        print("%9d bytes x %7d frames: %9.0f frames/s %8.1f MB/s" % (size,
+            count, count / elapsed, size * count / elapsed / 1e6))
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--sizes', dest='sizes',
+        default='64,1024,65536,1048576,16777216',
+        type=lambda value: [int(size) for size in value.split(',')])
+    parser.add_argument('-t', '--total', dest='total', default=64 * 1024 * 1024,
+        type=int, help="bytes sent for each size")
+    parser.add_argument('-r', '--repeat', dest='repeat', default=3, type=int)
+    args = parser.parse_args()
+    main(args.sizes, args.total, args.repeat)
@@ -0,0 +1,48 @@
+"""Micro-benchmark of the statement routing.
+
+Compares the former routing, which tries every pattern of
+config.STATEMENTS with re.fullmatch(), with router.StatementRouter.
+"""
+
+import re
+import timeit
+from argparse import ArgumentParser
+
+import router
+from config import *
+
+ENTRIES = [
+    "SELECT * FROM users WHERE id = 42;",
+    "INSERT INTO logs (message) VALUES ('hello');",
+    "UPDATE users SET name = 'ludo' WHERE id = 1;",
+    "DELETE FROM logs WHERE id < 100;",
+    "USE tweets;",
+    "SHOW DATABASES;",
+    "CREATE DATABASE tweets;",
+    "SET FORMAT csv;",
+]
+
+def route_by_scan(entry:str):
+    for key, pattern in STATEMENTS.items():
+        if re.fullmatch(pattern, entry, re.IGNORECASE | re.VERBOSE) is not None:
+            return key
+    return None
+
+def route_by_router(entry:str):
+    return router.statements.match(entry)[0]
+
+def main(number:int):
+    for entry in ENTRIES:
+        assert route_by_scan(entry) == route_by_router(entry), entry
+    print("%d routings of %d entries" % (number, len(ENTRIES)))
+    for name, func in (('scan', route_by_scan), ('router', route_by_router)):
+        elapsed = min(timeit.repeat(lambda: [func(e) for e in ENTRIES],
+            number=number, repeat=5))
+        print("%-8s %8.3f usec per entry" %
+            (name, elapsed / (number * len(ENTRIES)) * 1e6))
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--number', dest='number', default=20000, type=int)
+    args = parser.parse_args()
+    main(args.number)
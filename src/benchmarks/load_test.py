@@ -0,0 +1,288 @@
+"""Load test of the client - server stack.
+
+Starts an FDB_Server in a child process, in a temporary folder, then
+drives concurrent clients speaking the real protocol (connection.py).
+Each client runs a random mix of point SELECTs, scans, inserts and USE
+switches between two databases until the end of the test.
+
+Reports the throughput, the latency percentiles of each kind of request
+and the peak memory of the server and of the clients. Results can be
+written as JSON, and compared against a baseline written the same way:
+
+    python3 -m benchmarks.load_test --clients 16 --output run.json
+    python3 -m benchmarks.load_test --baseline run.json
+
+The exit status is 1 if the throughput or the p99 latency got worse
+than the baseline by more than --tolerance.
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+import connection
+from config import *
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+DATABASES = ('bench_a', 'bench_b')
+DEFAULT_MIX = 'point=60,scan=10,insert=25,use=5'
+
+
+def parse_mix(value:str) -> dict:
+    mix = {}
+    for part in value.split(','):
+        kind, weight = part.split('=')
+        if kind not in OPERATIONS:
+            raise ValueError("Unknown operation: %s" % kind)
+        mix[kind] = float(weight)
+    return mix
+
+def percentile(values:list, q:float) -> float:
+    """values must be sorted."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def max_rss_kb(who=resource.RUSAGE_SELF) -> int:
+    usage = resource.getrusage(who).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+# Operations: function(client) returning the statement to send
+
+def point_select(client) -> str:
+    return "SELECT * FROM items WHERE id = %d;" % \
+        client.random.randint(1, client.nb_rows)
+
+def scan(client) -> str:
+    return "SELECT * FROM items WHERE value >= %f LIMIT 500;" % \
+        client.random.random()
+
+def insert(client) -> str:
+    return "INSERT INTO items (name, value) VALUES ('client %d', %f);" % \
+        (client.number, client.random.random())
+
+def use(client) -> str:
+    client.dbname = DATABASES[1] if client.dbname == DATABASES[0] \
+        else DATABASES[0]
+    return "USE %s;" % client.dbname
+
+OPERATIONS = {'point': point_select, 'scan': scan, 'insert': insert,
+    'use': use}
+
+
+# Server process
+
+def serve(mode:str, processes:int, port_queue, stop_event, result_queue):
+    """Run the server in a temporary folder until stop_event is set."""
+    import server
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        os.makedirs(DATABASES_DIR)
+        _server = server.FDB_Server('127.0.0.1', 0, mode, processes=processes)
+        _server.create_tables()
+        _server.insert_new_user(USERNAME, PASSWORD)
+        _server.close_db_connection()
+        thread = threading.Thread(target=_server.run)
+        thread.start()
+        _server.ready.wait()
+        port_queue.put(_server.socket.getsockname()[1])
+        stop_event.wait()
+        _server.shutdown()
+        thread.join()
+        # The largest of the server processes
+        result_queue.put({'max_rss_kb': max(max_rss_kb(),
+            max_rss_kb(resource.RUSAGE_CHILDREN))})
+
+
+# Clients
+
+class Client(threading.Thread):
+    def __init__(self, number:int, port:int, mix:dict, nb_rows:int,
+            deadline:float, seed:int):
+        super().__init__(daemon=True)
+        self.number = number
+        self.port = port
+        self.nb_rows = nb_rows
+        self.deadline = deadline
+        self.random = random.Random(seed + number)
+        self.dbname = DATABASES[number % len(DATABASES)]
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.latencies = {kind: [] for kind in mix}
+        self.errors = 0
+
+    def run(self):
+        with connection.Connection('127.0.0.1', self.port, 1) as conn:
+            conn.connect()
+            conn.login(USERNAME, PASSWORD)
+            conn.query("USE %s;" % self.dbname).result()
+            while time.perf_counter() < self.deadline:
+                kind = self.random.choices(self.kinds, self.weights)[0]
+                statement = OPERATIONS[kind](self)
+                start = time.perf_counter()
+                result = conn.query(statement).result()
+                self.latencies[kind].append(time.perf_counter() - start)
+                if not result.ok:
+                    self.errors += 1
+
+
+def prepare(port:int, nb_rows:int):
+    """Create the databases, each one with a table of nb_rows rows."""
+    with connection.Connection('127.0.0.1', port) as conn:
+        conn.connect()
+        conn.login(USERNAME, PASSWORD)
+        for dbname in DATABASES:
+            for statement in ("CREATE DATABASE %s;" % dbname,
+                    "USE %s;" % dbname, "CREATE TABLE items (id INTEGER "
+                    "PRIMARY KEY, name TEXT, value REAL);"):
+                conn.query(statement).result()
+            rows = (('item %d' % i, random.random()) for i in range(nb_rows))
+            result = conn.load("INSERT INTO items (name, value) VALUES (?, ?)",
+                rows).result()
+            if not result.ok:
+                raise RuntimeError(result.message.strip())
+
+def summarize(latencies:list, duration:float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'qps': len(latencies) / duration,
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+def run(args) -> dict:
+    mix = parse_mix(args.mix)
+    port_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    process = multiprocessing.Process(target=serve,
+        args=(args.mode, args.processes, port_queue, stop_event, result_queue))
+    process.start()
+    try:
+        port = port_queue.get(timeout=30)
+        prepare(port, args.rows)
+        start = time.perf_counter()
+        clients = [Client(i, port, mix, args.rows, start + args.duration,
+            args.seed) for i in range(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        duration = time.perf_counter() - start
+    finally:
+        stop_event.set()
+        server_memory = result_queue.get(timeout=30)
+        process.join()
+
+    operations = {}
+    for kind in mix:
+        operations[kind] = summarize([latency for client in clients
+            for latency in client.latencies[kind]], duration)
+    total = summarize([latency for client in clients
+        for latencies in client.latencies.values() for latency in latencies],
+        duration)
+    total['errors'] = sum(client.errors for client in clients)
+    return {
+        'config': {'mode': args.mode, 'processes': args.processes,
+            'clients': args.clients,
+            'duration': args.duration, 'rows': args.rows, 'mix': mix,
+            'seed': args.seed},
+        'platform': {'python': platform.python_version(),
+            'system': platform.platform(), 'cpus': os.cpu_count()},
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'total': total,
+        'operations': operations,
+        'memory': {'server_max_rss_kb': server_memory['max_rss_kb'],
+            'client_max_rss_kb': max_rss_kb()},
+    }
+
+def report(results:dict):
+    config = results['config']
+    print("%d clients, %s mode, %d processes, %.1f sec, %d rows per table" % (
+        config['clients'], config['mode'], config.get('processes', 1),
+        config['duration'], config['rows']))
+    print("%-8s %9s %10s %9s %9s %9s %9s" % ('', 'requests', 'qps', 'mean ms',
+        'p50 ms', 'p95 ms', 'p99 ms'))
+    rows = list(results['operations'].items()) + [('total', results['total'])]
+    for name, stats in rows:
+        print("%-8s %9d %10.1f %9.3f %9.3f %9.3f %9.3f" % (name,
+            stats['requests'], stats['qps'], stats['mean_ms'], stats['p50_ms'],
+            stats['p95_ms'], stats['p99_ms']))
+    print("errors: %d" % results['total']['errors'])
+    print("memory: server %d KB, clients %d KB" % (
+        results['memory']['server_max_rss_kb'],
+        results['memory']['client_max_rss_kb']))
+
+def compare(results:dict, baseline:dict, tolerance:float) -> bool:
+    """Print the changes since the baseline. Returns False on regression."""
+    ok = True
+    print("\nCompared to the baseline of %s:" % baseline.get('time', '?'))
+    if baseline.get('config') != results['config']:
+        print("WARNING: the baseline was run with other settings: %s" %
+            json.dumps(baseline.get('config')))
+    checks = [('total', results['total'], baseline['total'])]
+    checks += [(kind, stats, baseline['operations'][kind])
+        for kind, stats in results['operations'].items()
+        if kind in baseline.get('operations', {})]
+    for name, stats, base in checks:
+        for key, higher_is_better in (('qps', True), ('p99_ms', False)):
+            if not base.get(key):
+                continue
+            change = (stats[key] - base[key]) / base[key]
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  REGRESSION'
+                ok = False
+            print("%-8s %-7s %10.3f -> %10.3f (%+.1f%%)%s" % (name, key,
+                base[key], stats[key], change * 100, flag))
+    return ok
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--clients', dest='clients', default=8, type=int)
+    parser.add_argument('-d', '--duration', dest='duration', default=10.0,
+        type=float, help="seconds")
+    parser.add_argument('-m', '--mode', dest='mode', choices=SERVER_MODES,
+        default=DEFAULT_SERVER_MODE)
+    parser.add_argument('-p', '--processes', dest='processes', default=1,
+        type=int, help="server processes")
+    parser.add_argument('--mix', dest='mix', default=DEFAULT_MIX,
+        help="weights of the operations, default: %s" % DEFAULT_MIX)
+    parser.add_argument('--rows', dest='rows', default=10000, type=int)
+    parser.add_argument('--seed', dest='seed', default=0, type=int)
+    parser.add_argument('-o', '--output', dest='output', default=None,
+        help="write the results to this JSON file")
+    parser.add_argument('-b', '--baseline', dest='baseline', default=None,
+        help="compare the results with this JSON file")
+    parser.add_argument('-t', '--tolerance', dest='tolerance', default=0.1,
+        type=float, help="regression allowed (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    results = run(args)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as _file:
+            json.dump(results, _file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as _file:
+            baseline = json.load(_file)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
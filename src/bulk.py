@@ -0,0 +1,73 @@
+"""Bulk load of rows into a database.
+
+A client starts a load with a MSG_LOAD frame holding an INSERT statement,
+streams the rows with MSG_LOAD_ROWS frames, then ends it with MSG_LOAD_END.
+The server only replies to MSG_LOAD_END, so rows flow without a round
+trip per batch. Rows are inserted with executemany() and committed every
+commit_batch_size rows instead of once per row.
+"""
+
+import sqlite3
+import time
+
+
+class BulkLoad:
+    def __init__(self, conn:sqlite3.Connection, sql:str, commit_batch_size:int):
+        self._conn = conn
+        self._sql = sql
+        self._commit_batch_size = max(1, commit_batch_size)
+        # Rows loaded inside a transaction opened by the client are
+        # committed by the client
+        self._own_transaction = not conn.in_transaction
+        self._uncommitted = 0
+        self._start = time.perf_counter()
+        self.nb_rows = 0
+        self.error = None
+        if self._own_transaction:
+            conn.execute("BEGIN")
+
+    @property
+    def conn(self):
+        return self._conn
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def _commit(self):
+        if self._own_transaction:
+            self._conn.execute("COMMIT")
+        self.nb_rows += self._uncommitted
+        self._uncommitted = 0
+
+    def add(self, rows:list):
+        """Insert a batch of rows. After an error, rows are ignored."""
+        if self.error is not None:
+            return
+        try:
+            self._conn.executemany(self._sql, rows)
+            self._uncommitted += len(rows)
+            if self._uncommitted >= self._commit_batch_size:
+                self._commit()
+                if self._own_transaction:
+                    self._conn.execute("BEGIN")
+        except sqlite3.Error as e:
+            self.error = e
+            self.abort()
+
+    def finish(self):
+        """Commit the last rows. Raises the first error met, if any."""
+        if self.error is None:
+            try:
+                self._commit()
+            except sqlite3.Error as e:
+                self.error = e
+                self.abort()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        """Roll back the rows not committed yet."""
+        self._uncommitted = 0
+        if self._own_transaction and self._conn.in_transaction:
+            self._conn.rollback()
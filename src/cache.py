@@ -0,0 +1,208 @@
+"""Server-wide cache of encoded SELECT results.
+
+Entries are keyed by database, output format and normalized SQL text,
+and evicted in LRU order once the cache holds more than max_bytes of
+encoded rows.
+
+The tables a statement reads or writes are found through the SQLite
+authorizer, which is called when a statement is compiled. Compiled
+statements are reused by the connections (see STATEMENT_CACHE_SIZE),
+so what the authorizer reports is remembered per SQL text. A write
+invalidates the entries reading the tables it touches; a schema change,
+or a write whose tables are unknown, invalidates the whole database.
+"""
+
+import collections
+import sqlite3
+import threading
+import re
+
+from config import *
+
+_READ_ACTIONS = {sqlite3.SQLITE_READ}
+_WRITE_ACTIONS = {sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE,
+    sqlite3.SQLITE_DELETE}
+# Any of these makes every cached result of the database suspect
+_SCHEMA_ACTIONS = {sqlite3.SQLITE_DROP_TABLE, sqlite3.SQLITE_DROP_TEMP_TABLE,
+    sqlite3.SQLITE_DROP_VIEW, sqlite3.SQLITE_DROP_TEMP_VIEW,
+    sqlite3.SQLITE_DROP_TRIGGER, sqlite3.SQLITE_DROP_TEMP_TRIGGER,
+    sqlite3.SQLITE_CREATE_VIEW, sqlite3.SQLITE_CREATE_TEMP_VIEW,
+    sqlite3.SQLITE_CREATE_TRIGGER, sqlite3.SQLITE_CREATE_TEMP_TRIGGER,
+    sqlite3.SQLITE_ALTER_TABLE, sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH}
+# Table name used for statements changing the schema
+SCHEMA = None
+
+_literal_regex = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+_space_regex = re.compile(r"\s+")
+
+
+def normalize_sql(sql:str) -> str:
+    """Collapse whitespace outside of quoted strings and drop the final ';'."""
+    parts = _literal_regex.split(sql.strip().rstrip(';').rstrip())
+    # Odd parts are quoted strings
+    for i in range(0, len(parts), 2):
+        parts[i] = _space_regex.sub(' ', parts[i])
+    return ''.join(parts)
+
+
+class TableRecorder:
+    """Authorizer callback recording the tables used by a statement."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # The authorizer is only called when a statement gets compiled
+        self.called = False
+        self.reads = set()
+        self.writes = set()
+
+    def __call__(self, action, arg1, arg2, dbname, trigger):
+        self.called = True
+        if action in _READ_ACTIONS:
+            self.reads.add(arg1)
+        elif action in _WRITE_ACTIONS:
+            self.writes.add(arg1)
+        elif action in _SCHEMA_ACTIONS:
+            self.writes.add(SCHEMA)
+        return sqlite3.SQLITE_OK
+
+
+class CachedResult:
+    def __init__(self, chunks:list, nb_rows:int, tables:frozenset):
+        self.chunks = chunks
+        self.nb_rows = nb_rows
+        self.tables = tables
+        self.size = sum(len(chunk) for chunk in chunks)
+
+
+class ResultCache:
+    def __init__(self, max_bytes:int, max_entry_bytes=None,
+            max_statements=RESULT_CACHE_STATEMENTS):
+        self._max_bytes = max_bytes
+        self._max_entry_bytes = max_entry_bytes or max(1, max_bytes // 8)
+        self._max_statements = max_statements
+        self._lock = threading.Lock()
+        # key -> CachedResult, least recently used first
+        self._entries = collections.OrderedDict()
+        # (dbname, table) -> keys of the entries reading it
+        self._readers = collections.defaultdict(set)
+        # dbname -> number of invalidations, to drop results computed
+        # while the database changed
+        self._generations = collections.Counter()
+        # (dbname, sql) -> (tables read, tables written) reported by the
+        # authorizer when the statement was compiled
+        self._statements = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def max_entry_bytes(self):
+        return self._max_entry_bytes
+
+    @staticmethod
+    def key(dbname:str, output_format:str, sql:str, params=()) -> tuple:
+        return dbname, output_format, normalize_sql(sql), tuple(params)
+
+    # Tables used by statements
+
+    def install(self, conn):
+        """Install the table recorder on a new connection."""
+        conn.recorder = TableRecorder()
+        conn.set_authorizer(conn.recorder)
+
+    def start_statement(self, conn):
+        """Called before running a statement whose tables are wanted."""
+        if conn.recorder is not None:
+            conn.recorder.reset()
+
+    def statement_tables(self, conn, dbname:str, sql:str):
+        """Returns the tables read and written by the statement just run
+        on conn, or None if they are unknown."""
+        recorder = conn.recorder
+        key = (dbname, sql)
+        with self._lock:
+            if recorder is not None and recorder.called:
+                tables = (frozenset(recorder.reads), frozenset(recorder.writes))
+                self._statements[key] = tables
+                if len(self._statements) > self._max_statements:
+                    self._statements.popitem(last=False)
+                return tables
+            tables = self._statements.get(key)
+            if tables is not None:
+                self._statements.move_to_end(key)
+            return tables
+
+    # Results
+
+    def generation(self, dbname:str) -> int:
+        return self._generations[dbname]
+
+    def get(self, key:tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key:tuple, entry:CachedResult, generation:int):
+        """Store a result, unless its database changed since generation."""
+        if entry.size > self._max_entry_bytes:
+            return
+        dbname = key[0]
+        with self._lock:
+            if self._generations[dbname] != generation:
+                return
+            self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            for table in entry.tables:
+                self._readers[(dbname, table)].add(key)
+            while self._bytes > self._max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key:tuple):
+        """Lock must be held."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        for table in entry.tables:
+            keys = self._readers.get((key[0], table))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._readers[(key[0], table)]
+
+    def invalidate(self, dbname:str, tables=None):
+        """Drop the entries reading the given tables (all if None)."""
+        with self._lock:
+            self._generations[dbname] += 1
+            if tables is None or SCHEMA in tables:
+                keys = [key for key in self._entries if key[0] == dbname]
+            else:
+                keys = set()
+                for table in tables:
+                    keys |= self._readers.get((dbname, table), set())
+            for key in list(keys):
+                self._remove(key)
+            self.invalidations += len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self._max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
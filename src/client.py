@@ -6,55 +6,275 @@
 import socket 
 import getpass 
 import datetime 
-import re 
+import signal
+import threading
+import csv
+import itertools
 
 import utils
+import protocol
+import encoders
+import router
+import connection
+from connection import LoginError, QueryError
 from config import *
 
-class LoginError(Exception):
-    pass
+class _Interruption:
+    """Turn Ctrl-C into a flag while a result is being received.
+
+    Stopping in the middle of a frame would corrupt the stream.
+    """
+    def __init__(self):
+        self.fired = False
+        self._handler = None
+
+    def _fire(self, signum, frame):
+        self.fired = True
+
+    def __enter__(self):
+        if threading.current_thread() is threading.main_thread():
+            self._handler = signal.signal(signal.SIGINT, self._fire)
+        return self
+
+    def __exit__(self, *args):
+        if self._handler is not None:
+            signal.signal(signal.SIGINT, self._handler)
+            self._handler = None
 
 class FDB_Client:
     commands = {'exit', 'quit', 'help'}
 
-    def __init__(self, username:str, address:str, port:int):
+    def __init__(self, username:str, address:str, port:int,
+            compression=COMPRESSION_METHODS, compression_level=COMPRESSION_LEVEL):
         self.username = username
         # Server information for connection
         self.address = address 
         self.port = port
         self.conn = None 
+        self.channel = None
         self.checker = utils.SQL_Checker() 
+        self.output_format = DEFAULT_OUTPUT_FORMAT
+        self._requested_format = None
+        self._request_id = 0
+        # Compression methods offered to the server
+        self.compression = tuple(compression)
+        self.compression_level = compression_level
 
-    def send_data(self, data:bytes):
+    def send_data(self, msg_type:int, data:bytes):
         """Send the data to the server."""
-        if self.conn:
-            self.conn.sendall(data)
+        if self.channel:
+            self._request_id += 1
+            self.channel.send(msg_type, data, self._request_id)
+
+    def receive(self):
+        """Wait for the reply to the last request."""
+        frame = self.channel.recv()
+        if frame is None:
+            raise ConnectionError("Connection closed by the server")
+        return frame
 
     def print_results(self):
-        """Wait and print incoming data."""
-        results = self.conn.recv(1024)
-        results = results.decode(encoding="utf-8")
-        print(results)
+        """Wait and print incoming data until the end of the result, and
+        returns its last frame.
+
+        Rows are printed as they arrive. Ctrl-C asks the server to stop
+        sending rows.
+        """
+        request_id = self._request_id
+        table = None
+        with _Interruption() as interruption:
+            while True:
+                frame = self.receive()
+                if frame.msg_type != MSG_ROWS:
+                    print(frame.payload.decode(encoding="utf-8"))
+                    break
+                if self.output_format == 'binary':
+                    if table is None:
+                        table = utils.StreamingTextTable(TABLE_SAMPLE_SIZE)
+                    columns, rows = encoders.decode_columnar(frame.payload)
+                    print(table.format(rows), end='', flush=True)
+                else:
+                    print(frame.payload.decode(encoding="utf-8"), end='',
+                        flush=True)
+                if interruption.fired:
+                    interruption.fired = False
+                    self.channel.send(MSG_CANCEL, request_id=request_id)
+        if self._requested_format and frame.status == STATUS_OK:
+            self.output_format = self._requested_format
+        self._requested_format = None
+        return frame
+
+    def prepare(self, sql:str) -> tuple:
+        """Prepare a statement on the server.
+
+        Returns the statement id and its number of parameters.
+        """
+        self.send_data(MSG_PREPARE, sql.encode("utf-8"))
+        frame = self.receive()
+        if frame.msg_type != MSG_PREPARED:
+            raise QueryError(frame.payload.decode(encoding="utf-8").strip())
+        return protocol.PREPARED.unpack(frame.payload)
+
+    def execute(self, statement_id:int, params=()):
+        """Run a prepared statement and print its result."""
+        self.send_data(MSG_EXECUTE, protocol.pack_execute(statement_id, params))
+        self.print_results()
+
+    def load(self, sql:str, rows, commit_batch_size=0):
+        """Bulk load rows (sequences of values) with an INSERT statement.
+
+        Rows are sent by batches without waiting for the server, which
+        commits them every commit_batch_size rows (0: server default).
+        Returns the final reply frame.
+        """
+        self.send_data(MSG_LOAD, protocol.pack_fields(sql, commit_batch_size))
+        request_id = self._request_id
+        try:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= LOAD_SEND_BATCH_SIZE:
+                    self.channel.send(MSG_LOAD_ROWS, protocol.pack_rows(batch),
+                        request_id)
+                    batch = []
+            if batch:
+                self.channel.send(MSG_LOAD_ROWS, protocol.pack_rows(batch),
+                    request_id)
+        finally:
+            # The server only replies to the end of the load
+            self.channel.send(MSG_LOAD_END, request_id=request_id)
+            frame = self.receive()
+        return frame
+
+    def load_data(self, path:str, table:str, skip=0):
+        """Load a CSV file into a table and print the report.
+
+        '\\N' fields are loaded as NULL.
+        """
+        try:
+            with open(path, newline='', encoding="utf-8") as csv_file:
+                reader = csv.reader(csv_file)
+                for i in range(skip):
+                    next(reader, None)
+                first = next(reader, None)
+                if first is None:
+                    print("\n%s\n" % (SUCCESS['rows-loaded'] % (0, 0, 0)))
+                    return
+                sql = "INSERT INTO %s VALUES (%s)" % (table,
+                    ', '.join(['?'] * len(first)))
+                rows = ([None if field == '\\N' else field for field in row]
+                    for row in itertools.chain([first], reader))
+                frame = self.load(sql, rows)
+        except (OSError, csv.Error) as e:
+            print(f"\nERROR: {str(e)}\n")
+        else:
+            print(frame.payload.decode(encoding="utf-8"))
+
+    def print_result(self, result:connection.Result):
+        """Print a result received through a pipelined connection."""
+        if self.output_format == 'binary':
+            table = utils.StreamingTextTable(TABLE_SAMPLE_SIZE)
+            for chunk in result.chunks:
+                columns, rows = encoders.decode_columnar(chunk)
+                print(table.format(rows), end='')
+        else:
+            for chunk in result.chunks:
+                print(bytes(chunk).decode(encoding="utf-8"), end='')
+        print(result.message)
+
+    def run_script(self, path:str, depth=PIPELINE_DEPTH):
+        """Run the statements of a SQL file without waiting for each
+        reply, and print their results in order."""
+        password = getpass.getpass(prompt="Enter password: ")
+        try:
+            with open(path, encoding="utf-8") as script, \
+                    connection.Connection(self.address, self.port, depth,
+                        self.compression, self.compression_level) as conn:
+                conn.connect()
+                conn.login(self.username, password)
+                for statement, result in conn.run_script(script):
+                    key, match = router.statements.match(statement)
+                    self.print_result(result)
+                    if key == 'set-format' and result.ok:
+                        self.output_format = match.group('format').lower()
+        except (OSError, LoginError, protocol.ProtocolError) as e:
+            print(e)
+
+    def _statement(self, key:str, statement:str):
+        """Send a custom statement."""
+        self.send_data(MSG_STATEMENT, protocol.pack_fields(key, statement))
+
+    def page(self, sql:str, size=CLIENT_PAGE_SIZE):
+        """Show the rows of a SELECT a page at a time.
+
+        The query runs once, in a server-side cursor: each page is
+        fetched when asked for.
+        """
+        self._statement('declare-cursor', "DECLARE %s CURSOR FOR %s;" %
+            (PAGER_CURSOR, sql))
+        frame = self.receive()
+        if frame.status != STATUS_OK:
+            print(frame.payload.decode(encoding="utf-8"))
+            return
+        end = SUCCESS['cursor-end'] % PAGER_CURSOR
+        try:
+            while True:
+                self._statement('fetch-cursor', "FETCH NEXT %d FROM %s;" %
+                    (size, PAGER_CURSOR))
+                frame = self.print_results()
+                if frame.status != STATUS_OK or \
+                        end in frame.payload.decode(encoding="utf-8"):
+                    break
+                if input(PAGER_PROMPT).strip().lower() == 'q':
+                    break
+        finally:
+            self._statement('close-cursor', "CLOSE %s;" % PAGER_CURSOR)
+            self.receive()
+
+    def run_client_statement(self, entry:str) -> bool:
+        """Run the entry if it is a statement handled by the client itself.
+
+        Returns True if it was.
+        """
+        key, match = router.client_statements.match(entry)
+        if match is None:
+            return False
+        if key == 'page':
+            self.page(match.group('query'))
+        else:
+            self.load_data(match.group('path'), match.group('table'),
+                int(match.group('skip') or 0))
+        return True
 
     def connect_to_server(self):
         """Establish connection between client and server."""
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.conn.connect((self.address, self.port))
+        self.channel = protocol.Channel(self.conn)
 
     def close_connection(self):
         """Close connection with server."""
         if self.conn:
             self.conn.close()
             self.conn = None  
+            self.channel.close()
+            self.channel = None
 
     def login(self):
         """Manages user's login."""
         password = getpass.getpass(prompt="Enter password: ")
-        data = bytes(self.username + DATA_SEPARATOR + password, 'utf-8')
-        self.send_data(data)
-        data = self.conn.recv(1024)
-        if data.decode(encoding="utf-8") != 'ok':
-            raise LoginError("Invalid username or password!")
+        self.send_data(MSG_LOGIN, protocol.pack_fields(self.username, password,
+            ','.join(self.compression)))
+        frame = self.receive()
+        if frame.msg_type != MSG_LOGIN or frame.status != STATUS_OK:
+            # A server turning the connection away says why
+            raise LoginError(frame.payload.decode(encoding="utf-8") or
+                "Invalid username or password!")
+        # The server replies with the compression method it chose
+        method = frame.payload.decode(encoding="utf-8")
+        if method:
+            self.channel.compression = protocol.Compression(method,
+                self.compression_level)
 
     def find_custom_statement(self, entry:str) -> bytes:
         """Try to find a specific statement for user or database.
@@ -63,10 +283,12 @@ class FDB_Client:
         to the key found in the STATEMENTS dict.
         """
         data = b''
-        for key, pattern in STATEMENTS.items():
-            if re.fullmatch(pattern, entry, re.IGNORECASE | re.VERBOSE) is not None:
-                data = bytes(key + DATA_SEPARATOR + entry, encoding="utf-8")
-                break 
+        key, match = router.statements.match(entry)
+        if match is not None:
+            data = protocol.pack_fields(key, entry)
+            if key == 'set-format':
+                # Rows are decoded according to the format in use
+                self._requested_format = match.group('format').lower()
         return data 
 
     def run(self):
@@ -74,7 +296,7 @@ class FDB_Client:
         try:
             self.connect_to_server()
             self.login()
-        except (socket.error, LoginError) as e:
+        except (socket.error, LoginError, protocol.ProtocolError) as e:
             print(e)
         else:
             cls = self.__class__
@@ -87,16 +309,18 @@ class FDB_Client:
                     elif entry == 'help':
                         cls.help()
                     else: pass
-                else:
+                elif not self.run_client_statement(entry):
+                    msg_type = MSG_STATEMENT
                     data = self.find_custom_statement(entry)
                     if not data:
                         self.checker.update(entry)
                         if self.checker.is_valid_statement():
+                            msg_type = MSG_QUERY
                             data = self.checker.sql_to_bytes()
                         else:
                             print(f"\nERROR: {ERROR['invalid-statement']}\n")
                             continue
-                    self.send_data(data)
+                    self.send_data(msg_type, data)
                     self.print_results()
             print("\nBye\n")
         finally:
@@ -132,7 +356,11 @@ class FDB_Client:
 if __name__ == '__main__':
     args = utils.parse_client_args()
     if utils.is_valid_ip(args.host):
-        client = FDB_Client(args.user, args.host, args.port)
-        client.run()
+        client = FDB_Client(args.user, args.host, args.port, args.compression,
+            args.compression_level)
+        if args.file:
+            client.run_script(args.file, args.pipeline)
+        else:
+            client.run()
     else:
         print("ERROR: Invalid IP address")
@@ -7,12 +7,178 @@ DEFAULT_HOST = 'localhost'
 DEFAULT_PORT = 5100
 SERVER_DATABASE = DATABASES_DIR + 'fastdb_info.db'
 LOG_FILE = 'log.txt'
+# Log writer (see utils.Logger): lines waiting before new ones get
+# dropped, lines written at once, seconds between flushes, size of a
+# file before rotation (0: never) and rotated files kept
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 1.0
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# 'text' or 'json' (one object per line)
+LOG_FORMATS = ('text', 'json')
+DEFAULT_LOG_FORMAT = 'text'
 
-DATA_SEPARATOR = '$'
-ACCESS_GRANTED = b'ok'
-ACCESS_DENIED  = b'access denied'
+# Connections waiting to be accepted (capped by the system, somaxconn
+# on Linux): a burst of connections beyond it waits for SYN retries
+LISTEN_BACKLOG = 1024
+
+# Admission control (see admission.py), 0 (None for the timeout) for no
+# limit: sessions running at once, connections waiting for one of them
+# and for how many seconds, statements a user runs at once, seconds a
+# statement may run, and bytes of rows sent for a result
+MAX_CONNECTIONS = 256
+CONNECTION_QUEUE_SIZE = 256
+CONNECTION_QUEUE_TIMEOUT = 10
+MAX_USER_QUERIES = 0
+STATEMENT_TIMEOUT = None
+MAX_RESULT_SIZE = 0
+# SQLite instructions between two checks of the statement timeout
+PROGRESS_HANDLER_STEPS = 10000
+
+# 'thread': one thread per client, 'async': one event loop for all clients
+SERVER_MODES = ('thread', 'async')
+DEFAULT_SERVER_MODE = 'thread'
+# Seconds between two checks of a shutdown request in 'thread' mode, and
+# given to 'async' sessions to end on shutdown
+SHUTDOWN_POLL_INTERVAL = 0.5
+# Seconds a server process (--processes) has to start listening
+PROCESS_START_TIMEOUT = 30
+# Threads running sqlite3 calls in 'async' mode
+ASYNC_WORKERS = 8
+# Frames read ahead by an 'async' session
+ASYNC_PENDING_FRAMES = 64
+
+# Rows fetched and sent at once by a SELECT
+FETCH_BATCH_SIZE = 500
+# Output format of the results: text, csv, ndjson or binary
+DEFAULT_OUTPUT_FORMAT = 'text'
+# Rows of the first chunk used to compute the width of the columns of a
+# streamed table
+TABLE_SAMPLE_SIZE = 1000
+
+# Prepared statements kept by a session (see prepared.py)
+PREPARED_CACHE_SIZE = 64
+# Statements kept compiled by each SQLite connection
+STATEMENT_CACHE_SIZE = 256
+
+# Server-side cursors (see cursors.py): cursors a session may keep open,
+# seconds an unused one stays open, rows of a FETCH without a count, and
+# rows per page of the client pager (PAGE SELECT ...)
+MAX_SESSION_CURSORS = 8
+CURSOR_IDLE_TIMEOUT = 300
+CURSOR_FETCH_SIZE = 100
+CLIENT_PAGE_SIZE = 50
+# Cursor declared by the client pager
+PAGER_CURSOR = 'fastdb_pager'
+
+# Backups (see backup.py): folder of the backup files, pages copied at
+# once, seconds a backup sleeps between two steps, times the copy starts
+# again (the source changed) before copying in one step, and copies shown
+# by SHOW BACKUPS
+BACKUPS_DIR = 'backups/'
+BACKUP_PAGES = 256
+BACKUP_THROTTLE = 0.01
+BACKUP_MAX_RESTARTS = 3
+BACKUP_HISTORY = 32
+
+# Bulk loads (see bulk.py): rows committed at once, rows sent per frame
+LOAD_COMMIT_BATCH_SIZE = 10000
+LOAD_SEND_BATCH_SIZE = 1000
+
+# Requests a pipelined client sends before waiting for replies (see
+# connection.py)
+PIPELINE_DEPTH = 128
+
+# Result cache (see cache.py), disabled if 0 bytes
+RESULT_CACHE_SIZE = 0
+# Statements whose tables are remembered by the result cache
+RESULT_CACHE_STATEMENTS = 4096
+
+# Connection pools (see pool.py), delays in seconds
+POOL_MAX_SIZE = 8
+POOL_IDLE_TIMEOUT = 300
+POOL_HEALTH_CHECK_INTERVAL = 30
+POOL_ACQUIRE_TIMEOUT = 10
+POOL_DRAIN_TIMEOUT = 5
+
+# Write queues (see writes.py): writes committed at once (0: no queue,
+# sessions write on their own connection), seconds waited for more writes
+# before committing, queued writes before sessions wait
+WRITE_GROUP_SIZE = 64
+WRITE_GROUP_DELAY = 0
+WRITE_QUEUE_SIZE = 1024
+# Attempts made again when the database is busy, first and longest delay
+# between two of them in seconds
+WRITE_RETRIES = 5
+WRITE_RETRY_DELAY = 0.005
+WRITE_RETRY_MAX_DELAY = 0.2
+
+# SQLite tuning profiles (see tuning.py): PRAGMAs applied to every
+# connection to a database, cache_size in KiB if negative, mmap_size in
+# bytes, busy_timeout in milliseconds. 'legacy' are the SQLite defaults
+TUNING_PROFILES = {
+    'default': {'journal_mode': 'wal', 'synchronous': 'normal',
+        'cache_size': -8192, 'mmap_size': 0, 'temp_store': 'default',
+        'busy_timeout': 5000},
+    'durable': {'journal_mode': 'wal', 'synchronous': 'full',
+        'cache_size': -8192, 'mmap_size': 0, 'temp_store': 'default',
+        'busy_timeout': 5000},
+    'fast': {'journal_mode': 'wal', 'synchronous': 'off',
+        'cache_size': -65536, 'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'memory', 'busy_timeout': 5000},
+    'legacy': {'journal_mode': 'delete', 'synchronous': 'full',
+        'cache_size': -2000, 'mmap_size': 0, 'temp_store': 'default',
+        'busy_timeout': 5000},
+}
+DEFAULT_TUNING_PROFILE = 'default'
+
+# Metrics (see metrics.py): HTTP listener, disabled if port is 0
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 0
+METRICS_PREFIX = 'fastdb_'
+
+# Slow query log (see slowlog.py): statements taking at least this many
+# seconds are logged, none if None
+SLOW_QUERY_TIME = None
+SLOW_QUERY_LOG_FILE = 'slow.log'
+
+# Login (see auth.py): lifetime of the session tokens, in seconds, and
+# passwords checked recently kept for CREDENTIAL_CACHE_TTL seconds
+SESSION_TOKEN_TTL = 3600
+CREDENTIAL_CACHE_SIZE = 1024
+CREDENTIAL_CACHE_TTL = 60
+
+# Wire protocol (see protocol.py)
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+RECV_BUFFER_SIZE = 64 * 1024
+# Receive buffers kept for the next connections (see protocol.BufferPool)
+RECV_BUFFER_POOL_SIZE = 64
+# Per-frame compression, negotiated at login: methods in order of
+# preference, level (0-9) and smallest payload compressed
+COMPRESSION_METHODS = ('zlib', 'lzma')
+COMPRESSION_LEVEL = 1
+COMPRESSION_THRESHOLD = 1024
+
+MSG_LOGIN     = 1
+MSG_QUERY     = 2
+MSG_STATEMENT = 3
+MSG_RESULT    = 4
+MSG_ROWS      = 5
+MSG_CANCEL    = 6
+MSG_PREPARE   = 7
+MSG_EXECUTE   = 8
+MSG_PREPARED  = 9
+MSG_LOAD      = 10
+MSG_LOAD_ROWS = 11
+MSG_LOAD_END  = 12
+
+STATUS_OK     = 0
+STATUS_ERROR  = 1
+STATUS_DENIED = 2
 
 CLIENT_PROMPT = "fastdb> "
+PAGER_PROMPT = "-- More -- (Enter: next page, q: quit) "
 CLIENT_APP_NAME = "FastDB"
 CLIENT_APP_VERSION = "1.0.1"
 
@@ -25,7 +191,28 @@ ERROR = {
     'unknown-database': "Unknown database '%s'",
     'no-database': "No such database '%s'",
     'no-user': "No user named '%s'",
-    'no-database-seleted': "No database in use"
+    'no-database-seleted': "No database in use",
+    'pool-exhausted': "Too many connections to database '%s'",
+    'unknown-format': "Unknown output format '%s'",
+    'unknown-statement': "Unknown prepared statement %d",
+    'no-load': "No bulk load in progress",
+    'unknown-profile': "Unknown tuning profile '%s'",
+    'unknown-pragma': "PRAGMA '%s' cannot be tuned",
+    'invalid-pragma': "Invalid value for PRAGMA %s: '%s'",
+    'database-busy': "Database '%s' is busy (%d attempts)",
+    'unknown-cursor': "Unknown cursor '%s'",
+    'cursor-exists': "Cursor '%s' already exists",
+    'too-many-cursors': "Too many open cursors (%d)",
+    'cursor-not-select': "A cursor is declared for a SELECT statement",
+    'too-many-connections': "Too many connections, try again later",
+    'too-many-queries': "Too many queries running for user '%s' (%d)",
+    'statement-timeout': "Statement cancelled after %g sec",
+    'result-too-large': "Result larger than %d bytes, %d rows sent",
+    'database-in-use': "Database '%s' deleted, but its files are still in use and were kept",
+    'database-files': "Cannot remove the files of database '%s': %s",
+    'invalid-backup-name': "Invalid backup file name '%s'",
+    'unknown-backup': "No backup file named '%s'",
+    'backup-running': "A copy of database '%s' to or from '%s' is running"
 }
 
 SUCCESS = {
@@ -33,7 +220,20 @@ SUCCESS = {
     'database-created': "Database '%s' created",
     'database-changed': "Database changed",
     'user-added': "User '%s' added successfully",
-    'user-deleted': "User '%s' deleted successfully"
+    'user-deleted': "User '%s' deleted successfully",
+    'query-cancelled': "Query cancelled, %d rows sent",
+    'format-changed': "Output format set to '%s'",
+    'rows-loaded': "%d rows loaded (%.3f sec, %d rows/sec)",
+    'cache-disabled': "Result cache disabled",
+    'profile-changed': "Profiling %s",
+    'tuning-changed': "Tuning of database '%s' changed",
+    'cursor-declared': "Cursor '%s' declared",
+    'cursor-closed': "Cursor '%s' closed",
+    'cursor-fetched': "%d rows fetched (%.3f sec)",
+    'cursor-end': "End of cursor '%s'",
+    'database-backed-up': "Database '%s' backed up to '%s': %d pages (%.3f sec)",
+    'database-restored': "Database '%s' restored from '%s': %d pages (%.3f sec)",
+    'copy-cancelled': "Copy cancelled, %d of %d pages copied"
 }
 
 STATEMENTS = {
@@ -41,7 +241,26 @@ STATEMENTS = {
     'show-databases': r"^SHOW\s+?DATABASES\s*?;$",
     'drop-database': r"^DROP\s+?DATABASE\s+?(?P<dbname>\w+)\s*?;$",
     'use-database': r"USE\s+?(?P<dbname>\w+)(\s*?;)?$",
-    # The two below are not really SQL statements
+    # The ones below are not really SQL statements
     'add-user': r"ADD\s+?USER\s+?(?P<username>\w+)\s+?PASSWORD\s+?(?P<pass>\w+)\s*?;$",
-    'delete-user': r"DELETE\s+?USER\s+?(?P<username>\w+)\s*?;$"
+    'delete-user': r"DELETE\s+?USER\s+?(?P<username>\w+)\s*?;$",
+    'set-format': r"SET\s+?FORMAT\s+?(?P<format>\w+)\s*?;$",
+    'show-cache': r"^SHOW\s+?CACHE\s*?;$",
+    'show-status': r"^SHOW\s+?STATUS\s*?;$",
+    'profile': r"^PROFILE\s+?(?P<state>ON|OFF)\s*?;$",
+    'alter-database': r"^ALTER\s+?DATABASE\s+?(?P<dbname>\w+)\s+?SET\s+?(PROFILE\s+?(?P<profile>\w+)|(?P<pragma>\w+)\s*?=\s*?(?P<value>-?\w+))\s*?;$",
+    'show-tuning': r"^SHOW\s+?TUNING(\s+?(?P<dbname>\w+))?\s*?;$",
+    'declare-cursor': r"^DECLARE\s+?(?P<name>\w+)\s+?CURSOR\s+?FOR\s+?(?P<query>[\s\S]+?)\s*?;$",
+    'fetch-cursor': r"^FETCH\s+?(NEXT\s+?)?((?P<count>\d+)\s+?)?FROM\s+?(?P<name>\w+)\s*?;$",
+    'close-cursor': r"^CLOSE\s+?(?P<name>\w+)\s*?;$",
+    'show-cursors': r"^SHOW\s+?CURSORS\s*?;$",
+    'backup-database': r"^BACKUP\s+?DATABASE\s+?(?P<dbname>\w+)\s+?TO\s+?'(?P<name>[^']+)'\s*?;$",
+    'restore-database': r"^RESTORE\s+?DATABASE\s+?(?P<dbname>\w+)\s+?FROM\s+?'(?P<name>[^']+)'\s*?;$",
+    'show-backups': r"^SHOW\s+?BACKUPS\s*?;$"
+}
+
+# Statements run by the client itself
+CLIENT_STATEMENTS = {
+    'load-data': r"LOAD\s+?DATA\s+?'(?P<path>[^']+)'\s+?INTO\s+?TABLE\s+?(?P<table>\w+)(\s+?IGNORE\s+?(?P<skip>\d+)\s+?LINES)?\s*?;$",
+    'page': r"PAGE\s+?(?P<query>SELECT\b[\s\S]+?)\s*?;$"
 }
@@ -0,0 +1,373 @@
+"""Programmatic client API with pipelining.
+
+Unlike the interactive client, which waits for each reply before
+sending the next statement, a Connection sends requests as soon as
+they are submitted. Up to max_in_flight requests may wait for their
+reply at the same time; replies are matched to requests by id.
+
+    conn = Connection('127.0.0.1', 5100)
+    conn.connect()
+    conn.login('ludo', 'secret')
+    futures = [conn.query("INSERT INTO t VALUES (%d);" % i) for i in range(1000)]
+    results = [future.result() for future in futures]
+
+A login returns a session token (conn.token) which logs in again, after
+a reconnection, without the password: conn.login('ludo', token=token).
+
+AsyncConnection offers the same with asyncio.
+"""
+
+import asyncio
+import concurrent.futures
+import socket
+import sqlite3
+import threading
+
+import protocol
+import router
+from config import *
+
+
+class LoginError(Exception):
+    pass
+
+class QueryError(Exception):
+    pass
+
+
+class Result:
+    """Reply to a request: chunks of rows then a final frame."""
+    def __init__(self, request_id:int):
+        self.request_id = request_id
+        self.chunks = []
+        self.msg_type = None
+        self.status = None
+        self.payload = b''
+
+    @property
+    def ok(self) -> bool:
+        return self.status == STATUS_OK
+
+    @property
+    def message(self) -> str:
+        return bytes(self.payload).decode(encoding="utf-8")
+
+    def _add(self, frame) -> bool:
+        """Add a reply frame. Returns True once the result is complete."""
+        if frame.msg_type == MSG_ROWS:
+            self.chunks.append(frame.payload)
+            return False
+        self.msg_type = frame.msg_type
+        self.status = frame.status
+        self.payload = frame.payload
+        return True
+
+
+def statement_frame(entry:str) -> tuple:
+    """Returns the message type and payload to send for a line of SQL or
+    a custom statement."""
+    key, match = router.statements.match(entry)
+    if match is not None:
+        return MSG_STATEMENT, protocol.pack_fields(key, entry)
+    return MSG_QUERY, entry.encode("utf-8")
+
+def _login_request(username:str, password, token, compression) -> bytes:
+    return protocol.pack_fields(username, password or '',
+        ','.join(compression), token or '')
+
+def _login_reply(frame, compression_level:int) -> tuple:
+    """Check the reply to a login. Returns the compression of the frames
+    to send, or None, and the session token given by the server."""
+    if frame is None or frame.msg_type != MSG_LOGIN or \
+            frame.status != STATUS_OK:
+        # A server turning the connection away says why
+        message = frame is not None and frame.status == STATUS_DENIED and \
+            bytes(frame.payload).decode(encoding="utf-8")
+        raise LoginError(message or "Invalid username or password!")
+    fields = protocol.unpack_fields(frame.payload)
+    method = fields[0] if fields else ''
+    token = fields[1] if len(fields) > 1 else None
+    if not method:
+        return None, token
+    return protocol.Compression(method, compression_level), token
+
+def split_script(lines):
+    """Split lines of a SQL script into statements.
+
+    Custom statements such as 'USE db' need no final ';'.
+    """
+    buffer = ''
+    for line in lines:
+        if not buffer and (not line.strip() or line.lstrip().startswith('--')):
+            continue
+        buffer += line
+        statement = buffer.strip()
+        if sqlite3.complete_statement(statement) or \
+                router.statements.match(statement)[0] is not None:
+            yield statement
+            buffer = ''
+    if buffer.strip():
+        yield buffer.strip()
+
+
+class Connection:
+    def __init__(self, address:str, port:int, max_in_flight=PIPELINE_DEPTH,
+            compression=COMPRESSION_METHODS, compression_level=COMPRESSION_LEVEL):
+        self.address = address
+        self.port = port
+        self.compression = tuple(compression)
+        self.compression_level = compression_level
+        self._sock = None
+        self._channel = None
+        self._reader = None
+        self._send_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, max_in_flight))
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._request_id = 0
+        self._error = None
+        # Session token given at login
+        self.token = None
+
+    def connect(self):
+        self._sock = socket.create_connection((self.address, self.port))
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._channel = protocol.Channel(self._sock)
+
+    def login(self, username:str, password=None, token=None):
+        """Log in with a password or a session token, then start matching
+        replies to requests."""
+        self._channel.send(MSG_LOGIN, _login_request(username, password, token,
+            self.compression))
+        frame = self._channel.recv()
+        self._channel.compression, self.token = _login_reply(frame,
+            self.compression_level)
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+
+    def close(self):
+        if self._sock:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+        if self._reader is not None:
+            self._reader.join()
+            self._reader = None
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read_replies(self):
+        results = {}
+        try:
+            while True:
+                frame = self._channel.recv()
+                if frame is None:
+                    raise ConnectionError("Connection closed by the server")
+                result = results.get(frame.request_id)
+                if result is None:
+                    result = results[frame.request_id] = Result(frame.request_id)
+                if result._add(frame):
+                    del results[frame.request_id]
+                    with self._pending_lock:
+                        future = self._pending.pop(frame.request_id, None)
+                    if future is not None:
+                        self._slots.release()
+                        future.set_result(result)
+        except (OSError, protocol.ProtocolError) as e:
+            with self._pending_lock:
+                self._error = e
+                pending, self._pending = self._pending, {}
+            for future in pending.values():
+                self._slots.release()
+                future.set_exception(ConnectionError(str(e)))
+
+    def submit(self, frames:list) -> concurrent.futures.Future:
+        """Send the (msg_type, payload) frames of one request.
+
+        Blocks while max_in_flight requests wait for their reply. Returns
+        a future of the Result.
+        """
+        self._slots.acquire()
+        future = concurrent.futures.Future()
+        with self._send_lock:
+            self._request_id += 1
+            request_id = self._request_id
+            with self._pending_lock:
+                if self._error is not None:
+                    self._slots.release()
+                    raise ConnectionError(str(self._error))
+                self._pending[request_id] = future
+            try:
+                for msg_type, payload in frames:
+                    self._channel.send(msg_type, payload, request_id)
+            except:
+                # Whatever failed, sending or building the frames
+                with self._pending_lock:
+                    if self._pending.pop(request_id, None) is not None:
+                        self._slots.release()
+                raise
+        return future
+
+    def query(self, entry:str) -> concurrent.futures.Future:
+        """Send a SQL statement or a custom statement."""
+        return self.submit([statement_frame(entry)])
+
+    def prepare(self, sql:str) -> tuple:
+        """Returns the id and number of parameters of a prepared statement."""
+        result = self.submit([(MSG_PREPARE, sql.encode("utf-8"))]).result()
+        if result.msg_type != MSG_PREPARED:
+            raise QueryError(result.message.strip())
+        return protocol.PREPARED.unpack(result.payload)
+
+    def execute(self, statement_id:int, params=()) -> concurrent.futures.Future:
+        """Run a prepared statement."""
+        return self.submit([(MSG_EXECUTE,
+            protocol.pack_execute(statement_id, params))])
+
+    def load(self, sql:str, rows, commit_batch_size=0) -> concurrent.futures.Future:
+        """Bulk load rows with an INSERT statement (see bulk.py)."""
+        def frames():
+            yield MSG_LOAD, protocol.pack_fields(sql, commit_batch_size)
+            try:
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= LOAD_SEND_BATCH_SIZE:
+                        yield MSG_LOAD_ROWS, protocol.pack_rows(batch)
+                        batch = []
+                if batch:
+                    yield MSG_LOAD_ROWS, protocol.pack_rows(batch)
+            except Exception:
+                # The server only replies to the end of the load
+                yield MSG_LOAD_END, b''
+                raise
+            yield MSG_LOAD_END, b''
+        return self.submit(frames())
+
+    def run_script(self, lines):
+        """Run the statements of a script, pipelined.
+
+        Yields (statement, Result) in the order of the script.
+        """
+        in_flight = []
+        for statement in split_script(lines):
+            in_flight.append((statement, self.query(statement)))
+            # Yield what is already done without waiting
+            while in_flight and in_flight[0][1].done():
+                statement, future = in_flight.pop(0)
+                yield statement, future.result()
+        for statement, future in in_flight:
+            yield statement, future.result()
+
+
+class AsyncConnection:
+    """asyncio variant of Connection."""
+    def __init__(self, address:str, port:int, max_in_flight=PIPELINE_DEPTH,
+            compression=COMPRESSION_METHODS, compression_level=COMPRESSION_LEVEL):
+        self.address = address
+        self.port = port
+        self.compression = tuple(compression)
+        self.compression_level = compression_level
+        self._channel = None
+        self._reader_task = None
+        self._slots = asyncio.Semaphore(max(1, max_in_flight))
+        self._send_lock = asyncio.Lock()
+        self._pending = {}
+        self._request_id = 0
+        self._error = None
+        self.token = None
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection(self.address, self.port)
+        self._channel = protocol.AsyncChannel(reader, writer)
+
+    async def login(self, username:str, password=None, token=None):
+        await self._channel.send(MSG_LOGIN, _login_request(username, password,
+            token, self.compression))
+        frame = await self._channel.recv()
+        self._channel.compression, self.token = _login_reply(frame,
+            self.compression_level)
+        self._reader_task = asyncio.create_task(self._read_replies())
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        if self._channel is not None:
+            await self._channel.close()
+            self._channel = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _read_replies(self):
+        results = {}
+        try:
+            while True:
+                frame = await self._channel.recv()
+                if frame is None:
+                    raise ConnectionError("Connection closed by the server")
+                result = results.get(frame.request_id)
+                if result is None:
+                    result = results[frame.request_id] = Result(frame.request_id)
+                if result._add(frame):
+                    del results[frame.request_id]
+                    future = self._pending.pop(frame.request_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(result)
+        except (OSError, protocol.ProtocolError) as e:
+            self._error = e
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(str(e)))
+
+    async def submit(self, frames) -> Result:
+        """Send the (msg_type, payload) frames of one request and wait for
+        its Result. Many submit() may run concurrently."""
+        async with self._slots:
+            if self._error is not None:
+                raise ConnectionError(str(self._error))
+            future = asyncio.get_running_loop().create_future()
+            async with self._send_lock:
+                self._request_id += 1
+                request_id = self._request_id
+                self._pending[request_id] = future
+                try:
+                    for msg_type, payload in frames:
+                        await self._channel.send(msg_type, payload,
+                            request_id)
+                except:
+                    self._pending.pop(request_id, None)
+                    raise
+            return await future
+
+    async def query(self, entry:str) -> Result:
+        return await self.submit([statement_frame(entry)])
+
+    async def prepare(self, sql:str) -> tuple:
+        result = await self.submit([(MSG_PREPARE, sql.encode("utf-8"))])
+        if result.msg_type != MSG_PREPARED:
+            raise QueryError(result.message.strip())
+        return protocol.PREPARED.unpack(result.payload)
+
+    async def execute(self, statement_id:int, params=()) -> Result:
+        return await self.submit([(MSG_EXECUTE,
+            protocol.pack_execute(statement_id, params))])
@@ -0,0 +1,183 @@
+"""Server-side cursors.
+
+A client pages through a big result without running its query again
+with an OFFSET (which reads, then skips, all the rows before the page):
+
+    DECLARE recent CURSOR FOR SELECT * FROM tweets ORDER BY id DESC;
+    FETCH NEXT 100 FROM recent;
+    FETCH NEXT 100 FROM recent;
+    CLOSE recent;
+
+A cursor keeps its SELECT running on a connection of its own, opened
+outside of the pool of the database (so that cursors never use up the
+connections of the other statements), and each FETCH goes on reading
+where the last one stopped. Until it is closed the statement holds a
+read lock (or an old WAL snapshot), so a session keeps at most
+MAX_SESSION_CURSORS of them, and the ones unused for CURSOR_IDLE_TIMEOUT
+seconds are closed by the server. Cursors are closed with their session.
+"""
+
+import sqlite3
+import threading
+import time
+
+from config import *
+
+
+class ServerCursor:
+    def __init__(self, name:str, pool, sql:str):
+        """Run the SELECT on a connection of its own."""
+        self.name = name
+        self.sql = sql
+        self.nb_rows = 0
+        self.exhausted = False
+        self._pool = pool
+        self._conn = pool.connect()
+        self._lock = threading.Lock()
+        self._closed = False
+        try:
+            self._cursor = self._conn.execute(sql)
+        except sqlite3.Error:
+            self._conn.close()
+            raise
+        self.columns = [column[0] for column in self._cursor.description or ()]
+        self.last_used = time.monotonic()
+
+    @property
+    def dbname(self):
+        return self._pool.dbname
+
+    @property
+    def conn(self):
+        return self._conn
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def fetch(self, size:int) -> list:
+        """Returns up to size of the next rows."""
+        with self._lock:
+            if self._closed:
+                raise sqlite3.Error(ERROR['unknown-cursor'] % self.name)
+            rows = self._cursor.fetchmany(size) if not self.exhausted else []
+            self.nb_rows += len(rows)
+            if len(rows) < size:
+                self.exhausted = True
+            self.last_used = time.monotonic()
+            return rows
+
+    def close(self, blocking=True) -> bool:
+        """Close the connection. Returns False if the cursor is in use
+        and blocking is False."""
+        if not self._lock.acquire(blocking):
+            return False
+        try:
+            if not self._closed:
+                self._closed = True
+                self._cursor.close()
+                self._conn.close()
+        finally:
+            self._lock.release()
+        return True
+
+
+class CursorManager:
+    """Server-wide registry of the cursors of the sessions."""
+    def __init__(self, metrics, max_per_session=MAX_SESSION_CURSORS,
+            idle_timeout=CURSOR_IDLE_TIMEOUT):
+        self._metrics = metrics
+        self._max_per_session = max_per_session
+        self._idle_timeout = idle_timeout
+        # session -> {name: ServerCursor}
+        self._cursors = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def declare(self, session, name:str, pool, sql:str) -> ServerCursor:
+        self.reap()
+        with self._lock:
+            cursors = self._cursors.get(session, {})
+            if name in cursors:
+                raise sqlite3.Error(ERROR['cursor-exists'] % name)
+            if len(cursors) >= self._max_per_session:
+                raise sqlite3.Error(ERROR['too-many-cursors'] %
+                    self._max_per_session)
+        cursor = ServerCursor(name, pool, sql)
+        with self._lock:
+            self._cursors.setdefault(session, {})[name] = cursor
+        self._metrics.inc('cursors_declared')
+        return cursor
+
+    def get(self, session, name:str) -> ServerCursor:
+        with self._lock:
+            cursor = self._cursors.get(session, {}).get(name)
+        if cursor is None:
+            raise sqlite3.Error(ERROR['unknown-cursor'] % name)
+        return cursor
+
+    def session_cursors(self, session) -> list:
+        with self._lock:
+            return list(self._cursors.get(session, {}).values())
+
+    def _remove(self, session, name:str):
+        """Lock must be held."""
+        cursors = self._cursors.get(session)
+        if cursors is not None:
+            cursor = cursors.pop(name, None)
+            if not cursors:
+                del self._cursors[session]
+            return cursor
+        return None
+
+    def close(self, session, name:str):
+        with self._lock:
+            cursor = self._remove(session, name)
+        if cursor is None:
+            raise sqlite3.Error(ERROR['unknown-cursor'] % name)
+        cursor.close()
+
+    def close_session(self, session):
+        """Close the cursors of a session which ended."""
+        with self._lock:
+            cursors = self._cursors.pop(session, {})
+        for cursor in cursors.values():
+            cursor.close()
+
+    def close_database(self, dbname:str):
+        """Close the cursors reading a database, before it is dropped."""
+        with self._lock:
+            closed = [(session, name) for session, cursors in
+                self._cursors.items() for name, cursor in cursors.items()
+                if cursor.dbname == dbname]
+            closed = [self._remove(session, name) for session, name in closed]
+        for cursor in closed:
+            cursor.close()
+
+    def reap(self) -> int:
+        """Close the cursors unused for too long. Looks at most once per
+        SHUTDOWN_POLL_INTERVAL; returns the number of cursors closed."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep < SHUTDOWN_POLL_INTERVAL:
+                return 0
+            self._last_sweep = now
+            idle = [(session, name, cursor) for session, cursors in
+                self._cursors.items() for name, cursor in cursors.items()
+                if now - cursor.last_used > self._idle_timeout]
+        reaped = 0
+        for session, name, cursor in idle:
+            # A cursor being read is not idle
+            if cursor.close(blocking=False):
+                with self._lock:
+                    if self._cursors.get(session, {}).get(name) is cursor:
+                        self._remove(session, name)
+                reaped += 1
+        if reaped:
+            self._metrics.inc('cursors_reaped', reaped)
+        return reaped
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'open': sum(len(cursors) for cursors in
+                self._cursors.values()), 'sessions': len(self._cursors)}
@@ -0,0 +1,213 @@
+"""Result set encodings.
+
+A session sends the rows of a SELECT chunk by chunk, each chunk being
+encoded by the encoder matching the session output format:
+
+    -> text   : ASCII-art table (utils.StreamingTextTable)
+    -> csv    : comma-separated values, header in the first chunk
+    -> ndjson : one JSON object per row
+    -> binary : typed columnar chunks, see ColumnarEncoder
+
+Every encoder is built with the column names of the result.
+"""
+
+import array
+import base64
+import csv
+import io
+import json
+import struct
+import sys
+
+import utils
+from config import *
+
+# Column types of the binary encoding
+TYPE_NULL  = 0
+TYPE_INT   = 1
+TYPE_FLOAT = 2
+TYPE_TEXT  = 3
+TYPE_BLOB  = 4
+
+CHUNK_HEADER = struct.Struct('<IH')
+COLUMN_HEADER = struct.Struct('<HBB')
+
+_swap = sys.byteorder != 'little'
+
+
+class EncodingError(ValueError):
+    pass
+
+
+class TextEncoder:
+    name = 'text'
+
+    def __init__(self, columns:list):
+        self._table = utils.StreamingTextTable(TABLE_SAMPLE_SIZE)
+
+    def encode(self, rows:list) -> str:
+        return self._table.format(rows)
+
+
+class CSVEncoder:
+    name = 'csv'
+
+    def __init__(self, columns:list):
+        self._columns = columns
+
+    def encode(self, rows:list) -> str:
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        if self._columns is not None:
+            writer.writerow(self._columns)
+            self._columns = None
+        writer.writerows(rows)
+        return output.getvalue()
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError("Cannot encode %r" % type(value))
+
+class NDJSONEncoder:
+    name = 'ndjson'
+
+    def __init__(self, columns:list):
+        self._columns = columns
+        self._dumps = json.JSONEncoder(ensure_ascii=False,
+            separators=(',', ':'), default=_json_default).encode
+
+    def encode(self, rows:list) -> str:
+        columns = self._columns
+        dumps = self._dumps
+        return ''.join([dumps(dict(zip(columns, row))) + '\n' for row in rows])
+
+
+class ColumnarEncoder:
+    """Typed columnar binary encoding.
+
+    Each chunk holds:
+        nb_rows (uint32), nb_columns (uint16), then for every column
+        name length (uint16), type (uint8), has_nulls (uint8), name,
+        [one null flag byte per row if has_nulls], data.
+    Data of INT and FLOAT columns is a packed int64 / float64 array, data
+    of TEXT and BLOB columns is an uint32 array of lengths followed by
+    the values. All integers are little-endian. A column mixing types is
+    sent as TEXT.
+    """
+    name = 'binary'
+
+    def __init__(self, columns:list):
+        self._names = [str(column).encode("utf-8") for column in columns]
+
+    @staticmethod
+    def _column_type(values) -> int:
+        types = {type(value) for value in values if value is not None}
+        if not types:
+            return TYPE_NULL
+        if types == {int}:
+            return TYPE_INT
+        if types <= {int, float}:
+            return TYPE_FLOAT
+        if types == {bytes}:
+            return TYPE_BLOB
+        return TYPE_TEXT
+
+    @staticmethod
+    def _pack_numbers(typecode:str, values) -> bytes:
+        data = array.array(typecode, values)
+        if _swap:
+            data.byteswap()
+        return data.tobytes()
+
+    def encode(self, rows:list) -> bytes:
+        nb_rows = len(rows)
+        columns = list(zip(*rows)) if rows else [()] * len(self._names)
+        parts = [CHUNK_HEADER.pack(nb_rows, len(self._names))]
+        for name, values in zip(self._names, columns):
+            column_type = self._column_type(values)
+            has_nulls = column_type != TYPE_NULL and None in values
+            parts.append(COLUMN_HEADER.pack(len(name), column_type, has_nulls))
+            parts.append(name)
+            if has_nulls:
+                parts.append(bytes([value is None for value in values]))
+            if column_type == TYPE_INT:
+                parts.append(self._pack_numbers('q',
+                    [0 if value is None else value for value in values]))
+            elif column_type == TYPE_FLOAT:
+                parts.append(self._pack_numbers('d',
+                    [0.0 if value is None else value for value in values]))
+            elif column_type in (TYPE_TEXT, TYPE_BLOB):
+                if column_type == TYPE_TEXT:
+                    cells = [b'' if value is None else str(value).encode("utf-8")
+                        for value in values]
+                else:
+                    cells = [b'' if value is None else value for value in values]
+                parts.append(self._pack_numbers('I', map(len, cells)))
+                parts.append(b''.join(cells))
+        return b''.join(parts)
+
+
+def decode_columnar(payload) -> tuple:
+    """Decode a chunk of the binary encoding.
+
+    Returns the column names and the rows.
+    """
+    view = memoryview(payload)
+    try:
+        nb_rows, nb_columns = CHUNK_HEADER.unpack_from(view, 0)
+        offset = CHUNK_HEADER.size
+        names, columns = [], []
+        for i in range(nb_columns):
+            name_length, column_type, has_nulls = \
+                COLUMN_HEADER.unpack_from(view, offset)
+            offset += COLUMN_HEADER.size
+            names.append(str(view[offset:offset + name_length], "utf-8"))
+            offset += name_length
+            nulls = None
+            if has_nulls:
+                nulls = view[offset:offset + nb_rows]
+                offset += nb_rows
+            if column_type == TYPE_NULL:
+                values = [None] * nb_rows
+            elif column_type in (TYPE_INT, TYPE_FLOAT):
+                values = array.array('q' if column_type == TYPE_INT else 'd')
+                size = values.itemsize * nb_rows
+                values.frombytes(view[offset:offset + size])
+                if _swap:
+                    values.byteswap()
+                values = values.tolist()
+                offset += size
+            else:
+                lengths = array.array('I')
+                lengths.frombytes(view[offset:offset + 4 * nb_rows])
+                if _swap:
+                    lengths.byteswap()
+                offset += 4 * nb_rows
+                values = []
+                for length in lengths:
+                    value = bytes(view[offset:offset + length])
+                    offset += length
+                    values.append(value.decode("utf-8")
+                        if column_type == TYPE_TEXT else value)
+            if nulls is not None:
+                values = [None if null else value
+                    for value, null in zip(values, nulls)]
+            columns.append(values)
+    except (struct.error, ValueError) as e:
+        raise EncodingError("Invalid binary chunk: %s" % str(e))
+    if offset != len(view):
+        raise EncodingError("Invalid binary chunk: trailing data")
+    return names, list(zip(*columns)) if columns else []
+
+
+ENCODERS = {encoder.name: encoder for encoder in
+    (TextEncoder, CSVEncoder, NDJSONEncoder, ColumnarEncoder)}
+
+def create_encoder(name:str, columns:list):
+    """Returns an encoder for the given output format."""
+    try:
+        return ENCODERS[name](columns)
+    except KeyError:
+        raise EncodingError(ERROR['unknown-format'] % name)
@@ -0,0 +1,193 @@
+"""In-memory cache of the server metadata (fastdb_info.db).
+
+Users and databases are loaded once from SQLite. Readers only look at
+snapshots which are never modified once published, so they need no
+lock and never touch SQLite. Writers are serialized by a single lock:
+a change is written to SQLite first, then a new snapshot replaces the
+old one (write-through).
+
+Server processes sharing the same metadata (see FDB_Server --processes)
+share a generation counter too: writers increment it, and readers
+reload the snapshots when it is not the one they were loaded at.
+"""
+
+import hmac
+import sqlite3
+import threading
+
+import tuning
+from config import *
+
+# Columns added to the databases table since its creation
+DATABASE_COLUMNS = {
+    'profile': "VARCHAR(20) NOT NULL DEFAULT '%s'" % DEFAULT_TUNING_PROFILE,
+    'pragmas': "TEXT NOT NULL DEFAULT ''",
+}
+
+
+class MetadataCache:
+    def __init__(self, conn:sqlite3.Connection, tables:dict, generation=None,
+            on_reload=None):
+        """generation is a multiprocessing.Value shared with the other
+        processes, if any. on_reload(dbnames) is called after a reload
+        caused by them, with the databases removed or changed."""
+        self._conn = conn
+        self._tables = tables
+        self._shared_generation = generation
+        self._generation = None
+        self._on_reload = on_reload
+        self._write_lock = threading.Lock()
+        # Snapshots: username -> password hash, dbname -> id,
+        # dbname -> (tuning profile, PRAGMAs overridden)
+        self._users = {}
+        self._databases = {}
+        self._tuning = {}
+
+    def migrate(self):
+        """Add the columns missing from a databases table created by an
+        older version."""
+        with self._write_lock:
+            table = self._tables['databases']
+            columns = {row[1] for row in self._conn.execute(
+                "PRAGMA table_info(%s)" % table)}
+            if not columns:
+                return # Table not created yet
+            with self._conn:
+                for name, definition in DATABASE_COLUMNS.items():
+                    if name not in columns:
+                        self._conn.execute("ALTER TABLE %s ADD COLUMN %s %s"
+                            % (table, name, definition))
+
+    def load(self):
+        """(Re)build the snapshots from SQLite."""
+        with self._write_lock:
+            if self._shared_generation is not None:
+                # Read first: a change made meanwhile causes another load
+                self._generation = self._shared_generation.value
+            try:
+                users = self._conn.execute("SELECT username, password FROM %s"
+                    % self._tables['users']).fetchall()
+                databases = self._conn.execute("SELECT dbname, id, profile, "
+                    "pragmas FROM %s" % self._tables['databases']).fetchall()
+            except sqlite3.OperationalError:
+                # Tables not created yet
+                users, databases = [], []
+            self._users = dict(users)
+            self._databases = {row[0]: row[1] for row in databases}
+            self._tuning = {dbname: (profile, tuning.load_overrides(pragmas))
+                for dbname, dbid, profile, pragmas in databases}
+
+    def _changed(self):
+        """Tell the other processes the metadata changed. Write lock must
+        be held."""
+        if self._shared_generation is not None:
+            with self._shared_generation.get_lock():
+                self._shared_generation.value += 1
+
+    def _refresh(self):
+        """Reload the snapshots if another process changed the metadata."""
+        if self._shared_generation is None or \
+                self._shared_generation.value == self._generation:
+            return
+        databases, _tuning = self._databases, self._tuning
+        self.load()
+        if self._on_reload is not None:
+            self._on_reload({dbname for dbname in databases
+                if databases[dbname] != self._databases.get(dbname) or
+                _tuning.get(dbname) != self._tuning.get(dbname)})
+
+    # Readers
+
+    def check_user(self, username:str, password_hash:str) -> bool:
+        """Checks the password hash of the given user."""
+        self._refresh()
+        expected = self._users.get(username)
+        return expected is not None and password_hash is not None and \
+            hmac.compare_digest(expected, password_hash)
+
+    def password_hash(self, username:str):
+        """Returns the password hash of a user, None if there is no such
+        user."""
+        self._refresh()
+        return self._users.get(username)
+
+    def has_user(self, username:str) -> bool:
+        self._refresh()
+        return username in self._users
+
+    def has_database(self, dbname:str) -> bool:
+        self._refresh()
+        return dbname in self._databases
+
+    def databases(self) -> list:
+        """Returns (id, dbname) rows ordered by id."""
+        self._refresh()
+        databases = self._databases
+        return sorted(((dbid, dbname) for dbname, dbid in databases.items()))
+
+    def tuning(self, dbname:str) -> tuple:
+        """Returns the tuning profile of a database and the PRAGMAs it
+        overrides."""
+        self._refresh()
+        return self._tuning.get(dbname, (DEFAULT_TUNING_PROFILE, {}))
+
+    # Writers
+
+    def add_user(self, username:str, password_hash:str):
+        sql = "INSERT INTO %s (username, password) VALUES(?, ?)" % \
+            self._tables['users']
+        with self._write_lock:
+            with self._conn:
+                self._conn.execute(sql, (username, password_hash))
+            self._changed()
+            users = dict(self._users)
+            users[username] = password_hash
+            self._users = users
+
+    def delete_user(self, username:str):
+        sql = "DELETE FROM %s WHERE username = ?" % self._tables['users']
+        with self._write_lock:
+            with self._conn:
+                self._conn.execute(sql, (username,))
+            self._changed()
+            users = dict(self._users)
+            users.pop(username, None)
+            self._users = users
+
+    def add_database(self, dbname:str):
+        sql = "INSERT INTO %s(dbname) VALUES(?)" % self._tables['databases']
+        with self._write_lock:
+            with self._conn:
+                cursor = self._conn.execute(sql, (dbname,))
+            self._changed()
+            databases = dict(self._databases)
+            databases[dbname] = cursor.lastrowid
+            self._databases = databases
+            _tuning = dict(self._tuning)
+            _tuning[dbname] = (DEFAULT_TUNING_PROFILE, {})
+            self._tuning = _tuning
+
+    def delete_database(self, dbname:str):
+        sql = "DELETE FROM %s WHERE dbname = ?" % self._tables['databases']
+        with self._write_lock:
+            with self._conn:
+                self._conn.execute(sql, (dbname,))
+            self._changed()
+            databases = dict(self._databases)
+            databases.pop(dbname, None)
+            self._databases = databases
+            _tuning = dict(self._tuning)
+            _tuning.pop(dbname, None)
+            self._tuning = _tuning
+
+    def set_tuning(self, dbname:str, profile:str, overrides:dict):
+        sql = "UPDATE %s SET profile = ?, pragmas = ? WHERE dbname = ?" % \
+            self._tables['databases']
+        with self._write_lock:
+            with self._conn:
+                self._conn.execute(sql, (profile,
+                    tuning.dump_overrides(overrides), dbname))
+            self._changed()
+            _tuning = dict(self._tuning)
+            _tuning[dbname] = (profile, dict(overrides))
+            self._tuning = _tuning
@@ -0,0 +1,213 @@
+"""Server metrics.
+
+Counters (requests, bytes in and out...), gauges (active sessions, and
+values read from the result cache and the connection pools when asked)
+and latency histograms, all measured with time.perf_counter().
+
+They are shown by 'SHOW STATUS;' and, if the server is started with
+--metrics-port, served in the Prometheus text format on
+http://127.0.0.1:PORT/metrics.
+"""
+
+import bisect
+import http.server
+import threading
+import time
+
+from config import *
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Histograms of the server
+HISTOGRAMS = {
+    'query_execute': "Time spent by SQLite executing and fetching",
+    'query_render': "Time spent encoding rows",
+    'query_send': "Time spent sending replies",
+    'query_total': "Time to handle a request",
+    'login': "Time to check credentials",
+    'statement_routing': "Time to route a custom statement",
+    'write_wait': "Time a write waited in the write queue",
+    'write_commit': "Time to run and commit a group of writes",
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is for values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        """Lock must be held by the caller."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q:float) -> float:
+        """Estimate a quantile: upper bound of the bucket holding it."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Timer:
+    """Context manager adding the time spent in its block to a histogram."""
+    __slots__ = ('_metrics', '_name', '_start')
+
+    def __init__(self, metrics, name:str):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._metrics.observe(self._name, time.perf_counter() - self._start)
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        # name -> function returning a dict of values, read when asked
+        self._collectors = {}
+        self._histograms = {name: Histogram() for name in HISTOGRAMS}
+        self._start = time.perf_counter()
+
+    def inc(self, name:str, value=1):
+        """Add to a counter."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def add_gauge(self, name:str, value):
+        """Add to a gauge (may be negative)."""
+        with self._lock:
+            self._gauges[name] = self._gauges.get(name, 0) + value
+
+    def observe(self, name:str, seconds:float):
+        with self._lock:
+            self._histograms[name].observe(seconds)
+
+    def timer(self, name:str) -> Timer:
+        return Timer(self, name)
+
+    def add_collector(self, name:str, func):
+        """func() returns a dict of values, or None, when metrics are read."""
+        self._collectors[name] = func
+
+    def _collect(self) -> dict:
+        values = {}
+        for prefix, func in self._collectors.items():
+            for key, value in (func() or {}).items():
+                if isinstance(value, dict):
+                    for subkey, subvalue in value.items():
+                        values["%s_%s_%s" % (prefix, key, subkey)] = subvalue
+                else:
+                    values["%s_%s" % (prefix, key)] = value
+        return values
+
+    def snapshot(self) -> dict:
+        """Returns counters, gauges and (copies of) histograms."""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {}
+            for name, histogram in self._histograms.items():
+                copy = Histogram(histogram.buckets)
+                copy.counts = list(histogram.counts)
+                copy.sum, copy.count = histogram.sum, histogram.count
+                histograms[name] = copy
+        gauges['uptime_seconds'] = time.perf_counter() - self._start
+        gauges.update(self._collect())
+        return {'counters': counters, 'gauges': gauges,
+            'histograms': histograms}
+
+    def status_rows(self) -> list:
+        """Rows (name, value) shown by SHOW STATUS."""
+        snapshot = self.snapshot()
+        rows = sorted(snapshot['counters'].items())
+        rows += sorted((name, round(value, 3) if isinstance(value, float)
+            else value) for name, value in snapshot['gauges'].items())
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            rows.append((name + '_count', histogram.count))
+            if histogram.count:
+                rows.append((name + '_avg_ms',
+                    round(histogram.sum / histogram.count * 1000, 3)))
+                for q in (0.5, 0.95, 0.99):
+                    rows.append(("%s_p%d_ms" % (name, q * 100),
+                        round(histogram.quantile(q) * 1000, 3)))
+        return rows
+
+    def prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            name = METRICS_PREFIX + name
+            lines.append("# TYPE %s_total counter" % name)
+            lines.append("%s_total %s" % (name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            name = METRICS_PREFIX + name
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %s" % (name, value))
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            metric = METRICS_PREFIX + name + '_seconds'
+            lines.append("# HELP %s %s" % (metric, HISTOGRAMS[name]))
+            lines.append("# TYPE %s histogram" % metric)
+            cumulated = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulated += count
+                lines.append('%s_bucket{le="%s"} %d' % (metric, bound, cumulated))
+            lines.append('%s_bucket{le="+Inf"} %d' % (metric, histogram.count))
+            lines.append("%s_sum %s" % (metric, histogram.sum))
+            lines.append("%s_count %d" % (metric, histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """HTTP listener serving the metrics, from its own thread."""
+    daemon_threads = True
+
+    def __init__(self, metrics:Metrics, port:int, host=METRICS_HOST):
+        super().__init__((host, port), _MetricsHandler)
+        self.metrics = metrics
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+            name='fastdb-metrics', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
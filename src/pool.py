@@ -0,0 +1,249 @@
+"""SQLite connection pools.
+
+The server keeps one ConnectionPool per database file, shared by all
+sessions. Connections are opened in autocommit mode: a session borrows
+one for a single statement, or keeps it while a transaction it started
+with BEGIN is open.
+"""
+
+import sqlite3
+import threading
+import time
+
+from config import *
+
+
+class PoolClosedError(sqlite3.Error):
+    pass
+
+
+class PooledConnection(sqlite3.Connection):
+    """Connection able to carry per-connection server state."""
+    # Authorizer recording the tables used by statements (see cache.py)
+    recorder = None
+    # Database of the pool and its settings version (see retune())
+    dbname = None
+    generation = 0
+
+
+class ConnectionPool:
+    """Pool of connections to a single database file."""
+    def __init__(self, dbname:str, path:str, max_size=POOL_MAX_SIZE,
+            idle_timeout=POOL_IDLE_TIMEOUT, on_connect=None):
+        self._dbname = dbname
+        self._on_connect = on_connect
+        self._path = path
+        self._max_size = max(1, max_size)
+        self._idle_timeout = idle_timeout
+        # (connection, time it was released), most recently used last
+        self._idle = []
+        self._in_use = set()
+        self._closed = False
+        # Connections opened before the last retune() are not reused
+        self._generation = 0
+        self._cond = threading.Condition()
+        self._created = 0
+        self._reused = 0
+        self._evicted = 0
+
+    @property
+    def dbname(self):
+        return self._dbname
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a new connection to the database file."""
+        conn = sqlite3.connect(self._path, check_same_thread=False,
+            isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE,
+            factory=PooledConnection)
+        conn.dbname = self._dbname
+        conn.generation = self._generation
+        if self._on_connect is not None:
+            self._on_connect(conn)
+        self._created += 1
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _evict_idle(self, now:float):
+        """Close connections idle for too long. Lock must be held."""
+        kept = []
+        for conn, since in self._idle:
+            if now - since > self._idle_timeout:
+                self._discard(conn)
+                self._evicted += 1
+            else:
+                kept.append((conn, since))
+        self._idle = kept
+
+    def connect(self) -> sqlite3.Connection:
+        """Open a connection outside of the pool, not counted in its
+        max_size. The caller closes it."""
+        with self._cond:
+            if self._closed:
+                raise PoolClosedError(ERROR['unknown-database'] %
+                    self._dbname)
+            return self._connect()
+
+    def acquire(self, timeout=POOL_ACQUIRE_TIMEOUT) -> sqlite3.Connection:
+        """Borrow a connection, waiting at most timeout seconds."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolClosedError(ERROR['unknown-database'] %
+                        self._dbname)
+                now = time.monotonic()
+                self._evict_idle(now)
+                while self._idle:
+                    conn, since = self._idle.pop()
+                    if now - since > POOL_HEALTH_CHECK_INTERVAL and \
+                            not self._is_healthy(conn):
+                        self._discard(conn)
+                        continue
+                    self._reused += 1
+                    self._in_use.add(conn)
+                    return conn
+                if len(self._in_use) < self._max_size:
+                    conn = self._connect()
+                    self._in_use.add(conn)
+                    return conn
+                if now >= deadline or not self._cond.wait(deadline - now):
+                    raise sqlite3.OperationalError(
+                        ERROR['pool-exhausted'] % self._dbname)
+
+    def release(self, conn:sqlite3.Connection):
+        """Give back a borrowed connection."""
+        with self._cond:
+            self._in_use.discard(conn)
+            if conn.in_transaction:
+                # Never hand out a connection in the middle of a transaction
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    self._discard(conn)
+                    conn = None
+            if conn is not None:
+                if self._closed or conn.generation != self._generation:
+                    self._discard(conn)
+                else:
+                    self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def evict_idle(self):
+        with self._cond:
+            self._evict_idle(time.monotonic())
+
+    def retune(self):
+        """Close the idle connections, and the borrowed ones when they are
+        released: the next ones get the settings of on_connect again."""
+        with self._cond:
+            self._generation += 1
+            for conn, since in self._idle:
+                self._discard(conn)
+            self._idle.clear()
+
+    def drain(self, timeout=POOL_DRAIN_TIMEOUT) -> bool:
+        """Close the pool.
+
+        Idle connections are closed at once; borrowed ones are closed
+        when released. Waits at most timeout seconds for them and returns
+        True if every connection got closed.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._closed = True
+            for conn, since in self._idle:
+                self._discard(conn)
+            self._idle.clear()
+            self._cond.notify_all()
+            while self._in_use:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    return False
+            return True
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'created': self._created,
+                'reused': self._reused,
+                'evicted': self._evicted
+            }
+
+
+class PoolManager:
+    """Server-wide registry of connection pools, one per database."""
+    def __init__(self, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+            on_connect=None):
+        """on_connect(conn) is called on every new connection."""
+        self._on_connect = on_connect
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def get(self, dbname:str) -> ConnectionPool:
+        """Returns the pool of the given database, creating it if needed."""
+        with self._lock:
+            pool = self._pools.get(dbname)
+            if pool is None:
+                pool = ConnectionPool(dbname,
+                    DATABASES_DIR + dbname + DATABASE_EXT,
+                    self._max_size, self._idle_timeout, self._on_connect)
+                self._pools[dbname] = pool
+            sweep = time.monotonic() - self._last_sweep > self._idle_timeout
+            if sweep:
+                self._last_sweep = time.monotonic()
+                pools = list(self._pools.values())
+        if sweep:
+            # Pools nobody uses anymore still hold idle connections
+            for other in pools:
+                other.evict_idle()
+        return pool
+
+    def drain(self, dbname:str, timeout=POOL_DRAIN_TIMEOUT) -> bool:
+        """Close and forget the pool of the given database."""
+        with self._lock:
+            pool = self._pools.pop(dbname, None)
+        if pool is None:
+            return True
+        return pool.drain(timeout)
+
+    def retune(self, dbname:str):
+        """See ConnectionPool.retune()."""
+        with self._lock:
+            pool = self._pools.get(dbname)
+        if pool is not None:
+            pool.retune()
+
+    def close_all(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.drain(0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pools = dict(self._pools)
+        return {dbname: pool.stats() for dbname, pool in pools.items()}
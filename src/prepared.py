@@ -0,0 +1,115 @@
+"""Prepared statements of a client session.
+
+A client prepares a statement once (MSG_PREPARE) and gets an id back,
+then runs it with positional parameters (MSG_EXECUTE). Each session
+keeps its prepared statements in a LRU keyed by SQL text: preparing the
+same text again returns the same id.
+
+sqlite3 does not expose compiled statements, so the cache keeps the
+statement metadata while each pooled connection keeps the compiled
+statement in its own cache (see STATEMENT_CACHE_SIZE), keyed by the
+same SQL text.
+"""
+
+import collections
+import sqlite3
+import re
+
+from config import *
+
+# Statements streamed as result sets, prepared or not
+select_regex = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+_explain_regex = re.compile(r"^\s*EXPLAIN\b", re.IGNORECASE)
+# Literals, quoted identifiers and comments, in which a '?' is not a
+# parameter, then the parameters: ?, ?NNN, :name, @name and $name
+_parameters_regex = re.compile(r"""
+    '(?:[^']|'')*' | "(?:[^"]|"")*" | `[^`]*` | \[[^\]]*\]
+    | --[^\n]* | /\*.*?(?:\*/|$)
+    | (?P<number>\?\d*) | (?P<name>[:@$][A-Za-z_]\w*)
+""", re.VERBOSE | re.DOTALL)
+
+
+def is_select(sql:str) -> bool:
+    """Check if the SQL statement is a SELECT statement."""
+    return select_regex.search(sql) is not None
+
+
+class PreparedStatement:
+    def __init__(self, statement_id:int, sql:str, nb_params:int):
+        self.id = statement_id
+        self.sql = sql
+        self.nb_params = nb_params
+        self.is_select = is_select(sql)
+
+
+def parameters(sql:str) -> int:
+    """Returns the number of parameters of a statement, as SQLite numbers
+    them: the largest index, '?' taking the one after the largest so far
+    and a name the one after the largest when first seen."""
+    nb_params = 0
+    names = set()
+    for match in _parameters_regex.finditer(sql):
+        number, name = match.group('number', 'name')
+        if number == '?':
+            nb_params += 1
+        elif number is not None:
+            nb_params = max(nb_params, int(number[1:]))
+        elif name is not None and name not in names:
+            names.add(name)
+            nb_params += 1
+    return nb_params
+
+def count_parameters(conn:sqlite3.Connection, sql:str) -> int:
+    """Compile the statement without running it and returns its number
+    of parameters."""
+    nb_params = parameters(sql)
+    # EXPLAIN compiles the statement it explains, and does not run it
+    explain = sql if _explain_regex.match(sql) else "EXPLAIN " + sql
+    conn.execute(explain, [None] * nb_params).close()
+    return nb_params
+
+
+class StatementCache:
+    """LRU of prepared statements keyed by SQL text."""
+    def __init__(self, max_size=PREPARED_CACHE_SIZE):
+        self._max_size = max(1, max_size)
+        self._by_sql = collections.OrderedDict()
+        self._by_id = {}
+        self._next_id = 1
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._by_sql)
+
+    def lookup(self, sql:str):
+        """Returns the statement prepared for this text, if any."""
+        statement = self._by_sql.get(sql)
+        if statement is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._by_sql.move_to_end(sql)
+        return statement
+
+    def add(self, sql:str, nb_params:int) -> PreparedStatement:
+        statement = PreparedStatement(self._next_id, sql, nb_params)
+        self._next_id += 1
+        self._by_sql[sql] = statement
+        self._by_id[statement.id] = statement
+        if len(self._by_sql) > self._max_size:
+            sql, evicted = self._by_sql.popitem(last=False)
+            del self._by_id[evicted.id]
+        return statement
+
+    def get(self, statement_id:int) -> PreparedStatement:
+        """Returns the statement with the given id."""
+        statement = self._by_id.get(statement_id)
+        if statement is None:
+            raise sqlite3.Error(ERROR['unknown-statement'] % statement_id)
+        self._by_sql.move_to_end(statement.sql)
+        return statement
+
+    def stats(self) -> dict:
+        return {'size': len(self._by_sql), 'hits': self.hits,
+            'misses': self.misses}
@@ -0,0 +1,451 @@
+"""Client - server wire protocol.
+
+Every message is sent as a frame made of a fixed size header followed
+by a payload:
+
+    +----------+----------+-------+------------+--------+---------+
+    | length   | msg type | flags | request id | status | payload |
+    | 4 bytes  | 1 byte   | 1 byte| 4 bytes    | 1 byte | length  |
+    +----------+----------+-------+------------+--------+---------+
+
+All integers are unsigned and in network byte order. The flags tell
+whether the payload is compressed (FLAG_ZLIB, FLAG_LZMA); the length is
+the one of the payload as sent. Payloads holding
+several strings (login, custom statements) are packed with pack_fields(),
+statement parameters with pack_values() and bulk load rows with
+pack_rows().
+"""
+
+import asyncio
+import collections
+import lzma
+import socket
+import struct
+import threading
+import zlib
+
+from config import *
+
+HEADER = struct.Struct('!IBBIB')
+FIELD_LENGTH = struct.Struct('!I')
+VALUES_COUNT = struct.Struct('!H')
+ROWS_COUNT = struct.Struct('!I')
+INT_VALUE = struct.Struct('!q')
+FLOAT_VALUE = struct.Struct('!d')
+STATEMENT_ID = struct.Struct('!I')
+PREPARED = struct.Struct('!IH')
+
+# Tags of the values packed by pack_values()
+VALUE_NULL  = 0
+VALUE_INT   = 1
+VALUE_FLOAT = 2
+VALUE_TEXT  = 3
+VALUE_BLOB  = 4
+
+# Frame flags
+FLAG_ZLIB = 0x01
+FLAG_LZMA = 0x02
+COMPRESSION_FLAGS = {'zlib': FLAG_ZLIB, 'lzma': FLAG_LZMA}
+
+# Scatter-gather sends, not on every platform
+_sendmsg = hasattr(socket.socket, 'sendmsg')
+
+Frame = collections.namedtuple('Frame',
+    ['msg_type', 'flags', 'request_id', 'status', 'payload'])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def decode_text(data) -> str:
+    """Decode UTF-8 text received from the peer."""
+    try:
+        return str(data, encoding="utf-8")
+    except UnicodeDecodeError:
+        raise ProtocolError("Invalid UTF-8 text")
+
+def pack_fields(*fields) -> bytes:
+    """Pack strings into a single payload, each one length-prefixed."""
+    parts = []
+    for field in fields:
+        data = field if isinstance(field, bytes) else str(field).encode("utf-8")
+        parts.append(FIELD_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+def unpack_fields(payload) -> list:
+    """Unpack a payload built with pack_fields()."""
+    fields = []
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        if offset + FIELD_LENGTH.size > len(view):
+            raise ProtocolError("Truncated field header")
+        size, = FIELD_LENGTH.unpack_from(view, offset)
+        offset += FIELD_LENGTH.size
+        if offset + size > len(view):
+            raise ProtocolError("Truncated field")
+        fields.append(decode_text(view[offset:offset + size]))
+        offset += size
+    return fields
+
+def pack_values(values) -> bytes:
+    """Pack typed values (None, int, float, str, bytes)."""
+    parts = [VALUES_COUNT.pack(len(values))]
+    for value in values:
+        if value is None:
+            parts.append(bytes([VALUE_NULL]))
+        elif isinstance(value, int):
+            parts.append(bytes([VALUE_INT]))
+            try:
+                parts.append(INT_VALUE.pack(value))
+            except struct.error:
+                raise ProtocolError("Integer out of range: %d" % value)
+        elif isinstance(value, float):
+            parts.append(bytes([VALUE_FLOAT]))
+            parts.append(FLOAT_VALUE.pack(value))
+        elif isinstance(value, (str, bytes, bytearray, memoryview)):
+            if isinstance(value, str):
+                tag, value = VALUE_TEXT, value.encode("utf-8")
+            else:
+                tag = VALUE_BLOB
+            parts.append(bytes([tag]))
+            parts.append(FIELD_LENGTH.pack(len(value)))
+            parts.append(bytes(value))
+        else:
+            raise ProtocolError("Unsupported value type: %s" %
+                type(value).__name__)
+    return b''.join(parts)
+
+def unpack_values(payload, offset=0) -> list:
+    """Unpack values packed with pack_values(), starting at offset."""
+    return _unpack_values_from(memoryview(payload), offset)[0]
+
+def _unpack_values_from(view, offset:int) -> tuple:
+    """Returns the values found at offset and the offset that follows."""
+    values = []
+    try:
+        count, = VALUES_COUNT.unpack_from(view, offset)
+        offset += VALUES_COUNT.size
+        for i in range(count):
+            tag = view[offset]
+            offset += 1
+            if tag == VALUE_NULL:
+                values.append(None)
+            elif tag == VALUE_INT:
+                values.append(INT_VALUE.unpack_from(view, offset)[0])
+                offset += INT_VALUE.size
+            elif tag == VALUE_FLOAT:
+                values.append(FLOAT_VALUE.unpack_from(view, offset)[0])
+                offset += FLOAT_VALUE.size
+            elif tag in (VALUE_TEXT, VALUE_BLOB):
+                size, = FIELD_LENGTH.unpack_from(view, offset)
+                offset += FIELD_LENGTH.size
+                if offset + size > len(view):
+                    raise ProtocolError("Truncated value")
+                data = bytes(view[offset:offset + size])
+                offset += size
+                values.append(data.decode("utf-8") if tag == VALUE_TEXT
+                    else data)
+            else:
+                raise ProtocolError("Unknown value tag %d" % tag)
+    except (struct.error, IndexError):
+        raise ProtocolError("Truncated values")
+    except UnicodeDecodeError:
+        raise ProtocolError("Invalid text value")
+    return values, offset
+
+def pack_rows(rows) -> bytes:
+    """Pack a list of rows, each one being a sequence of values."""
+    parts = [ROWS_COUNT.pack(len(rows))]
+    parts.extend([pack_values(row) for row in rows])
+    return b''.join(parts)
+
+def unpack_rows(payload) -> list:
+    """Unpack rows packed with pack_rows()."""
+    view = memoryview(payload)
+    if len(view) < ROWS_COUNT.size:
+        raise ProtocolError("Truncated rows")
+    count, = ROWS_COUNT.unpack_from(view)
+    offset = ROWS_COUNT.size
+    rows = []
+    for i in range(count):
+        values, offset = _unpack_values_from(view, offset)
+        rows.append(values)
+    if offset != len(view):
+        raise ProtocolError("Trailing data after rows")
+    return rows
+
+def pack_execute(statement_id:int, params) -> bytes:
+    """Payload of a MSG_EXECUTE frame."""
+    return STATEMENT_ID.pack(statement_id) + pack_values(params)
+
+def unpack_execute(payload) -> tuple:
+    """Returns the statement id and the parameters of a MSG_EXECUTE frame."""
+    if len(payload) < STATEMENT_ID.size:
+        raise ProtocolError("Truncated statement id")
+    statement_id, = STATEMENT_ID.unpack_from(payload)
+    return statement_id, unpack_values(payload, STATEMENT_ID.size)
+
+
+class Compression:
+    """Compression of the payloads sent over a channel.
+
+    Payloads smaller than threshold, or which do not get smaller, are
+    sent as they are.
+    """
+    def __init__(self, method:str, level=COMPRESSION_LEVEL,
+            threshold=COMPRESSION_THRESHOLD):
+        if method not in COMPRESSION_FLAGS:
+            raise ProtocolError("Unknown compression method: %s" % method)
+        self.method = method
+        self.level = min(max(level, 0), 9)
+        self.threshold = threshold
+
+    def compress(self, payload) -> tuple:
+        """Returns the flags and the payload to send."""
+        if len(payload) < self.threshold:
+            return 0, payload
+        if self.method == 'zlib':
+            compressed = zlib.compress(payload, self.level)
+        else:
+            compressed = lzma.compress(payload, preset=self.level)
+        if len(compressed) >= len(payload):
+            return 0, payload
+        return COMPRESSION_FLAGS[self.method], compressed
+
+def decompress(flags:int, payload):
+    """Returns the payload of a frame as it was before compression."""
+    if flags & FLAG_ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(payload, MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise ProtocolError("Invalid compressed payload: %s" % e)
+        done = decompressor.eof and not decompressor.unconsumed_tail
+    elif flags & FLAG_LZMA:
+        decompressor = lzma.LZMADecompressor()
+        try:
+            data = decompressor.decompress(payload, MAX_FRAME_SIZE)
+        except lzma.LZMAError as e:
+            raise ProtocolError("Invalid compressed payload: %s" % e)
+        done = decompressor.eof
+    else:
+        return payload
+    if not done:
+        raise ProtocolError("Compressed payload too large or truncated")
+    return data
+
+
+class BufferPool:
+    """Receive buffers of RECV_BUFFER_SIZE bytes, reused by the channels
+    instead of allocating one per connection."""
+    def __init__(self, size=RECV_BUFFER_SIZE, max_buffers=RECV_BUFFER_POOL_SIZE):
+        self.size = size
+        self._max_buffers = max_buffers
+        self._buffers = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        with self._lock:
+            if self._buffers:
+                return self._buffers.pop()
+        return bytearray(self.size)
+
+    def release(self, buffer:bytearray):
+        with self._lock:
+            if len(self._buffers) < self._max_buffers:
+                self._buffers.append(buffer)
+
+buffers = BufferPool()
+
+
+def choose_compression(offered:str, supported=COMPRESSION_METHODS) -> str:
+    """Returns the first method offered (comma separated) which is
+    supported, or an empty string."""
+    for method in offered.split(','):
+        method = method.strip().lower()
+        if method in supported and method in COMPRESSION_FLAGS:
+            return method
+    return ''
+
+
+class Channel:
+    """Send and receive frames over a connected socket.
+
+    Bytes are received into a buffer of the pool, so one system call
+    often reads several frames; large payloads are read straight into
+    their own buffer. Large frames are sent without joining their header
+    and payload (sendmsg()).
+    """
+    def __init__(self, sock, pool=buffers):
+        self._sock = sock
+        self._pool = pool
+        self._buffer = pool.acquire()
+        self._view = memoryview(self._buffer)
+        # Received bytes not read yet: self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = 0
+        # Compression of the frames sent, set once negotiated
+        self.compression = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def socket(self):
+        return self._sock
+
+    @property
+    def buffered(self) -> bool:
+        """True if bytes were received but not read yet."""
+        return self._end > self._start
+
+    def close(self):
+        """Give the receive buffer back to the pool. The socket is left
+        open."""
+        if self._buffer is not None:
+            self._view.release()
+            self._pool.release(self._buffer)
+            self._buffer = self._view = None
+
+    def send(self, msg_type:int, payload=b'', request_id=0, status=STATUS_OK):
+        """Send one frame."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        flags = 0
+        if self.compression is not None:
+            flags, payload = self.compression.compress(payload)
+        header = HEADER.pack(len(payload), msg_type, flags, request_id, status)
+        self.bytes_sent += len(header) + len(payload)
+        if len(payload) < RECV_BUFFER_SIZE:
+            self._sock.sendall(header + payload)
+        elif _sendmsg:
+            # Avoid copying big payloads only to prepend the header
+            sent = self._sock.sendmsg([header, payload])
+            if sent < len(header):
+                self._sock.sendall(header[sent:])
+                sent = len(header)
+            if sent - len(header) < len(payload):
+                with memoryview(payload) as view:
+                    self._sock.sendall(view[sent - len(header):])
+        else:
+            self._sock.sendall(header)
+            self._sock.sendall(payload)
+
+    def recv(self):
+        """Receive one frame. Returns None if the peer closed the socket."""
+        if not self._fill(HEADER.size):
+            return None
+        length, msg_type, flags, request_id, status = \
+            HEADER.unpack_from(self._buffer, self._start)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError("Frame too large (%d bytes)" % length)
+        self._start += HEADER.size
+        # Payloads of more than a quarter of the buffer are received
+        # straight into their own buffer, not copied from this one
+        if length <= self._end - self._start or \
+                length < len(self._buffer) // 4:
+            if not self._fill(length):
+                raise ProtocolError("Connection closed in the middle of a frame")
+            payload = bytes(self._view[self._start:self._start + length])
+            self._start += length
+        else:
+            # Bytes already received, then the rest straight in the payload
+            payload = bytearray(length)
+            buffered = self._end - self._start
+            payload[:buffered] = self._view[self._start:self._end]
+            self._start = self._end = 0
+            with memoryview(payload) as view:
+                self._recv_into(view[buffered:])
+        self.bytes_received += HEADER.size + length
+        if flags:
+            payload = decompress(flags, payload)
+        return Frame(msg_type, flags, request_id, status, payload)
+
+    def _fill(self, size:int) -> bool:
+        """Receive until size bytes are buffered. Returns False on a clean
+        EOF, before any byte of a frame."""
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buffer) - self._start < size:
+            # Move the start of the frame to the front of the buffer
+            remaining = bytes(self._view[self._start:self._end])
+            self._end = len(remaining)
+            self._start = 0
+            self._buffer[:self._end] = remaining
+        while self._end - self._start < size:
+            received = self._sock.recv_into(self._view[self._end:])
+            if received == 0:
+                if self._end == self._start:
+                    return False
+                raise ProtocolError("Connection closed in the middle of a frame")
+            self._end += received
+        return True
+
+    def _recv_into(self, view):
+        """Fill the whole view."""
+        received = 0
+        total = len(view)
+        while received < total:
+            size = self._sock.recv_into(view[received:])
+            if size == 0:
+                raise ProtocolError("Connection closed in the middle of a frame")
+            received += size
+
+
+class AsyncChannel:
+    """Send and receive frames over asyncio streams."""
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        # Compression of the frames sent, set once negotiated
+        self.compression = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    async def send(self, msg_type:int, payload=b'', request_id=0,
+            status=STATUS_OK):
+        """Send one frame."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        flags = 0
+        if self.compression is not None:
+            flags, payload = self.compression.compress(payload)
+        self.bytes_sent += HEADER.size + len(payload)
+        header = HEADER.pack(len(payload), msg_type, flags, request_id, status)
+        if len(payload) < RECV_BUFFER_SIZE:
+            # One segment for small frames
+            self._writer.write(header + payload)
+        else:
+            self._writer.write(header)
+            self._writer.write(payload)
+        await self._writer.drain()
+
+    async def recv(self):
+        """Receive one frame. Returns None if the peer closed the socket."""
+        try:
+            header = await self._reader.readexactly(HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise ProtocolError("Connection closed in the middle of a frame")
+            return None
+        length, msg_type, flags, request_id, status = HEADER.unpack(header)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError("Frame too large (%d bytes)" % length)
+        try:
+            payload = await self._reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise ProtocolError("Connection closed in the middle of a frame")
+        self.bytes_received += HEADER.size + length
+        if flags:
+            payload = decompress(flags, payload)
+        return Frame(msg_type, flags, request_id, status, payload)
+
+    async def close(self):
+        """Close the underlying stream."""
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
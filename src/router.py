@@ -0,0 +1,74 @@
+"""Statement router.
+
+Finds which custom statement (config.STATEMENTS) a line is. Patterns are
+compiled once, and indexed in a trie by the keywords they start with
+("CREATE" -> "DATABASE" -> 'create-database'). Routing a line walks the
+trie with its first words, then tries only the patterns found there:
+plain SQL lines usually stop at the first word.
+"""
+
+import re
+
+from config import *
+
+_FLAGS = re.IGNORECASE | re.VERBOSE
+# Keywords a pattern starts with, as in r"^SHOW\s+?DATABASES..."
+_keyword_regex = re.compile(r"([A-Z]+)(?:\\s[+*]\??|$)")
+# Keywords considered in a line
+_DEPTH = 2
+
+
+def _leading_keywords(pattern:str) -> list:
+    keywords = []
+    position = 1 if pattern.startswith('^') else 0
+    while len(keywords) < _DEPTH:
+        match = _keyword_regex.match(pattern, position)
+        if match is None:
+            break
+        keywords.append(match.group(1))
+        position = match.end()
+    return keywords
+
+
+class StatementRouter:
+    def __init__(self, statements:dict):
+        self._patterns = {key: re.compile(pattern, _FLAGS)
+            for key, pattern in statements.items()}
+        # Trie node: (children by keyword, keys of the patterns ending here)
+        self._root = ({}, [])
+        for key, pattern in statements.items():
+            node = self._root
+            for keyword in _leading_keywords(pattern):
+                node = node[0].setdefault(keyword, ({}, []))
+            node[1].append(key)
+
+    def _candidates(self, entry:str) -> list:
+        node = self._root
+        candidates = node[1]
+        for word in entry.split(None, _DEPTH)[:_DEPTH]:
+            node = node[0].get(word.rstrip(';').upper())
+            if node is None:
+                break
+            candidates = candidates + node[1] if candidates else node[1]
+        return candidates
+
+    def match(self, entry:str) -> tuple:
+        """Returns the key of the statement matching the whole entry and
+        the match object, or (None, None)."""
+        for key in self._candidates(entry):
+            match = self._patterns[key].fullmatch(entry)
+            if match is not None:
+                return key, match
+        return None, None
+
+    def match_key(self, key:str, entry:str):
+        """Match the entry against the statement of the given key.
+
+        Returns the match object or None.
+        """
+        pattern = self._patterns.get(key)
+        return pattern.fullmatch(entry) if pattern is not None else None
+
+
+statements = StatementRouter(STATEMENTS)
+client_statements = StatementRouter(CLIENT_STATEMENTS)
@@ -7,18 +7,113 @@ import sqlite3
 import socket 
 import datetime 
 import time 
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import multiprocessing.connection
+import os
+import select
+import threading
 
 import utils
-from session import ClientSession 
+import tuning
+import protocol
+from auth import Authenticator
+from admission import ConnectionGate, QuerySlots
+from pool import PoolManager
+from writes import WriteManager
+from cursors import CursorManager
+from backup import BackupManager
+from metadata import MetadataCache, DATABASE_COLUMNS
+from cache import ResultCache
+from metrics import Metrics, MetricsServer
+from slowlog import SlowQueryLog
+from session import ClientSession, AsyncClientSession
 from config import *
 
+# Every process of a multi-process server listens on its own socket
+_REUSEPORT = hasattr(socket, 'SO_REUSEPORT')
+
 class FDB_Server:
-    def __init__(self, host:str, port:int):
+    def __init__(self, host:str, port:int, mode=DEFAULT_SERVER_MODE,
+            workers=ASYNC_WORKERS, batch_size=FETCH_BATCH_SIZE,
+            result_cache_size=RESULT_CACHE_SIZE, compression=COMPRESSION_METHODS,
+            compression_level=COMPRESSION_LEVEL, metrics_port=METRICS_PORT,
+            slow_query_time=SLOW_QUERY_TIME, slow_query_log=SLOW_QUERY_LOG_FILE,
+            log_format=DEFAULT_LOG_FORMAT, group_commit=WRITE_GROUP_SIZE,
+            processes=1, max_connections=MAX_CONNECTIONS,
+            max_user_queries=MAX_USER_QUERIES,
+            statement_timeout=STATEMENT_TIMEOUT,
+            max_result_size=MAX_RESULT_SIZE):
+        if mode not in SERVER_MODES:
+            raise ValueError("Invalid mode. Expected %s, got %s" %
+                (str(SERVER_MODES), str(mode)))
+        if processes > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            raise ValueError("Several processes need os.fork()")
         self._host = host 
         self._port = port 
+        self._mode = mode
+        self._workers = workers
+        self._batch_size = max(1, batch_size)
+        self._compression = tuple(compression)
+        self._compression_level = compression_level
         self._db_conn = None
+        self._metadata = None
+        self._auth = None
+        # Signs the session tokens, the same in every process
+        self._token_secret = os.urandom(32)
+        self._processes = max(1, processes)
+        # Number of this process in a multi-process server
+        self._worker = None
+        # Metadata generation shared by the processes
+        self._generation = None
+        self._result_cache = None
+        # Each process would only see its own writes: no result cache
+        # with several processes
+        if result_cache_size > 0 and self._processes == 1:
+            self._result_cache = ResultCache(result_cache_size)
+        self._pools = PoolManager(on_connect=self._setup_connection)
+        self._metrics = Metrics()
+        self._metrics.add_collector('pool', self._pools.stats)
+        # Writes go through a queue per database, unless group_commit is 0
+        self._writes = None
+        if group_commit > 0:
+            self._writes = WriteManager(self._metrics, group_commit)
+            self._metrics.add_collector('writes', self._writes.stats)
+        self._cursors = CursorManager(self._metrics)
+        self._backups = BackupManager(self._metrics)
+        # Admission control and limits (see admission.py)
+        self._gate = ConnectionGate(max_connections)
+        self._queries = QuerySlots(max_user_queries)
+        self._statement_timeout = statement_timeout
+        self._max_result_size = max_result_size
+        self._metrics.add_collector('admission', self._gate.stats)
+        self._metrics.add_collector('user_queries', self._queries.stats)
+        self._metrics.add_collector('cursors', self._cursors.stats)
+        self._metrics.add_collector('backups', self._backups.stats)
+        if self._result_cache is not None:
+            self._metrics.add_collector('cache', self._result_cache.stats)
+        self._metrics.add_collector('auth',
+            lambda: self._auth.stats() if self._auth else None)
+        self._metrics.add_collector('log',
+            lambda: {'dropped': self._logger.dropped})
+        self._metrics_port = metrics_port
+        self._metrics_server = None
+        self._slow_log = None
+        if slow_query_time is not None:
+            self._slow_log = SlowQueryLog(slow_query_time, slow_query_log,
+                log_format)
+            self._metrics.add_collector('slow_log',
+                lambda: {'dropped': self._slow_log.dropped})
         self._socket = None 
-        self._logger = utils.Logger(LOG_FILE) 
+        # Set once clients can connect
+        self._ready = threading.Event()
+        # Set by shutdown(), and the event stopping the 'async' mode
+        self._stopping = threading.Event()
+        self._loop = None
+        self._stop_serving = None
+        self._logger = utils.Logger(LOG_FILE, log_format=log_format)
         self._nb_clients = 0
         self.tables = {'users': 'users', 'databases': 'databases'}
         self._info_dbname = 'fastdb_info'
@@ -31,6 +126,40 @@ class FDB_Server:
     def port(self):
         return self._port 
 
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def processes(self):
+        return self._processes
+
+    @property
+    def ready(self):
+        """Event set once clients can connect."""
+        return self._ready
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def slow_log(self):
+        return self._slow_log
+
+    @property
+    def compression(self):
+        """Compression methods accepted from clients."""
+        return self._compression
+
+    @property
+    def compression_level(self):
+        return self._compression_level
+
     @property
     def logger(self):
         return self._logger
@@ -43,59 +172,107 @@ class FDB_Server:
     def db_conn(self):
         return self._db_conn 
 
+    @property
+    def pools(self):
+        return self._pools
+
+    @property
+    def writes(self):
+        return self._writes
+
+    @property
+    def cursors(self):
+        return self._cursors
+
+    @property
+    def backups(self):
+        return self._backups
+
+    @property
+    def queries(self):
+        return self._queries
+
+    @property
+    def statement_timeout(self):
+        return self._statement_timeout
+
+    @property
+    def max_result_size(self):
+        return self._max_result_size
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @property
+    def result_cache(self):
+        return self._result_cache
+
+    def _setup_connection(self, conn):
+        """Called by the pools on every new connection."""
+        tuning.apply(conn, self.database_pragmas(conn.dbname))
+        if self._result_cache is not None:
+            self._result_cache.install(conn)
+
+    def database_tuning(self, dbname:str) -> tuple:
+        """Returns the tuning profile of a database and the PRAGMAs it
+        overrides."""
+        if self._metadata:
+            return self._metadata.tuning(dbname)
+        return DEFAULT_TUNING_PROFILE, {}
+
+    def database_pragmas(self, dbname:str) -> dict:
+        """PRAGMAs applied to the connections to a database."""
+        return tuning.pragmas(*self.database_tuning(dbname))
+
+    def set_database_tuning(self, dbname:str, profile:str, overrides:dict):
+        """Store the tuning of a database. Connections opened from now on
+        use it; the ones in use are closed when given back."""
+        self._metadata.set_tuning(dbname, profile, overrides)
+        self._pools.retune(dbname)
+        if dbname == self._info_dbname:
+            tuning.apply(self._db_conn, self.database_pragmas(dbname))
+
     def is_user_exist(self, username:str, password:str) -> bool:
         """Checks if the given username is allowed to connect server."""
-        if self._db_conn:
-            with self._db_conn:
-                cursor = self._db_conn.cursor()
-                cursor.execute("""SELECT * FROM %s WHERE username=? AND
-                    password=?""" % self.tables['users'], 
-                    (username, utils.hash_password('sha512', password)))
-                return cursor.fetchone() is not None 
+        if self._auth:
+            return self._auth.check_password(username, password)
         return False
 
+    def check_token(self, username:str, token:str) -> bool:
+        """Checks a session token sent instead of a password."""
+        if self._auth:
+            return self._auth.check_token(username, token)
+        return False
+
+    def issue_token(self, username:str) -> str:
+        return self._auth.issue_token(username)
+
     def is_database_exist(self, dbname:str) -> bool:
         """Checks if the given database name exists."""
-        if self._db_conn:
-            with self._db_conn:
-                cursor = self._db_conn.cursor()
-                cursor.execute('SELECT dbname FROM %s WHERE dbname=?' % \
-                    self.tables['databases'], (dbname,))
-                return cursor.fetchone() is not None 
+        if self._metadata:
+            return self._metadata.has_database(dbname)
         return False 
 
     def insert_new_user(self, username:str, password:str):
-        sql = "INSERT INTO %s (username, password) VALUES(?, ?)" % \
-            self.tables['users']
-        with self.db_conn:
-            password = utils.hash_password('sha512', password)
-            self.db_conn.execute(sql, (username, password))
-            self.db_conn.commit()
+        self._metadata.add_user(username,
+            utils.hash_password('sha512', password))
 
     def delete_user(self, username:str):
-        sql = "DELETE FROM %s WHERE username = ?" % self.tables['users']
-        with self.db_conn:
-            self.db_conn.execute(sql, (username,))
-            self.db_conn.commit()
+        self._metadata.delete_user(username)
+        self._auth.forget(username)
 
     def insert_new_database(self, dbname:str):
-        sql = "INSERT INTO %s(dbname) VALUES(?)" % self.tables['databases']
-        with self.db_conn:
-            self.db_conn.execute(sql, (dbname,))
-            self.db_conn.commit()
+        self._metadata.add_database(dbname)
 
     def delete_database_entry(self, dbname:str):
-        sql = "DELETE FROM %s WHERE dbname = ?" % self.tables['databases']
-        with self.db_conn:
-            self.db_conn.execute(sql, (dbname,))
-            self.db_conn.commit() 
+        self._metadata.delete_database(dbname)
 
     def select_databases(self) -> list:
         """Select all databases entries."""
         results = []
-        if self.db_conn:
-            sql = "SELECT * FROM %s" % self.tables['databases']
-            results = self.db_conn.execute(sql).fetchall()
+        if self._metadata:
+            results = self._metadata.databases()
         return results 
 
     def create_tables(self):
@@ -113,26 +290,52 @@ class FDB_Server:
                 """
                 CREATE TABLE %s (
                     `id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-                    `dbname` VARCHAR(50) NOT NULL UNIQUE
-                );""" % self.tables['databases'])
+                    `dbname` VARCHAR(50) NOT NULL UNIQUE,
+                    %s
+                );""" % (self.tables['databases'], ",\n".join("`%s` %s" %
+                    column for column in DATABASE_COLUMNS.items())))
             self._db_conn.execute(sql[0])
             self._db_conn.execute(sql[1])
             sql = "INSERT INTO %s(dbname) VALUES(?)" % self.tables['databases']
             self.db_conn.execute(sql, (self._info_dbname,))
             self._db_conn.commit()
+        self._metadata.load()
 
     def connect_to_database(self):
-        """Connect to the server database information."""
+        """Connect to the server database information and load it in the
+        metadata cache."""
+        # Only used by the metadata cache, which serializes writes
         self._db_conn = sqlite3.connect(SERVER_DATABASE, check_same_thread=False) 
+        self._metadata = MetadataCache(self._db_conn, self.tables,
+            self._generation, self._metadata_reloaded)
+        self._metadata.migrate()
+        self._metadata.load()
+        self._auth = Authenticator(self._metadata, self._token_secret)
+        tuning.apply(self._db_conn, self.database_pragmas(self._info_dbname))
+
+    def _metadata_reloaded(self, dbnames:set):
+        """Another process dropped, or changed the tuning of, databases."""
+        for dbname in dbnames:
+            if self._metadata.has_database(dbname):
+                self._pools.retune(dbname)
+            else:
+                if self._writes is not None:
+                    self._writes.drain(dbname)
+                self._cursors.close_database(dbname)
+                self._pools.drain(dbname, 0)
 
     def close_db_connection(self):
         """Close connection to the server database."""
         if self._db_conn:
             self._db_conn.close()
             self._db_conn = None 
+            self._metadata = None
+            self._auth = None
 
     def create_socket(self):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self._processes > 1 and _REUSEPORT:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._socket.bind((self.host, self.port)) 
 
     def close_socket(self):
@@ -140,50 +343,334 @@ class FDB_Server:
             self._socket.close()
             self._socket = None  
 
-    def log(self, msg:str, output=True):
-        """Write status in the log file and stdout if output=True."""
-        self.logger.write_line(msg)
-        if output:
-            print(msg) 
+    def log(self, msg:str, output=True, **fields):
+        """Write status in the log file and stdout if output=True.
+
+        fields are added to the record in 'json' log format. Never
+        blocks: lines are written by the logger thread.
+        """
+        self.logger.write_record(msg, output, **fields)
 
     def __del__(self):
         self.logger.close_file()
         self.close_db_connection()
         self.close_socket()
 
-    def run(self):
-        """Main server activity."""
+    def _client_connected(self, conn, address):
+        # Replies are often several small frames: do not let them wait for
+        # the acknowledgement of the previous one
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._nb_clients += 1
+        self._metrics.inc('connections')
+        self.log("[%s] New Client connected at %s\n" % 
+            (time.strftime('%H:%M:%S'), str(address)), event='connect',
+            address=str(address))
+
+    def shutdown(self):
+        """Make run() return. Can be called from any thread.
+
+        In 'thread' mode, sessions in progress go on until their client
+        leaves; in 'async' mode, they end with the event loop.
+        """
+        self._stopping.set()
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._stop_serving.set)
+            except RuntimeError:
+                pass # loop already closed
+
+    def session_ended(self):
+        """A session ended: start the one of the next connection waiting,
+        if any."""
+        waiting = self._gate.leave()
+        if waiting is not None:
+            admit, reject = waiting
+            admit()
+
+    def _reject(self, conn):
+        """Turn away a connection which waited too long: it gets a denied
+        login reply."""
+        channel = protocol.Channel(conn)
         try:
-            self.create_socket()
-            self.connect_to_database()
-            self.logger.open_file("a")
+            # Read what the client sent: closing a socket with unread
+            # data would reset the connection before the reply is read
+            conn.setblocking(False)
+            while conn.recv(RECV_BUFFER_SIZE):
+                pass
+        except OSError:
+            pass
+        try:
+            conn.setblocking(True)
+            channel.send(MSG_LOGIN, ERROR['too-many-connections'],
+                status=STATUS_DENIED)
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        finally:
+            channel.close()
+            conn.close()
 
-            now = datetime.datetime.now()
-            self.log("     ======== %s ========\n" % now.strftime('%d-%m-%Y'))
-            self.log("[%s] Server started successfully\n" % now.strftime('%H:%M:%S'))
+    def _serve_threads(self):
+        """Accept loop of the 'thread' mode: one thread per client, up to
+        max_connections."""
+        def start_session(conn):
+            ClientSession(self, conn).start()
 
-            while True:
-                self._socket.listen()
+        while not self._stopping.is_set():
+            self._cursors.reap()
+            for admit, reject in self._gate.expired():
+                reject()
+            # While no connection can wait, new ones stay in the listen
+            # backlog
+            if not self._gate.wait_room(SHUTDOWN_POLL_INTERVAL):
+                continue
+            # Wake up now and then to see if the server is shut down
+            if not select.select([self._socket], [], [], SHUTDOWN_POLL_INTERVAL)[0]:
+                continue
+            try:
                 conn, address = self._socket.accept()
-                self._nb_clients += 1
-                self.log("[%s] New Client connected at %s\n" % 
-                    (time.strftime('%H:%M:%S'), str(address)))
-                session = ClientSession(self, conn)
-                session.start()
+            except BlockingIOError:
+                continue # accepted by another process
+            self._client_connected(conn, address)
+            state = self._gate.enter((functools.partial(start_session, conn),
+                functools.partial(self._reject, conn)))
+            if state == ConnectionGate.RUN:
+                start_session(conn)
+            elif state == ConnectionGate.FULL:
+                self._reject(conn)
+
+    async def _serve_async(self):
+        """Event loop of the 'async' mode: one coroutine per client."""
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._workers, thread_name_prefix='fastdb-sql')
+
+        sessions = set()
+
+        async def turn_away(reader, writer):
+            """Turn a connection away with a denied login reply."""
+            channel = protocol.AsyncChannel(reader, writer)
+            try:
+                await channel.send(MSG_LOGIN, ERROR['too-many-connections'],
+                    status=STATUS_DENIED)
+                writer.write_eof()
+                # Until the client closes: closing with unread data would
+                # reset the connection before the reply is read
+                while await asyncio.wait_for(reader.read(RECV_BUFFER_SIZE),
+                        SHUTDOWN_POLL_INTERVAL):
+                    pass
+            except (OSError, asyncio.TimeoutError):
+                pass
+            finally:
+                await channel.close()
+
+        async def serve_client(reader, writer):
+            if self._stopping.is_set():
+                writer.close()
+                return
+            self._client_connected(writer.get_extra_info('socket'),
+                writer.get_extra_info('peername'))
+            task = asyncio.current_task()
+            sessions.add(task)
+            try:
+                admitted = asyncio.get_running_loop().create_future()
+
+                def wake(result:bool):
+                    if not admitted.done():
+                        admitted.set_result(result)
+                    elif result:
+                        self.session_ended() # cancelled: pass the slot on
+
+                state = self._gate.enter((functools.partial(wake, True),
+                    functools.partial(wake, False)))
+                if state == ConnectionGate.WAIT:
+                    state = ConnectionGate.RUN if await admitted \
+                        else ConnectionGate.FULL
+                if state == ConnectionGate.FULL:
+                    await turn_away(reader, writer)
+                    return
+                try:
+                    await AsyncClientSession(self, reader, writer,
+                        executor).run()
+                finally:
+                    self.session_ended()
+            except asyncio.CancelledError:
+                pass # server shut down
+            finally:
+                sessions.discard(task)
+
+        self._stop_serving = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        try:
+            self._socket.setblocking(False)
+            server = await asyncio.start_server(serve_client, sock=self._socket,
+                backlog=LISTEN_BACKLOG)
+            async with server:
+                # Other processes cannot wake the loop up: look now and then
+                while not self._stopping.is_set():
+                    self._cursors.reap()
+                    for admit, reject in self._gate.expired():
+                        reject()
+                    try:
+                        await asyncio.wait_for(self._stop_serving.wait(),
+                            SHUTDOWN_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self._loop = None
+            # Let the sessions whose client left end, and give their
+            # connection back, before the executor stops. Clients just
+            # accepted get their session started first.
+            await asyncio.sleep(0)
+            if sessions:
+                done, pending = await asyncio.wait(set(sessions),
+                    timeout=SHUTDOWN_POLL_INTERVAL)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+            executor.shutdown(wait=False)
+
+    def _start(self):
+        """Open what a serving process needs, then listen."""
+        self.connect_to_database()
+        self.logger.open_file("a")
+
+        now = datetime.datetime.now()
+        self.log("     ======== %s ========\n" % now.strftime('%d-%m-%Y'))
+        if self._worker is None:
+            self.log("[%s] Server started successfully (%s mode)\n" % 
+                (now.strftime('%H:%M:%S'), self.mode))
+        else:
+            self.log("[%s] Server process %d/%d started successfully (%s "
+                "mode)\n" % (now.strftime('%H:%M:%S'), self._worker + 1,
+                self._processes, self.mode))
+
+        if self._metrics_port:
+            # One listener per process
+            port = self._metrics_port + (self._worker or 0)
+            self._metrics_server = MetricsServer(self._metrics, port)
+            self._metrics_server.start()
+            self.log("[%s] Metrics served on http://%s:%d/metrics\n" %
+                (now.strftime('%H:%M:%S'), METRICS_HOST, port))
+
+        if self._slow_log is not None:
+            self._slow_log.start()
+
+        self._socket.listen(LISTEN_BACKLOG)
+
+    def _serve(self, started=None):
+        """Serve clients until shutdown. started is released once they
+        can connect."""
+        try:
+            self._start()
+            if started is not None:
+                started.release()
+            else:
+                self._ready.set()
+            if self.mode == 'async':
+                asyncio.run(self._serve_async())
+            else:
+                self._serve_threads()
         except KeyboardInterrupt:
-            self.log("Total today clients: %d\n" % self._nb_clients)
-            self.log("Shutting down server...\n")
+            self._stopping.set()
         except (sqlite3.Error, socket.error) as e:
             print(e)
         finally:
+            if self._stopping.is_set():
+                self.log("Total today clients: %d\n" % self._nb_clients)
+                self.log("Shutting down server...\n")
+            if self._metrics_server is not None:
+                self._metrics_server.stop()
+                self._metrics_server = None
+            if self._slow_log is not None:
+                self._slow_log.close()
             self.logger.close_file()
+            if self._writes is not None:
+                self._writes.close_all()
+            self.pools.close_all()
             self.close_db_connection()
             self.close_socket()
 
+    def _serve_process(self, number:int, started):
+        """Main activity of the process number of a multi-process server."""
+        self._worker = number
+        if _REUSEPORT:
+            # The socket of the parent only holds the port
+            self._port = self._socket.getsockname()[1]
+            self._socket.close()
+            self.create_socket()
+        else:
+            # Shared by all the processes, any of them may accept a client
+            self._socket.setblocking(False)
+        self._serve(started)
+
+    def _start_process(self, context, number:int, started):
+        process = context.Process(target=self._serve_process,
+            args=(number, started), name='fastdb-server-%d' % number)
+        process.start()
+        return process
+
+    def _run_processes(self):
+        """Start the serving processes, and start them again if they die,
+        until shutdown."""
+        context = multiprocessing.get_context('fork')
+        # Shared with the processes
+        self._stopping = context.Event()
+        self._generation = context.Value('Q', 0)
+        started = context.Semaphore(0)
+        processes = []
+        try:
+            self.create_socket()
+            if not _REUSEPORT:
+                self._socket.listen(LISTEN_BACKLOG)
+            processes = [self._start_process(context, number, started)
+                for number in range(self._processes)]
+            for process in processes:
+                if not started.acquire(timeout=PROCESS_START_TIMEOUT):
+                    raise RuntimeError("Server process not started")
+            print("[%s] Server started with %d processes (%s mode)" %
+                (time.strftime('%H:%M:%S'), self._processes, self.mode))
+            self._ready.set()
+            while not self._stopping.is_set():
+                multiprocessing.connection.wait([process.sentinel
+                    for process in processes], SHUTDOWN_POLL_INTERVAL)
+                for number, process in enumerate(processes):
+                    if not process.is_alive() and not self._stopping.is_set():
+                        print("[%s] Server process %d exited (%s), restarting"
+                            % (time.strftime('%H:%M:%S'), number + 1,
+                            process.exitcode))
+                        processes[number] = self._start_process(context,
+                            number, started)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopping.set()
+            for process in processes:
+                process.join()
+            self.close_socket()
+
+    def run(self):
+        """Main server activity."""
+        if self._processes > 1:
+            self._run_processes()
+            return
+        try:
+            self.create_socket()
+        except socket.error as e:
+            print(e)
+            self.close_socket()
+            return
+        self._serve()
+
 if __name__ == '__main__':
     args = utils.parse_server_args()
     if utils.is_valid_ip(args.host):
-        server = FDB_Server(args.host, args.port)
+        server = FDB_Server(args.host, args.port, args.mode, args.workers,
+            args.batch_size, args.result_cache, args.compression,
+            args.compression_level, args.metrics_port, args.slow_query_time,
+            args.slow_query_log, args.log_format, args.group_commit,
+            args.processes, args.max_connections, args.max_user_queries,
+            args.statement_timeout, args.max_result_size)
         server.run()
     else:
         print("Error: Invalid IP address")
@@ -2,24 +2,42 @@
 """
 
 import threading 
+import asyncio
+import collections
+import select
 import sqlite3
 import time
-import re 
 import os
 
 import utils
+import protocol
+import encoders
+import prepared
+import router
+import bulk
+import slowlog
+import tuning
+import writes
+import admission
+import backup
+from cache import CachedResult, SCHEMA
 from config import *
 
 
 # select_regex = re.compile(
 #     r"^select (\* | (?P<field>\w+,\s?)*?)?? (\w+) from \w+ .+?;$", 
 #     re.IGNORECASE | re.VERBOSE | re.DOTALL)
-select_regex = re.compile(r"^SELECT", re.IGNORECASE | re.VERBOSE)
+select_regex = prepared.select_regex
+# Statements on server-side cursors (see cursors.py)
+_CURSOR_STATEMENTS = {'declare-cursor', 'fetch-cursor', 'close-cursor',
+    'show-cursors'}
+# Backups and restores (see backup.py)
+_BACKUP_STATEMENTS = {'backup-database', 'restore-database', 'show-backups'}
 
 
 def _is_select_statement(sql:str) -> bool:
     """Check if the SQL command is a SELECT statement."""
-    return select_regex.search(sql) is not None
+    return prepared.is_select(sql)
 
 def _extract_fields(sql:str) -> list:
     """Extracts fields of a SELECT SQL statement."""
@@ -28,30 +46,105 @@ def _extract_fields(sql:str) -> list:
     return fields
 
 
-class ClientSession(threading.Thread):
-    def __init__(self, server, conn):
-        super().__init__()
+class BaseSession:
+    """Transport independent part of a client session.
+
+    Subclasses only move frames between the socket and handle().
+    """
+    def __init__(self, server):
         self.server = server 
-        self.conn = conn 
+        # Connection kept while a transaction is open (see _release())
         self.db_conn = None
+        self._pool = None
         self._client_connected = False
         self._old_dbname = ''
+        self._output_format = DEFAULT_OUTPUT_FORMAT
+        self._statements = prepared.StatementCache(PREPARED_CACHE_SIZE)
+        # Bulk load in progress and the error which stopped the last one
+        self._load = None
+        self._load_error = None
+        # Tables written by the transaction in progress
+        self._tx_writes = set()
+        # Compression method agreed on at login ('' for none)
+        self._compression = ''
+        self._metrics = server.metrics
+        self._username = ''
+        # Show the time spent in each phase with the results (PROFILE ON)
+        self._profiling = False
+        # Channel byte counts already added to the metrics
+        self._bytes_counted = (0, 0)
 
     def _connect_db(self, dbname:str):
         """Connects to the database selected by the user."""
         self._close_db_connection()
-        self.db_conn = sqlite3.connect(DATABASES_DIR + dbname  + DATABASE_EXT)
+        self._pool = self.server.pools.get(dbname)
 
     def _close_db_connection(self):
+        """Give back the connection kept by the session, if any."""
+        self._abort_load()
         if self.db_conn:
-            self.db_conn.close()
+            self._pool.release(self.db_conn)
             self.db_conn = None
 
+    def _acquire(self) -> sqlite3.Connection:
+        """Returns a connection to the database in use."""
+        if self.db_conn:
+            return self.db_conn
+        if not self._pool:
+            raise sqlite3.Error(ERROR['no-database-seleted'])
+        return self._pool.acquire()
+
+    def _release(self, conn:sqlite3.Connection):
+        """Give back a connection unless a transaction is still open."""
+        if conn.in_transaction:
+            self.db_conn = conn
+        else:
+            self.db_conn = None
+            self._pool.release(conn)
+
+    def _drop_database(self, dbname:str):
+        """Forget a database, close its connections and remove its files.
+
+        The files are kept if connections are still borrowed after
+        POOL_DRAIN_TIMEOUT.
+        """
+        self.server.delete_database_entry(dbname)
+        if self.server.writes is not None:
+            self.server.writes.drain(dbname)
+        self.server.cursors.close_database(dbname)
+        if self._old_dbname == dbname:
+            self._close_db_connection()
+            self._pool = None
+            self._old_dbname = ''
+        if self.server.result_cache is not None:
+            self.server.result_cache.invalidate(dbname)
+        # Wait for other sessions to give back their connections before
+        # removing the file
+        if not self.server.pools.drain(dbname):
+            raise sqlite3.Error(ERROR['database-in-use'] % dbname)
+        path = DATABASES_DIR + dbname + DATABASE_EXT
+        try:
+            # With the files of the WAL journal mode
+            for path in (path, path + '-wal', path + '-shm'):
+                if os.path.exists(path):
+                    os.remove(os.path.relpath(path))
+        except OSError as e:
+            raise sqlite3.Error(ERROR['database-files'] % (dbname,
+                e.strerror))
+
+    def _forget_database(self, dbname:str):
+        """Drop a database created by a restore which did not complete."""
+        try:
+            self._drop_database(dbname)
+        except sqlite3.Error:
+            pass
+
     def _handle_statement(self, key, stmt):
         """Handles user and database statements defined in config.py"""
         msg = ''
         if key in STATEMENTS.keys():
-            match = re.fullmatch(STATEMENTS[key], stmt, re.IGNORECASE | re.VERBOSE)
+            with self._metrics.timer('statement_routing'):
+                match = router.statements.match_key(key, stmt)
             if match:
                 if key in {'create-database', 'use-database', 'drop-database'}:
                     dbname = match.group('dbname')
@@ -65,7 +158,8 @@ class ClientSession(threading.Thread):
                         if not self.server.is_database_exist(dbname):
                             raise sqlite3.Error(ERROR['unknown-database'] % dbname)
                         else:
-                            if self._old_dbname != dbname:
+                            if self._old_dbname != dbname or \
+                                    self._pool is None or self._pool.closed:
                                 self._old_dbname = dbname
                                 self._connect_db(dbname)
                                 msg = SUCCESS['database-changed']
@@ -73,10 +167,7 @@ class ClientSession(threading.Thread):
                         if not self.server.is_database_exist(dbname):
                             raise sqlite3.Error(ERROR['no-database'] % dbname)
                         else:
-                            self.server.delete_database_entry(dbname)
-                            path = DATABASES_DIR + dbname + DATABASE_EXT
-                            if os.path.exists(path):
-                                os.remove(os.path.relpath(path))
+                            self._drop_database(dbname)
                             msg = SUCCESS['database-deleted'] % dbname
                 elif key in {'add-user', 'delete-user'}:
                     username = match.group('username')
@@ -93,63 +184,750 @@ class ClientSession(threading.Thread):
                     table = utils.TextTable()
                     table.add_rows(self.server.select_databases())
                     msg = str(table)
+                elif key == 'set-format':
+                    output_format = match.group('format').lower()
+                    if output_format not in encoders.ENCODERS:
+                        raise sqlite3.Error(ERROR['unknown-format'] %
+                            output_format)
+                    self._output_format = output_format
+                    msg = SUCCESS['format-changed'] % output_format
+                elif key == 'show-cache':
+                    cache = self.server.result_cache
+                    if cache is None:
+                        msg = SUCCESS['cache-disabled']
+                    else:
+                        table = utils.TextTable()
+                        table.add_rows(sorted(cache.stats().items()))
+                        msg = str(table)
+                elif key == 'profile':
+                    state = match.group('state').upper()
+                    self._profiling = state == 'ON'
+                    msg = SUCCESS['profile-changed'] % state
+                elif key == 'alter-database':
+                    dbname = match.group('dbname')
+                    if not self.server.is_database_exist(dbname):
+                        raise sqlite3.Error(ERROR['unknown-database'] % dbname)
+                    if match.group('profile'):
+                        profile = tuning.check_profile(match.group('profile'))
+                        overrides = {}
+                    else:
+                        profile, overrides = self.server.database_tuning(dbname)
+                        pragma = match.group('pragma').lower()
+                        overrides = dict(overrides)
+                        overrides[pragma] = tuning.check_pragma(pragma,
+                            match.group('value'))
+                    self.server.set_database_tuning(dbname, profile, overrides)
+                    msg = SUCCESS['tuning-changed'] % dbname
+                elif key == 'show-tuning':
+                    dbname = match.group('dbname') or self._old_dbname
+                    if not dbname:
+                        raise sqlite3.Error(ERROR['no-database-seleted'])
+                    if not self.server.is_database_exist(dbname):
+                        raise sqlite3.Error(ERROR['unknown-database'] % dbname)
+                    profile, overrides = self.server.database_tuning(dbname)
+                    pragmas = self.server.database_pragmas(dbname)
+                    # Values really in use, read from a connection
+                    pool = self.server.pools.get(dbname)
+                    conn = pool.acquire()
+                    try:
+                        rows = tuning.current(conn, sorted(pragmas))
+                    finally:
+                        pool.release(conn)
+                    table = utils.TextTable()
+                    table.add_rows([('profile', profile, '')] + [(name, value,
+                        'override' if name in overrides else '')
+                        for name, value in rows])
+                    msg = str(table)
+                elif key == 'show-status':
+                    table = utils.TextTable()
+                    table.add_rows(self._metrics.status_rows())
+                    msg = str(table)
         msg = "\n%s\n" % msg if len(msg) > 0 else " "
         return msg
 
+    def _cursor_statement(self, key:str, stmt:str, cancelled=None):
+        """Handle a statement on server-side cursors and yield its result.
+
+        FETCH sends the rows by chunks of server.batch_size rows, as a
+        SELECT does.
+        """
+        cursors = self.server.cursors
+        with self._metrics.timer('statement_routing'):
+            match = router.statements.match_key(key, stmt)
+        if match is None:
+            raise sqlite3.Error(ERROR['invalid-statement'])
+        if key == 'show-cursors':
+            now = time.monotonic()
+            rows = [(cursor.name, cursor.dbname, cursor.nb_rows,
+                'end' if cursor.exhausted else 'open',
+                "%.1f" % (now - cursor.last_used))
+                for cursor in cursors.session_cursors(self)]
+            msg = "Empty set"
+            if rows:
+                table = utils.TextTable()
+                table.add_rows(rows)
+                table.header(['cursor', 'database', 'rows', 'state', 'idle'])
+                msg = str(table)
+            yield MSG_RESULT, "\n%s\n" % msg, STATUS_OK
+            return
+        name = match.group('name')
+        if key == 'declare-cursor':
+            sql = match.group('query')
+            if not _is_select_statement(sql):
+                raise sqlite3.Error(ERROR['cursor-not-select'])
+            if not self._pool:
+                raise sqlite3.Error(ERROR['no-database-seleted'])
+            cursors.declare(self, name, self._pool, sql)
+            yield MSG_RESULT, "\n%s\n" % (SUCCESS['cursor-declared'] % name), \
+                STATUS_OK
+            return
+        if key == 'close-cursor':
+            cursors.close(self, name)
+            yield MSG_RESULT, "\n%s\n" % (SUCCESS['cursor-closed'] % name), \
+                STATUS_OK
+            return
+        # fetch-cursor
+        cursor = cursors.get(self, name)
+        count = int(match.group('count') or CURSOR_FETCH_SIZE)
+        encoder = encoders.create_encoder(self._output_format, cursor.columns)
+        profile = slowlog.Profile()
+        size = 0
+        with admission.StatementTimeout(cursor.conn,
+                self.server.statement_timeout):
+            while profile.rows < count:
+                now = time.perf_counter()
+                rows = cursor.fetch(min(self.server.batch_size,
+                    count - profile.rows))
+                fetched = time.perf_counter()
+                profile.fetch += fetched - now
+                if not rows:
+                    break
+                payload = encoder.encode(rows)
+                now = time.perf_counter()
+                profile.format += now - fetched
+                size += len(payload)
+                error = self._too_large(size, profile.rows)
+                if error is not None:
+                    yield error
+                    return
+                profile.rows += len(rows)
+                yield MSG_ROWS, payload, STATUS_OK
+                profile.send += time.perf_counter() - now
+                if cancelled is not None and cancelled():
+                    message = SUCCESS['query-cancelled'] % profile.rows
+                    yield MSG_RESULT, "\n%s\n" % message, STATUS_OK
+                    return
+        message = "\n %s\n" % (SUCCESS['cursor-fetched'] % (profile.rows,
+            profile.total - profile.send))
+        if cursor.exhausted:
+            message += " %s\n" % (SUCCESS['cursor-end'] % name)
+        message += self._record_profile(cursor.conn, cursor.sql, (), profile,
+            True)
+        yield MSG_RESULT, message, STATUS_OK
+
+    def _backup_statement(self, key:str, stmt:str, cancelled=None) -> str:
+        """Handle BACKUP, RESTORE and SHOW BACKUPS and returns the result.
+
+        The copy runs in the session, polling cancelled() between steps.
+        """
+        backups = self.server.backups
+        with self._metrics.timer('statement_routing'):
+            match = router.statements.match_key(key, stmt)
+        if match is None:
+            raise sqlite3.Error(ERROR['invalid-statement'])
+        if key == 'show-backups':
+            rows = [(copy.name, copy.dbname, copy.kind, copy.state,
+                "%d/%d" % (copy.done, copy.pages), "%.1f%%" % copy.percent,
+                "%.1f" % copy.elapsed) for copy in backups.copies()]
+            msg = "Empty set"
+            if rows:
+                table = utils.TextTable()
+                table.add_rows(rows)
+                table.header(['file', 'database', 'kind', 'state', 'pages',
+                    'progress', 'sec'])
+                msg = str(table)
+            return "\n%s\n" % msg
+        dbname, name = match.group('dbname'), match.group('name')
+        if key == 'backup-database':
+            if not self.server.is_database_exist(dbname):
+                raise sqlite3.Error(ERROR['unknown-database'] % dbname)
+            copy = backups.backup(self.server.pools.get(dbname), name,
+                cancelled)
+            success = 'database-backed-up'
+        else:
+            # Nothing is created for a backup which does not exist
+            backup.backup_file(name)
+            created = not self.server.is_database_exist(dbname)
+            if created:
+                self.server.insert_new_database(dbname)
+            # Nothing may write to the database but the restore
+            if self.server.writes is not None:
+                self.server.writes.drain(dbname)
+            self.server.cursors.close_database(dbname)
+            if self._old_dbname == dbname:
+                self._close_db_connection()
+            try:
+                copy = backups.restore(self.server.pools.get(dbname), name,
+                    cancelled)
+            except sqlite3.Error:
+                if created:
+                    self._forget_database(dbname)
+                raise
+            finally:
+                if self.server.result_cache is not None:
+                    self.server.result_cache.invalidate(dbname)
+            if created and copy.state == 'cancelled':
+                self._forget_database(dbname)
+            success = 'database-restored'
+        if copy.state == 'cancelled':
+            return "\n%s\n" % (SUCCESS['copy-cancelled'] % (copy.done,
+                copy.pages))
+        return "\n%s\n" % (SUCCESS[success] % (dbname, name, copy.pages,
+            copy.elapsed))
+
+    def _limited(self, replies):
+        """Yield the replies of a statement, run within the number of
+        statements its user may run at once."""
+        queries = self.server.queries
+        queries.acquire(self._username)
+        try:
+            yield from replies
+        finally:
+            queries.release(self._username)
+
+    def _too_large(self, size:int, nb_rows:int):
+        """Returns the error reply if a result of size bytes is over the
+        max_result_size of the server, else None."""
+        max_size = self.server.max_result_size
+        if max_size and size > max_size:
+            self._metrics.inc('results_too_large')
+            return MSG_RESULT, "\nERROR: %s\n" % (ERROR['result-too-large'] %
+                (max_size, nb_rows)), STATUS_ERROR
+        return None
+
+    def _execute(self, sql:str, cancelled=None, params=(), is_select=None):
+        """Execute a plain SQL statement and yield its result.
+
+        Rows of a SELECT are fetched and sent by chunks of
+        server.batch_size rows. cancelled() is polled between two chunks.
+        """
+        if is_select is None:
+            is_select = _is_select_statement(sql)
+        if not is_select and self.db_conn is None and self._pool and \
+                self.server.writes is not None and writes.is_queued(sql):
+            yield self._execute_write(sql, params)
+            return
+        cache = self.server.result_cache
+        conn = self._acquire()
+        cursor = conn.cursor()
+        try:
+            key = None
+            if cache is not None and is_select and not conn.in_transaction:
+                key = cache.key(self._old_dbname, self._output_format, sql,
+                    params)
+                entry = cache.get(key)
+                if entry is not None:
+                    yield from self._send_cached(entry, cancelled)
+                    return
+                generation = cache.generation(self._old_dbname)
+            if cache is not None:
+                cache.start_statement(conn)
+            with admission.StatementTimeout(conn,
+                    self.server.statement_timeout):
+                profile = slowlog.Profile()
+                start = time.perf_counter()
+                cursor.execute(sql, params)
+                now = time.perf_counter()
+                profile.execute = now - start
+                if is_select:
+                    nb_rows = 0
+                    # Encoded chunks kept for the result cache
+                    chunks = [] if key is not None else None
+                    size = 0
+                    # Bytes of rows sent
+                    sent = 0
+                    encoder = encoders.create_encoder(self._output_format,
+                        [column[0] for column in cursor.description])
+                    rows = cursor.fetchmany(self.server.batch_size)
+                    fetched = time.perf_counter()
+                    profile.fetch += fetched - now
+                    while rows:
+                        nb_rows += len(rows)
+                        payload = encoder.encode(rows)
+                        now = time.perf_counter()
+                        profile.format += now - fetched
+                        sent += len(payload)
+                        error = self._too_large(sent, nb_rows - len(rows))
+                        if error is not None:
+                            yield error
+                            return
+                        if chunks is not None:
+                            size += len(payload)
+                            if size > cache.max_entry_bytes:
+                                chunks = None
+                            else:
+                                chunks.append(payload)
+                        yield MSG_ROWS, payload, STATUS_OK
+                        # The payload was sent while suspended
+                        profile.send += time.perf_counter() - now
+                        if cancelled is not None and cancelled():
+                            message = SUCCESS['query-cancelled'] % nb_rows
+                            yield MSG_RESULT, "\n%s\n" % message, STATUS_OK
+                            return
+                        now = time.perf_counter()
+                        rows = cursor.fetchmany(self.server.batch_size)
+                        fetched = time.perf_counter()
+                        profile.fetch += fetched - now
+                    profile.rows = nb_rows
+                    time_passed = "(%.3f sec)" % (profile.total - profile.send)
+                    if nb_rows:
+                        message = "\n %d rows in set %s\n" % (nb_rows,
+                            time_passed)
+                    else:
+                        message = f"\nEmpty set {time_passed}\n"
+                    if chunks is not None:
+                        tables = cache.statement_tables(conn,
+                            self._old_dbname, sql)
+                        if tables is not None:
+                            cache.put(key, CachedResult(chunks, nb_rows,
+                                tables[0]), generation)
+                else:
+                    profile.rows = max(cursor.rowcount, 0)
+                    time_passed = "(%.3f sec)" % profile.execute
+                    message = "\nQuery done %s\n" % time_passed
+                    if cache is not None:
+                        tables = cache.statement_tables(conn,
+                            self._old_dbname, sql)
+                        # Tables unknown: the whole database may have changed
+                        self._invalidate_cache(conn,
+                            {SCHEMA} if tables is None else tables[1])
+                message += self._record_profile(conn, sql, params, profile,
+                    is_select)
+                yield MSG_RESULT, message, STATUS_OK
+        finally:
+            cursor.close()
+            self._release(conn)
+
+    def _execute_write(self, sql:str, params=()) -> tuple:
+        """Run a write through the write queue of the database in use.
+
+        Returns its MSG_RESULT reply once committed.
+        """
+        cache = self.server.result_cache
+        dbname = self._old_dbname
+
+        def write(conn):
+            if cache is not None:
+                cache.start_statement(conn)
+            with admission.StatementTimeout(conn,
+                    self.server.statement_timeout):
+                cursor = conn.execute(sql, params)
+            rowcount = cursor.rowcount
+            cursor.close()
+            if cache is None:
+                return rowcount, None
+            return rowcount, cache.statement_tables(conn, dbname, sql)
+
+        profile = slowlog.Profile()
+        start = time.perf_counter()
+        future = self.server.writes.get(self._pool).submit(write)
+        rowcount, tables = future.result()
+        # Time waited in the queue and to commit included
+        profile.execute = time.perf_counter() - start
+        profile.rows = max(rowcount, 0)
+        if cache is not None:
+            # Tables unknown: the whole database may have changed
+            self._invalidate_cache(None, {SCHEMA} if tables is None
+                else tables[1])
+        message = "\nQuery done (%.3f sec)\n" % profile.execute
+        message += self._record_profile(None, sql, params, profile, False)
+        return MSG_RESULT, message, STATUS_OK
+
+    def _record_profile(self, conn, sql:str, params, profile,
+            is_select:bool) -> str:
+        """Add the profile of a statement to the metrics and the slow
+        query log. Returns it as shown in profiling mode, else ''.
+
+        conn is None if the statement was run by the write queue.
+        """
+        self._metrics.observe('query_execute', profile.execute + profile.fetch)
+        if is_select:
+            self._metrics.observe('query_render', profile.format)
+        slow_log = self.server.slow_log
+        if slow_log is not None and slow_log.is_slow(profile):
+            plan_conn = conn if conn is not None else self._acquire()
+            try:
+                plan = slowlog.query_plan(plan_conn, sql, params)
+            except sqlite3.Error:
+                plan = ()
+            finally:
+                if conn is None:
+                    self._release(plan_conn)
+            slow_log.log(sql, self._old_dbname, self._username, profile, plan)
+            self._metrics.inc('slow_queries')
+        if self._profiling:
+            return " %s\n" % profile
+        return ''
+
+    def _send_cached(self, entry:CachedResult, cancelled=None):
+        """Yield a result found in the result cache."""
+        size = 0
+        for i, payload in enumerate(entry.chunks):
+            size += len(payload)
+            error = self._too_large(size, min(entry.nb_rows,
+                i * self.server.batch_size))
+            if error is not None:
+                yield error
+                return
+            yield MSG_ROWS, payload, STATUS_OK
+            if cancelled is not None and cancelled():
+                message = SUCCESS['query-cancelled'] % \
+                    min(entry.nb_rows, (i + 1) * self.server.batch_size)
+                yield MSG_RESULT, "\n%s\n" % message, STATUS_OK
+                return
+        if entry.nb_rows:
+            message = "\n %d rows in set (cached)\n" % entry.nb_rows
+        else:
+            message = "\nEmpty set (cached)\n"
+        yield MSG_RESULT, message, STATUS_OK
+
+    def _invalidate_cache(self, conn, tables:set):
+        """Drop the cached results reading the written tables."""
+        cache = self.server.result_cache
+        if cache is None:
+            return
+        if tables:
+            cache.invalidate(self._old_dbname, tables)
+        if conn is not None and conn.in_transaction:
+            # Other sessions could cache what they read before the commit
+            self._tx_writes |= tables
+        elif self._tx_writes:
+            cache.invalidate(self._old_dbname, self._tx_writes)
+            self._tx_writes = set()
+
+    def _prepare(self, sql:str) -> bytes:
+        """Prepare a statement, or find it if already prepared."""
+        statement = self._statements.lookup(sql)
+        self._metrics.inc('prepared_misses' if statement is None
+            else 'prepared_hits')
+        if statement is None:
+            conn = self._acquire()
+            try:
+                nb_params = prepared.count_parameters(conn, sql)
+            finally:
+                self._release(conn)
+            statement = self._statements.add(sql, nb_params)
+        return protocol.PREPARED.pack(statement.id, statement.nb_params)
+
+    def _feed_load(self, frame):
+        """Start a bulk load or add rows to it.
+
+        Nothing is replied before MSG_LOAD_END, errors are kept until then.
+        """
+        try:
+            if frame.msg_type == MSG_LOAD:
+                self._abort_load()
+                self._load_error = None
+                sql, commit_batch_size = protocol.unpack_fields(frame.payload)
+                conn = self._acquire()
+                try:
+                    self._load = bulk.BulkLoad(conn, sql,
+                        int(commit_batch_size) or LOAD_COMMIT_BATCH_SIZE)
+                except sqlite3.Error:
+                    self._release(conn)
+                    raise
+            elif self._load is not None:
+                self._load.add(protocol.unpack_rows(frame.payload))
+        except (sqlite3.Error, ValueError, protocol.ProtocolError) as e:
+            self._load_error = e
+            self._abort_load()
+
+    def _finish_load(self) -> str:
+        """End the bulk load in progress and returns its report."""
+        load, self._load = self._load, None
+        if load is None:
+            error = self._load_error or sqlite3.Error(ERROR['no-load'])
+            self._load_error = None
+            raise sqlite3.Error(str(error))
+        try:
+            load.finish()
+        except sqlite3.Error as e:
+            raise sqlite3.Error("%s (%d rows loaded)" % (str(e), load.nb_rows))
+        finally:
+            self._release(load.conn)
+            self._invalidate_cache(None, {SCHEMA})
+        elapsed = load.elapsed
+        return "\n%s\n" % (SUCCESS['rows-loaded'] %
+            (load.nb_rows, elapsed, load.nb_rows / max(elapsed, 1e-6)))
+
+    def _abort_load(self):
+        if self._load is not None:
+            load, self._load = self._load, None
+            load.abort()
+            self._release(load.conn)
+            self._invalidate_cache(None, {SCHEMA})
+
+    def _login(self, frame):
+        """Check the credentials sent in a login frame. Returns the payload
+        of the reply, or None if the login is denied.
+
+        The client may add the compression methods it supports, in order
+        of preference; the one chosen is kept in _compression. It may then
+        add a session token (see auth.py), sent instead of the password,
+        or '' to get one: the reply holds the compression method and a
+        new token.
+        """
+        if frame is None or frame.msg_type != MSG_LOGIN:
+            return None
+        try:
+            username, password, *extra = protocol.unpack_fields(frame.payload)
+        except (ValueError, protocol.ProtocolError):
+            return None
+        token = extra[1] if len(extra) > 1 else None
+        with self._metrics.timer('login'):
+            if token:
+                exists = self.server.check_token(username, token)
+            else:
+                exists = self.server.is_user_exist(username, password)
+        if not exists:
+            self._metrics.inc('login_failures')
+            return None
+        if token:
+            self._metrics.inc('token_logins')
+        self._username = username
+        if extra:
+            self._compression = protocol.choose_compression(extra[0],
+                self.server.compression)
+        if token is None:
+            return self._compression
+        return protocol.pack_fields(self._compression,
+            self.server.issue_token(username))
+
+    def _request_done(self, frame, channel, start:float, sending:float):
+        """Record the metrics of a request once replied to."""
+        if frame.msg_type in (MSG_LOAD, MSG_LOAD_ROWS):
+            return # replied to with MSG_LOAD_END
+        self._metrics.inc('requests')
+        self._metrics.observe('query_send', sending)
+        self._metrics.observe('query_total', time.perf_counter() - start)
+        self._count_bytes(channel)
+
+    def _count_bytes(self, channel):
+        """Add what the channel sent and received since last time to the
+        metrics."""
+        sent, received = self._bytes_counted
+        self._metrics.inc('bytes_out', channel.bytes_sent - sent)
+        self._metrics.inc('bytes_in', channel.bytes_received - received)
+        self._bytes_counted = (channel.bytes_sent, channel.bytes_received)
+
+    def _channel_compression(self):
+        """Compression of the frames sent once logged in, or None."""
+        if not self._compression:
+            return None
+        return protocol.Compression(self._compression,
+            self.server.compression_level)
+
+    def handle(self, frame, cancelled=None):
+        """Process one request frame.
+
+        Yields (msg_type, payload, status) replies, the last one being
+        a MSG_RESULT. Frames of a bulk load get no reply until MSG_LOAD_END.
+        """
+        try:
+            if frame.msg_type == MSG_STATEMENT:
+                # Custom statements (on user, database, cursors)
+                fields = protocol.unpack_fields(frame.payload)
+                # The key of the statement and the statement
+                if len(fields) != 2:
+                    raise protocol.ProtocolError("Invalid statement frame")
+                if fields[0] in _CURSOR_STATEMENTS:
+                    yield from self._limited(self._cursor_statement(*fields,
+                        cancelled=cancelled))
+                elif fields[0] in _BACKUP_STATEMENTS:
+                    yield MSG_RESULT, self._backup_statement(*fields,
+                        cancelled=cancelled), STATUS_OK
+                else:
+                    yield MSG_RESULT, self._handle_statement(*fields), \
+                        STATUS_OK
+            elif frame.msg_type == MSG_QUERY:
+                yield from self._limited(self._execute(
+                    protocol.decode_text(frame.payload), cancelled))
+            elif frame.msg_type == MSG_PREPARE:
+                yield MSG_PREPARED, self._prepare(
+                    protocol.decode_text(frame.payload)), STATUS_OK
+            elif frame.msg_type == MSG_EXECUTE:
+                statement_id, params = protocol.unpack_execute(frame.payload)
+                statement = self._statements.get(statement_id)
+                yield from self._limited(self._execute(statement.sql,
+                    cancelled, params, statement.is_select))
+            elif frame.msg_type in (MSG_LOAD, MSG_LOAD_ROWS):
+                self._feed_load(frame)
+            elif frame.msg_type == MSG_LOAD_END:
+                yield MSG_RESULT, self._finish_load(), STATUS_OK
+            else:
+                raise sqlite3.Error(ERROR['invalid-statement'])
+        except (sqlite3.Error, protocol.ProtocolError) as e:
+            if self.db_conn:
+                self.db_conn.rollback()
+                self._close_db_connection()
+            yield MSG_RESULT, f"\nERROR: {str(e)}\n", STATUS_ERROR
+
+
+class ClientSession(BaseSession, threading.Thread):
+    """Session served by its own thread."""
+    def __init__(self, server, conn):
+        BaseSession.__init__(self, server)
+        threading.Thread.__init__(self)
+        self.conn = conn 
+        # Frames read while looking for a cancel request
+        self._pending = collections.deque()
+
+    def _next_frame(self, channel):
+        if self._pending:
+            return self._pending.popleft()
+        return channel.recv()
+
+    def _is_cancelled(self, channel, request_id:int) -> bool:
+        """Check, without blocking, if the client cancelled the request."""
+        cancelled = False
+        while channel.buffered or select.select([self.conn], [], [], 0)[0]:
+            frame = channel.recv()
+            if frame is None:
+                # Client gone, no need to go on
+                self._pending.append(None)
+                return True
+            if frame.msg_type == MSG_CANCEL:
+                cancelled = cancelled or frame.request_id == request_id
+            else:
+                self._pending.append(frame)
+        return cancelled
+
     def run(self):
         """Handle client - server session."""
+        self._metrics.add_gauge('active_sessions', 1)
         with self.conn:
+            channel = protocol.Channel(self.conn)
+            try:
+                # 1. client's connection (login)
+                frame = channel.recv()
+                if frame is not None:
+                    reply = self._login(frame)
+                    if reply is not None:
+                        channel.send(MSG_LOGIN, reply, frame.request_id)
+                        channel.compression = self._channel_compression()
+                        self._client_connected = True
+                    else:
+                        channel.send(MSG_LOGIN, request_id=frame.request_id,
+                            status=STATUS_DENIED)
+                # 2. main activity
+                while self._client_connected:
+                    frame = self._next_frame(channel)
+                    if frame is None:
+                        break
+                    if frame.msg_type == MSG_CANCEL:
+                        continue # the request is already over
+                    request_id = frame.request_id
+                    cancelled = lambda: self._is_cancelled(channel, request_id)
+                    start = time.perf_counter()
+                    sending = 0.0
+                    for msg_type, message, status in self.handle(frame, cancelled):
+                        sent = time.perf_counter()
+                        channel.send(msg_type, message, request_id, status)
+                        sending += time.perf_counter() - sent
+                    self._request_done(frame, channel, start, sending)
+            except (OSError, protocol.ProtocolError):
+                pass
+            finally:
+                self._close_db_connection()
+                self.server.cursors.close_session(self)
+                self._count_bytes(channel)
+                channel.close()
+                self._metrics.add_gauge('active_sessions', -1)
+                # Let the next connection waiting in
+                self.server.session_ended()
+
+
+class AsyncClientSession(BaseSession):
+    """Session served by a coroutine of the server event loop.
+
+    Blocking sqlite3 calls are run in the server executor.
+    """
+    def __init__(self, server, reader, writer, executor):
+        super().__init__(server)
+        self.reader = reader
+        self.writer = writer
+        self.executor = executor
+        self._frames = asyncio.Queue(ASYNC_PENDING_FRAMES)
+        self._cancelled = set()
+
+    async def _call(self, func, *args):
+        """Run a blocking function in the executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def _read_frames(self, channel):
+        """Read incoming frames, keeping cancel requests aside."""
+        try:
+            while True:
+                frame = await channel.recv()
+                if frame is not None and frame.msg_type == MSG_CANCEL:
+                    self._cancelled.add(frame.request_id)
+                    continue
+                await self._frames.put(frame)
+                if frame is None:
+                    break
+        except (OSError, protocol.ProtocolError):
+            await self._frames.put(None)
+
+    async def run(self):
+        """Handle client - server session."""
+        channel = protocol.AsyncChannel(self.reader, self.writer)
+        reader_task = None
+        self._metrics.add_gauge('active_sessions', 1)
+        try:
             # 1. client's connection (login)
-            data = self.conn.recv(1024)
-            data = data.decode(encoding="utf-8")
-            if data:
-                if self.server.is_user_exist(*data.split(DATA_SEPARATOR)):
-                    self.conn.send(ACCESS_GRANTED)
+            frame = await channel.recv()
+            if frame is not None:
+                reply = await self._call(self._login, frame)
+                if reply is not None:
+                    await channel.send(MSG_LOGIN, reply, frame.request_id)
+                    channel.compression = self._channel_compression()
                     self._client_connected = True
                 else:
-                    self.conn.send(ACCESS_DENIED)
+                    await channel.send(MSG_LOGIN, request_id=frame.request_id,
+                        status=STATUS_DENIED)
             # 2. main activity
             if self._client_connected:
-                table = utils.TextTable()
-                message = ''
-                while self.conn:
-                    try:
-                        sql = self.conn.recv(1024)
-                        sql = sql.decode(encoding="utf-8")
-                        if sql:
-                            # Try to execute custom statements (on user, database)
-                            parts = sql.split(DATA_SEPARATOR)
-                            if len(parts) == 2:
-                                message = self._handle_statement(*parts)
-                            else:
-                                if not self.db_conn:
-                                    raise sqlite3.Error(ERROR['no-database-seleted'])
-                                cursor = self.db_conn.cursor()
-                                start = time.time()
-                                cursor.execute(sql)
-                                end = time.time()
-                                elapsed_time = end - start
-                                time_passed = "(%.3f sec)" % elapsed_time
-                                if _is_select_statement(sql):
-                                    table.clear()
-                                    results = cursor.fetchall()
-                                    # table.header(_extract_fields(sql))
-                                    if results:
-                                        table.add_rows(results)
-                                        message = "%s\n %d rows in set %s\n" % (
-                                            str(table), len(results), time_passed)
-                                    else:
-                                        message = f"\nEmpty set {time_passed}\n"
-                                else:
-                                    self.db_conn.commit()
-                                    message = "\nQuery done %s\n" % time_passed
-                    except sqlite3.Error as e:
-                        message = f"\nERROR: {str(e)}\n"
-                        if self.db_conn:
-                            self.db_conn.rollback()
-                    try:
-                        self.conn.sendall(message.encode("utf-8"))
-                    except BrokenPipeError:
-                        break
-            self._close_db_connection()
-            self.conn.close()
+                reader_task = asyncio.create_task(self._read_frames(channel))
+            while self._client_connected:
+                frame = await self._frames.get()
+                if frame is None:
+                    break
+                request_id = frame.request_id
+                replies = self.handle(frame,
+                    lambda: request_id in self._cancelled)
+                start = time.perf_counter()
+                sending = 0.0
+                try:
+                    while True:
+                        reply = await self._call(next, replies, None)
+                        if reply is None:
+                            break
+                        msg_type, message, status = reply
+                        sent = time.perf_counter()
+                        await channel.send(msg_type, message, request_id, status)
+                        sending += time.perf_counter() - sent
+                    self._request_done(frame, channel, start, sending)
+                finally:
+                    await self._call(replies.close)
+                    self._cancelled.discard(request_id)
+        except (OSError, protocol.ProtocolError):
+            pass
+        finally:
+            if reader_task is not None:
+                reader_task.cancel()
+            await self._call(self._close_db_connection)
+            await self._call(self.server.cursors.close_session, self)
+            await channel.close()
+            self._count_bytes(channel)
+            self._metrics.add_gauge('active_sessions', -1)
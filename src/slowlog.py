@@ -0,0 +1,97 @@
+"""Slow query log.
+
+Statements taking at least SLOW_QUERY_TIME seconds are logged with their
+database, user, number of rows, the time spent executing, fetching,
+formatting and sending, and their query plan:
+
+    # Time: 2026-01-01 12:00:00  User: ludo  Database: tweets  Rows: 2500
+    # Total: 1.204  Execute: 0.002  Fetch: 1.105  Format: 0.075  Send: 0.022
+    # Plan: SCAN tweets
+    SELECT * FROM tweets WHERE text LIKE '%python%';
+
+In 'json' log format, each record is a JSON object with the same
+information. Records are written by a utils.Logger, from a background
+thread, so sessions never wait for the disk. If it falls behind, new
+records are dropped and counted.
+"""
+
+import datetime
+
+import utils
+from config import *
+
+# Parts of the time of a statement, in the order they are shown
+PHASES = ('execute', 'fetch', 'format', 'send')
+
+
+class Profile:
+    """Time spent by a statement in each phase, in seconds."""
+    __slots__ = PHASES + ('rows',)
+
+    def __init__(self):
+        for phase in PHASES:
+            setattr(self, phase, 0.0)
+        self.rows = 0
+
+    @property
+    def total(self) -> float:
+        return sum(getattr(self, phase) for phase in PHASES)
+
+    def __str__(self):
+        return "Total: %.3f  " % self.total + "  ".join("%s: %.3f" %
+            (phase.capitalize(), getattr(self, phase)) for phase in PHASES)
+
+
+class SlowQueryLog:
+    def __init__(self, threshold:float, filename=SLOW_QUERY_LOG_FILE,
+            log_format=DEFAULT_LOG_FORMAT):
+        self._threshold = threshold
+        self._format = log_format
+        self._logger = utils.Logger(filename, log_format=log_format)
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    @property
+    def dropped(self):
+        return self._logger.dropped
+
+    def start(self):
+        self._logger.open_file('a')
+
+    def close(self):
+        self._logger.close_file()
+
+    def is_slow(self, profile:Profile) -> bool:
+        return profile.total >= self._threshold
+
+    def log(self, sql:str, dbname:str, username:str, profile:Profile,
+            plan=()):
+        """Queue the record of a slow statement. plan holds the details
+        of its EXPLAIN QUERY PLAN rows."""
+        sql = sql.strip()
+        if self._format == 'json':
+            times = {phase: getattr(profile, phase) for phase in PHASES}
+            self._logger.write_record(sql, user=username, database=dbname,
+                rows=profile.rows, total=profile.total, plan=list(plan),
+                **times)
+            return
+        lines = ["# Time: %s  User: %s  Database: %s  Rows: %d\n" %
+            (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), username,
+            dbname or '-', profile.rows), "# %s\n" % profile]
+        lines.extend("# Plan: %s\n" % detail for detail in plan)
+        lines.append(sql if sql.endswith(';') else sql + ';')
+        self._logger.write_line(''.join(lines) + "\n")
+
+
+def query_plan(conn, sql:str, params=()) -> list:
+    """Returns the details of the EXPLAIN QUERY PLAN rows of a statement,
+    indented by depth."""
+    rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    depths = {}
+    details = []
+    for node_id, parent, notused, detail in rows:
+        depths[node_id] = depths.get(parent, -1) + 1
+        details.append("  " * depths[node_id] + detail)
+    return details
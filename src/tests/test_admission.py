@@ -0,0 +1,84 @@
+"""This module tests admission control and resource limits (admission.py)
+"""
+
+import unittest
+import sqlite3
+import threading
+
+import admission
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestConnectionGate, TestQuerySlots, TestStatementTimeout
+
+class TestConnectionGate(unittest.TestCase):
+    def test_queue(self):
+        gate = admission.ConnectionGate(2, queue_size=1, queue_timeout=60)
+        self.assertEqual(gate.enter('a'), gate.RUN)
+        self.assertEqual(gate.enter('b'), gate.RUN)
+        self.assertEqual(gate.enter('c'), gate.WAIT)
+        self.assertFalse(gate.wait_room(0))
+        self.assertEqual(gate.enter('d'), gate.FULL)
+        # The waiting connection takes the place of the session which ended
+        self.assertEqual(gate.leave(), 'c')
+        self.assertTrue(gate.wait_room(0))
+        self.assertEqual(gate.stats(), {'active': 2, 'waiting': 0,
+            'rejected': 1})
+        self.assertIsNone(gate.leave())
+        self.assertEqual(gate.stats()['active'], 1)
+
+    def test_expired(self):
+        gate = admission.ConnectionGate(1, queue_size=4, queue_timeout=-1)
+        gate.enter('a')
+        gate.enter('b')
+        gate.enter('c')
+        self.assertEqual(gate.expired(), ['b', 'c'])
+        self.assertIsNone(gate.leave())
+        self.assertEqual(gate.stats(), {'active': 0, 'waiting': 0,
+            'rejected': 2})
+
+    def test_wait_room(self):
+        gate = admission.ConnectionGate(1, queue_size=0)
+        gate.enter('a')
+        threading.Timer(0.05, gate.leave).start()
+        self.assertTrue(gate.wait_room(5))
+
+    def test_unlimited(self):
+        gate = admission.ConnectionGate(0, queue_size=0)
+        for i in range(100):
+            self.assertEqual(gate.enter(i), gate.RUN)
+
+
+class TestQuerySlots(unittest.TestCase):
+    def test_limit(self):
+        slots = admission.QuerySlots(2)
+        slots.acquire('ludo')
+        slots.acquire('ludo')
+        slots.acquire('other')
+        with self.assertRaises(sqlite3.Error) as context:
+            slots.acquire('ludo')
+        self.assertIn(ERROR['too-many-queries'] % ('ludo', 2),
+            str(context.exception))
+        slots.release('ludo')
+        slots.acquire('ludo')
+        self.assertEqual(slots.stats(), {'running': 3, 'rejected': 1})
+
+
+class TestStatementTimeout(unittest.TestCase):
+    # Never ends on its own
+    endless = "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 " \
+        "FROM n) SELECT count(*) FROM n"
+
+    def test_timeout(self):
+        conn = sqlite3.connect(':memory:')
+        with self.assertRaises(sqlite3.OperationalError) as context:
+            with admission.StatementTimeout(conn, 0.05):
+                conn.execute(self.endless)
+        self.assertEqual(str(context.exception),
+            ERROR['statement-timeout'] % 0.05)
+        # The handler is removed
+        with admission.StatementTimeout(conn, None):
+            self.assertEqual(conn.execute("SELECT 1").fetchone(), (1,))
+        with admission.StatementTimeout(conn, 5):
+            self.assertEqual(conn.execute("SELECT 2").fetchone(), (2,))
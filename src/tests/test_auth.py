@@ -0,0 +1,82 @@
+"""This module tests the login fast path (auth.py)
+"""
+
+import unittest
+import sqlite3
+
+import auth
+import utils
+import metadata
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestAuthenticator,
+
+class TestAuthenticator(unittest.TestCase):
+    tables = {'users': 'users', 'databases': 'databases'}
+
+    def setUp(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, "
+            "username TEXT UNIQUE, password TEXT)")
+        self.metadata = metadata.MetadataCache(conn, self.tables)
+        self.metadata.load()
+        self.metadata.add_user('ludo', utils.hash_password('sha512', 'ludo'))
+
+    def test_password_cache(self):
+        _auth = auth.Authenticator(self.metadata, cache_size=2)
+        self.assertTrue(_auth.check_password('ludo', 'ludo'))
+        self.assertTrue(_auth.check_password('ludo', 'ludo'))
+        self.assertFalse(_auth.check_password('ludo', 'oops'))
+        self.assertFalse(_auth.check_password('nobody', 'ludo'))
+        self.assertEqual(_auth.stats(), {'cached': 1, 'hits': 1, 'misses': 2})
+
+        # Added again with another password: the entry is not used
+        self.metadata.delete_user('ludo')
+        self.metadata.add_user('ludo', utils.hash_password('sha512', 'new'))
+        self.assertFalse(_auth.check_password('ludo', 'ludo'))
+        self.assertTrue(_auth.check_password('ludo', 'new'))
+
+        _auth.forget('ludo')
+        self.assertEqual(_auth.stats()['cached'], 0)
+
+        # Bounded
+        for name in ('a', 'b', 'c'):
+            self.metadata.add_user(name, utils.hash_password('sha512', name))
+            self.assertTrue(_auth.check_password(name, name))
+        self.assertEqual(_auth.stats()['cached'], 2)
+
+        # Expired
+        _auth = auth.Authenticator(self.metadata, cache_ttl=0)
+        _auth.check_password('a', 'a')
+        _auth.check_password('a', 'a')
+        self.assertEqual(_auth.stats()['hits'], 0)
+
+    def test_tokens(self):
+        _auth = auth.Authenticator(self.metadata)
+        token = _auth.issue_token('ludo')
+        self.assertTrue(_auth.check_token('ludo', token))
+        self.assertFalse(_auth.check_token('other', token))
+        self.assertFalse(_auth.check_token('ludo', token[:-1] + 'x'))
+        self.assertFalse(_auth.check_token('ludo', 'garbage'))
+        # Non-ASCII signature: denied, not a TypeError
+        self.assertFalse(_auth.check_token('ludo',
+            token.rsplit(':', 1)[0] + ':\u00e9' * 64))
+        self.assertEqual(_auth.issue_token('nobody'), '')
+
+        # Signed by the secret of the server
+        other = auth.Authenticator(self.metadata)
+        self.assertFalse(other.check_token('ludo', token))
+        shared = auth.Authenticator(self.metadata, _auth._secret)
+        self.assertTrue(shared.check_token('ludo', token))
+
+        expired = auth.Authenticator(self.metadata, token_ttl=-1)
+        self.assertFalse(expired.check_token('ludo',
+            expired.issue_token('ludo')))
+
+        # No longer valid once the user is deleted
+        self.metadata.delete_user('ludo')
+        self.assertFalse(_auth.check_token('ludo', token))
+        self.metadata.add_user('ludo', utils.hash_password('sha512', 'ludo2'))
+        self.assertFalse(_auth.check_token('ludo', token))
@@ -0,0 +1,227 @@
+"""This module tests online backups and restores (backup.py)
+"""
+
+import unittest
+import sqlite3
+import tempfile
+import shutil
+import os
+
+import backup
+import metrics
+import protocol
+import session
+import cursors
+from pool import ConnectionPool
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestBackupManager, TestBackupStatements
+
+class _BackupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self._backups_dir = backup.BACKUPS_DIR
+        backup.BACKUPS_DIR = os.path.join(self.directory, 'backups') + '/'
+        self.path = os.path.join(self.directory, 'shop' + DATABASE_EXT)
+        self.pool = ConnectionPool('shop', self.path)
+        conn = self.pool.acquire()
+        conn.execute("PRAGMA journal_mode=wal")
+        conn.execute("CREATE TABLE t (x INTEGER, y TEXT)")
+        conn.executemany("INSERT INTO t VALUES (?, ?)",
+            [(i, 'x' * 500) for i in range(2000)])
+        conn.commit()
+        self.pool.release(conn)
+        self.metrics = metrics.Metrics()
+
+    def tearDown(self):
+        self.pool.drain(0)
+        backup.BACKUPS_DIR = self._backups_dir
+        shutil.rmtree(self.directory)
+
+    def _count(self) -> int:
+        conn = self.pool.acquire()
+        try:
+            return conn.execute("SELECT count(*) FROM t").fetchone()[0]
+        finally:
+            self.pool.release(conn)
+
+
+class TestBackupManager(_BackupTestCase):
+    def test_backup_restore(self):
+        manager = backup.BackupManager(self.metrics, pages=50, throttle=0)
+        copy = manager.backup(self.pool, 'shop-1.db')
+        self.assertEqual(copy.state, 'done')
+        self.assertGreater(copy.pages, 50)
+        self.assertEqual(copy.done, copy.pages)
+        self.assertEqual(os.listdir(backup.BACKUPS_DIR), ['shop-1.db'])
+        target = sqlite3.connect(backup.BACKUPS_DIR + 'shop-1.db')
+        self.assertEqual(target.execute("PRAGMA journal_mode").fetchone()[0],
+            'delete')
+        target.close()
+        conn = self.pool.acquire()
+        conn.execute("DELETE FROM t WHERE x >= 100")
+        conn.commit()
+        self.pool.release(conn)
+        self.assertEqual(self._count(), 100)
+        copy = manager.restore(self.pool, 'shop-1.db')
+        self.assertEqual(copy.state, 'done')
+        self.assertEqual(self._count(), 2000)
+        conn = self.pool.acquire()
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0],
+            'wal')
+        self.pool.release(conn)
+        self.assertEqual([c.kind for c in manager.copies()],
+            ['backup', 'restore'])
+        rows = dict(self.metrics.status_rows())
+        self.assertEqual(rows['backups_done'], 2)
+        self.assertGreaterEqual(rows['backup_pages'], 2 * copy.pages)
+
+    def test_names(self):
+        manager = backup.BackupManager(self.metrics)
+        for name in ('../shop.db', '.hidden', 'a/b', 'shop.db.part'):
+            with self.assertRaises(sqlite3.Error):
+                manager.backup(self.pool, name)
+        with self.assertRaises(sqlite3.Error) as context:
+            manager.restore(self.pool, 'nope.db')
+        self.assertIn(ERROR['unknown-backup'] % 'nope.db',
+            str(context.exception))
+        self.assertEqual(manager.copies(), [])
+
+    def test_cancel(self):
+        manager = backup.BackupManager(self.metrics, pages=10, throttle=0)
+        copy = manager.backup(self.pool, 'shop-1.db', lambda: True)
+        self.assertEqual(copy.state, 'cancelled')
+        self.assertLess(copy.done, copy.pages)
+        # No torn file left
+        self.assertEqual(os.listdir(backup.BACKUPS_DIR), [])
+        manager.backup(self.pool, 'shop-1.db')
+        conn = self.pool.acquire()
+        conn.execute("DELETE FROM t")
+        conn.commit()
+        self.pool.release(conn)
+        copy = manager.restore(self.pool, 'shop-1.db', lambda: True)
+        self.assertEqual(copy.state, 'cancelled')
+        # Nothing of the backup was restored
+        self.assertEqual(self._count(), 0)
+
+    def test_restarts(self):
+        manager = backup.BackupManager(self.metrics, pages=10, throttle=0,
+            max_restarts=2)
+        writer = sqlite3.connect(self.path)
+        self.addCleanup(writer.close)
+
+        def write():
+            # Each step sees the database changed by another connection
+            writer.execute("INSERT INTO t VALUES (-1, '')")
+            writer.commit()
+            return False
+
+        copy = manager.backup(self.pool, 'shop-1.db', write)
+        self.assertEqual(copy.state, 'done')
+        self.assertEqual(copy.restarts, 3)
+        target = sqlite3.connect(backup.BACKUPS_DIR + 'shop-1.db')
+        self.addCleanup(target.close)
+        self.assertGreater(target.execute("SELECT count(*) FROM t").fetchone()
+            [0], 2000)
+
+    def test_running(self):
+        manager = backup.BackupManager(self.metrics, throttle=0)
+
+        def cancelled():
+            # Another session asks for a copy to the same file
+            with self.assertRaises(sqlite3.Error) as context:
+                manager.backup(self.pool, 'shop-1.db')
+            self.assertIn(ERROR['backup-running'] % ('shop', 'shop-1.db'),
+                str(context.exception))
+            self.assertEqual(manager.stats(), {'running': 1})
+            return False
+
+        manager.backup(self.pool, 'shop-1.db', cancelled)
+        self.assertEqual(manager.stats(), {'running': 0})
+
+
+class _FakeServer:
+    batch_size = 10
+    writes = None
+    result_cache = None
+
+    def __init__(self, pool):
+        self.metrics = metrics.Metrics()
+        self.backups = backup.BackupManager(self.metrics, throttle=0)
+        self.cursors = cursors.CursorManager(self.metrics)
+        self.pools = self
+        self._pool = pool
+        self.databases = ['shop']
+
+    def get(self, dbname:str):
+        return self._pool
+
+    def drain(self, dbname:str) -> bool:
+        return True
+
+    def is_database_exist(self, dbname:str) -> bool:
+        return dbname in self.databases
+
+    def insert_new_database(self, dbname:str):
+        self.databases.append(dbname)
+
+    def delete_database_entry(self, dbname:str):
+        self.databases.remove(dbname)
+
+    def select_databases(self) -> list:
+        return list(enumerate(self.databases))
+
+
+class TestBackupStatements(_BackupTestCase):
+    def _run(self, _session, key:str, sql:str) -> tuple:
+        frame = protocol.Frame(MSG_STATEMENT, 0, 1, STATUS_OK,
+            protocol.pack_fields(key, sql))
+        return list(_session.handle(frame))[-1]
+
+    def test_statements(self):
+        _session = session.BaseSession(_FakeServer(self.pool))
+        reply = self._run(_session, 'show-backups', "SHOW BACKUPS;")
+        self.assertIn("Empty set", reply[1])
+        reply = self._run(_session, 'backup-database',
+            "BACKUP DATABASE shop TO 'monday.db';")
+        self.assertEqual(reply[2], STATUS_OK)
+        self.assertIn("Database 'shop' backed up to 'monday.db'", reply[1])
+        reply = self._run(_session, 'restore-database',
+            "RESTORE DATABASE shop FROM 'monday.db';")
+        self.assertEqual(reply[2], STATUS_OK)
+        self.assertIn("Database 'shop' restored from 'monday.db'", reply[1])
+        reply = self._run(_session, 'show-backups', "SHOW BACKUPS;")
+        self.assertIn("100.0%", reply[1])
+        self.assertIn("restore", reply[1])
+        for key, sql, error in (
+                ('backup-database', "BACKUP DATABASE nope TO 'a.db';",
+                    ERROR['unknown-database'] % 'nope'),
+                ('backup-database', "BACKUP DATABASE shop TO '../a.db';",
+                    ERROR['invalid-backup-name'] % '../a.db'),
+                ('restore-database', "RESTORE DATABASE shop FROM 'a.db';",
+                    ERROR['unknown-backup'] % 'a.db')):
+            reply = self._run(_session, key, sql)
+            self.assertEqual(reply[2], STATUS_ERROR)
+            self.assertIn(error, reply[1])
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+    def test_failed_restore(self):
+        """A restore which fails creates no database."""
+        _session = session.BaseSession(_FakeServer(self.pool))
+        databases = self._run(_session, 'show-databases', "SHOW DATABASES;")
+        reply = self._run(_session, 'restore-database',
+            "RESTORE DATABASE ghost FROM 'nope.db';")
+        self.assertIn(ERROR['unknown-backup'] % 'nope.db', reply[1])
+        self.assertEqual(self._run(_session, 'show-databases',
+            "SHOW DATABASES;"), databases)
+        # Nor one which is cancelled
+        self._run(_session, 'backup-database',
+            "BACKUP DATABASE shop TO 'monday.db';")
+        frame = protocol.Frame(MSG_STATEMENT, 0, 1, STATUS_OK,
+            protocol.pack_fields('restore-database',
+                "RESTORE DATABASE ghost FROM 'monday.db';"))
+        reply = list(_session.handle(frame, lambda: True))[-1]
+        self.assertIn("Copy cancelled", reply[1])
+        self.assertEqual(_session.server.databases, ['shop'])
@@ -0,0 +1,123 @@
+"""This module tests the result cache (cache.py)
+"""
+
+import unittest
+import tempfile
+import os
+
+import cache
+import protocol
+import session
+import metrics
+import admission
+from pool import ConnectionPool
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestResultCache, TestSessionCache
+
+class TestResultCache(unittest.TestCase):
+    def test_normalize(self):
+        self.assertEqual(cache.normalize_sql("SELECT  *\n FROM t ;"),
+            "SELECT * FROM t")
+        # Quoted strings are left untouched
+        self.assertEqual(cache.normalize_sql("SELECT 'a  b',  \"c  d\";"),
+            "SELECT 'a  b', \"c  d\"")
+
+    def test_lru(self):
+        _cache = cache.ResultCache(max_bytes=10, max_entry_bytes=6)
+        _cache.put(('db', 'text', 'a', ()), cache.CachedResult(['xxxx'], 1,
+            frozenset(['t'])), 0)
+        _cache.put(('db', 'text', 'b', ()), cache.CachedResult(['xxxx'], 1,
+            frozenset(['t'])), 0)
+        self.assertIsNotNone(_cache.get(('db', 'text', 'a', ())))
+        _cache.put(('db', 'text', 'c', ()), cache.CachedResult(['xxxx'], 1,
+            frozenset(['u'])), 0)
+        # 'b' was the least recently used
+        self.assertIsNone(_cache.get(('db', 'text', 'b', ())))
+        self.assertEqual(_cache.stats()['evictions'], 1)
+        # Too big
+        _cache.put(('db', 'text', 'd', ()), cache.CachedResult(['x' * 7], 1,
+            frozenset(['u'])), 0)
+        self.assertIsNone(_cache.get(('db', 'text', 'd', ())))
+
+    def test_invalidation(self):
+        _cache = cache.ResultCache(max_bytes=100)
+        for name, table in (('a', 't'), ('b', 'u')):
+            _cache.put(('db', 'text', name, ()), cache.CachedResult(['x'], 1,
+                frozenset([table])), 0)
+        _cache.invalidate('db', {'t'})
+        self.assertIsNone(_cache.get(('db', 'text', 'a', ())))
+        self.assertIsNotNone(_cache.get(('db', 'text', 'b', ())))
+        # Results computed before an invalidation are not stored
+        _cache.put(('db', 'text', 'a', ()), cache.CachedResult(['x'], 1,
+            frozenset(['t'])), 0)
+        self.assertIsNone(_cache.get(('db', 'text', 'a', ())))
+        _cache.invalidate('db')
+        self.assertEqual(_cache.stats()['entries'], 0)
+
+
+class _FakeServer:
+    batch_size = 10
+    slow_log = None
+    writes = None
+    statement_timeout = None
+    max_result_size = 0
+
+    def __init__(self):
+        self.result_cache = cache.ResultCache(max_bytes=1024 * 1024)
+        self.metrics = metrics.Metrics()
+        self.queries = admission.QuerySlots()
+
+def _query(sql:str):
+    return protocol.Frame(MSG_QUERY, 0, 1, STATUS_OK, sql.encode())
+
+class TestSessionCache(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=DATABASE_EXT)
+        os.close(fd)
+        server = _FakeServer()
+        self.cache = server.result_cache
+        self.session = session.BaseSession(server)
+        self.session._old_dbname = 'test'
+        self.session._pool = ConnectionPool('test', self.path,
+            on_connect=self.cache.install)
+        for sql in ("CREATE TABLE t (x);", "CREATE TABLE u (y);",
+                "INSERT INTO t VALUES (1);", "INSERT INTO u VALUES (1);"):
+            self._run(sql)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _run(self, sql:str) -> str:
+        replies = list(self.session.handle(_query(sql)))
+        self.assertEqual(replies[-1][2], STATUS_OK, replies[-1][1])
+        return ''.join(str(reply[1]) for reply in replies)
+
+    def test_cache(self):
+        self.assertNotIn("cached", self._run("SELECT * FROM t;"))
+        self.assertIn("1 rows in set (cached)", self._run("SELECT  * FROM t"))
+        self._run("SELECT * FROM u;")
+        # Writing 't' only invalidates the results reading 't'
+        self._run("INSERT INTO t VALUES (2);")
+        self.assertIn("2 rows in set (0", self._run("SELECT * FROM t;"))
+        self.assertIn("(cached)", self._run("SELECT * FROM u;"))
+        # Again, with a compiled statement reused by the connection
+        self._run("INSERT INTO t VALUES (2);")
+        self.assertIn("3 rows in set (0", self._run("SELECT * FROM t;"))
+
+    def test_transaction(self):
+        self._run("SELECT * FROM t;")
+        self._run("BEGIN;")
+        self._run("INSERT INTO t VALUES (2);")
+        # Not served from the cache inside a transaction
+        self.assertIn("2 rows in set (0", self._run("SELECT * FROM t;"))
+        self._run("COMMIT;")
+        self.assertIn("2 rows in set (0", self._run("SELECT * FROM t;"))
+        self.assertIn("2 rows in set (cached)", self._run("SELECT * FROM t;"))
+
+    def test_schema_change(self):
+        self._run("SELECT * FROM u;")
+        self._run("DROP TABLE t;")
+        self.assertIn("1 rows in set (0", self._run("SELECT * FROM u;"))
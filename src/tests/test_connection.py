@@ -0,0 +1,133 @@
+"""This module tests the pipelined client API (connection.py)
+"""
+
+import unittest
+import asyncio
+import socket
+import threading
+
+import protocol
+import connection
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestSplitScript, TestConnection, TestAsyncConnection
+
+class _EchoServer(threading.Thread):
+    """Reads `expected` requests, then replies to them in reverse order
+    with one row chunk and the text of the request."""
+    def __init__(self, expected:int):
+        super().__init__(daemon=True)
+        self.expected = expected
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.msg_types = []
+
+    def run(self):
+        conn, address = self.sock.accept()
+        with conn:
+            channel = protocol.Channel(conn)
+            frame = channel.recv()
+            channel.send(MSG_LOGIN, b'', frame.request_id, STATUS_OK)
+            frames = [channel.recv() for i in range(self.expected)]
+            self.msg_types = [frame.msg_type for frame in frames]
+            for frame in reversed(frames):
+                channel.send(MSG_ROWS, b'row', frame.request_id)
+                channel.send(MSG_RESULT, frame.payload, frame.request_id)
+            channel.recv()
+        self.sock.close()
+
+
+class TestSplitScript(unittest.TestCase):
+    def test_split(self):
+        lines = ["-- comment\n", "USE db\n", "\n", "SELECT *\n",
+            "FROM t;\n", "INSERT INTO t VALUES ('a;b');\n"]
+        self.assertEqual(list(connection.split_script(lines)),
+            ["USE db", "SELECT *\nFROM t;", "INSERT INTO t VALUES ('a;b');"])
+
+
+class TestConnection(unittest.TestCase):
+    def test_pipelining(self):
+        server = _EchoServer(3)
+        server.start()
+        with connection.Connection('127.0.0.1', server.port) as conn:
+            conn.connect()
+            conn.login('user', 'password')
+            # All requests are sent before any reply comes back
+            futures = [conn.query("SELECT %d;" % i) for i in range(3)]
+            for i, future in enumerate(futures):
+                result = future.result(timeout=5)
+                self.assertEqual(result.message, "SELECT %d;" % i)
+                self.assertEqual(result.chunks, [b'row'])
+                self.assertTrue(result.ok)
+        server.join(5)
+
+    def test_connection_lost(self):
+        server = _EchoServer(0)
+        server.start()
+        with connection.Connection('127.0.0.1', server.port) as conn:
+            conn.connect()
+            conn.login('user', 'password')
+            # The server closes the connection without replying
+            future = conn.query("SELECT 1;")
+            with self.assertRaises(ConnectionError):
+                future.result(timeout=5)
+
+    def test_load_error(self):
+        """A row which cannot be sent ends the load and frees its slot."""
+        server = _EchoServer(3)
+        server.start()
+        with connection.Connection('127.0.0.1', server.port, 1) as conn:
+            conn.connect()
+            conn.login('user', 'password')
+            with self.assertRaises(protocol.ProtocolError):
+                conn.load("INSERT INTO t VALUES (?)", [(1,), (object(),)])
+            self.assertEqual(conn._pending, {})
+            # The only slot is free again
+            self.assertTrue(conn._slots.acquire(timeout=1))
+            conn._slots.release()
+            result = conn.query("SELECT 1;").result(timeout=5)
+            self.assertEqual(result.message, "SELECT 1;")
+        server.join(5)
+        self.assertEqual(server.msg_types, [MSG_LOAD, MSG_LOAD_END,
+            MSG_QUERY])
+
+
+class TestAsyncConnection(unittest.TestCase):
+    def test_pipelining(self):
+        server = _EchoServer(3)
+        server.start()
+
+        async def run():
+            async with connection.AsyncConnection('127.0.0.1',
+                    server.port) as conn:
+                await conn.connect()
+                await conn.login('user', 'password')
+                return await asyncio.gather(
+                    *(conn.query("SELECT %d;" % i) for i in range(3)))
+
+        results = asyncio.run(run())
+        self.assertEqual([result.message for result in results],
+            ["SELECT %d;" % i for i in range(3)])
+        server.join(5)
+
+    def test_send_error(self):
+        server = _EchoServer(1)
+        server.start()
+
+        def frames():
+            yield MSG_QUERY, b'SELECT 1;'
+            raise protocol.ProtocolError("Bad frame")
+
+        async def run():
+            async with connection.AsyncConnection('127.0.0.1',
+                    server.port) as conn:
+                await conn.connect()
+                await conn.login('user', 'password')
+                with self.assertRaises(protocol.ProtocolError):
+                    await conn.submit(frames())
+                self.assertEqual(conn._pending, {})
+
+        asyncio.run(run())
+        server.join(5)
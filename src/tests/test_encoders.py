@@ -0,0 +1,51 @@
+"""This module tests the result encodings (encoders.py)
+"""
+
+import unittest
+import json
+
+import encoders
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestEncoders,
+
+class TestEncoders(unittest.TestCase):
+    columns = ['id', 'name', 'score', 'data', 'nothing']
+    rows = [(1, 'ludo', 2.5, b'\x00\x01', None),
+            (2, None, 3, b'', None),
+            (-2**63, 'élève', None, None, None)]
+
+    def test_csv(self):
+        encoder = encoders.create_encoder('csv', self.columns)
+        self.assertEqual(encoder.encode(self.rows[:1]),
+            "id,name,score,data,nothing\n1,ludo,2.5,b'\\x00\\x01',\n")
+        # The header is only sent once
+        self.assertTrue(encoder.encode(self.rows[1:2]).startswith("2,"))
+
+    def test_ndjson(self):
+        encoder = encoders.create_encoder('ndjson', self.columns)
+        lines = encoder.encode(self.rows).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0]), {'id': 1, 'name': 'ludo',
+            'score': 2.5, 'data': 'AAE=', 'nothing': None})
+
+    def test_binary(self):
+        encoder = encoders.create_encoder('binary', self.columns)
+        columns, rows = encoders.decode_columnar(encoder.encode(self.rows))
+        self.assertEqual(columns, self.columns)
+        self.assertEqual(rows, self.rows)
+        self.assertIsInstance(rows[1][2], float)
+        # Columns mixing types are sent as text
+        columns, rows = encoders.decode_columnar(
+            encoders.create_encoder('binary', ['x']).encode([(1,), ('a',)]))
+        self.assertEqual(rows, [('1',), ('a',)])
+        # Empty chunk
+        columns, rows = encoders.decode_columnar(encoder.encode([]))
+        self.assertEqual(rows, [])
+        with self.assertRaises(encoders.EncodingError):
+            encoders.decode_columnar(encoder.encode(self.rows)[:-1])
+
+    def test_unknown(self):
+        with self.assertRaises(encoders.EncodingError):
+            encoders.create_encoder('xml', self.columns)
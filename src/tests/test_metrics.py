@@ -0,0 +1,59 @@
+"""This module tests the server metrics (metrics.py)
+"""
+
+import unittest
+import urllib.request
+
+import metrics
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestMetrics,
+
+class TestMetrics(unittest.TestCase):
+    def _metrics(self):
+        _metrics = metrics.Metrics()
+        _metrics.inc('requests')
+        _metrics.inc('requests', 2)
+        _metrics.add_gauge('active_sessions', 1)
+        _metrics.add_collector('pool', lambda: {'db': {'idle': 2}})
+        for value in (0.0002, 0.0002, 0.003, 0.2):
+            _metrics.observe('query_execute', value)
+        return _metrics
+
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+        for value in (0.0002, 0.0002, 0.003, 0.2):
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.quantile(0.5), 0.00025)
+        self.assertEqual(histogram.quantile(0.99), 0.25)
+        histogram.observe(100)
+        self.assertEqual(histogram.quantile(1), float('inf'))
+
+    def test_status_rows(self):
+        rows = dict(self._metrics().status_rows())
+        self.assertEqual(rows['requests'], 3)
+        self.assertEqual(rows['active_sessions'], 1)
+        self.assertEqual(rows['pool_db_idle'], 2)
+        self.assertEqual(rows['query_execute_count'], 4)
+        self.assertEqual(rows['query_execute_p50_ms'], 0.25)
+        self.assertEqual(rows['login_count'], 0)
+
+    def test_prometheus(self):
+        _metrics = self._metrics()
+        server = metrics.MetricsServer(_metrics, 0)
+        server.start()
+        try:
+            url = "http://%s:%d/metrics" % server.server_address
+            with urllib.request.urlopen(url, timeout=5) as response:
+                text = response.read().decode()
+        finally:
+            server.stop()
+        self.assertIn("fastdb_requests_total 3\n", text)
+        self.assertIn("fastdb_pool_db_idle 2\n", text)
+        self.assertIn('fastdb_query_execute_seconds_bucket{le="0.00025"} 2\n',
+            text)
+        self.assertIn('fastdb_query_execute_seconds_bucket{le="+Inf"} 4\n', text)
+        self.assertIn("fastdb_query_execute_seconds_count 4\n", text)
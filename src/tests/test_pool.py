@@ -0,0 +1,87 @@
+"""This module tests the connection pools (pool.py)
+"""
+
+import unittest
+import tempfile
+import sqlite3
+import os
+
+import pool
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestConnectionPool,
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=DATABASE_EXT)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_reuse(self):
+        _pool = pool.ConnectionPool('test', self.path, max_size=2)
+        conn = _pool.acquire()
+        _pool.release(conn)
+        self.assertIs(_pool.acquire(), conn)
+        self.assertEqual(_pool.stats()['created'], 1)
+        self.assertEqual(_pool.stats()['reused'], 1)
+
+    def test_max_size(self):
+        _pool = pool.ConnectionPool('test', self.path, max_size=1)
+        conn = _pool.acquire()
+        with self.assertRaises(sqlite3.OperationalError):
+            _pool.acquire(timeout=0.01)
+        _pool.release(conn)
+        self.assertIs(_pool.acquire(timeout=0.01), conn)
+
+    def test_open_transaction(self):
+        _pool = pool.ConnectionPool('test', self.path)
+        conn = _pool.acquire()
+        conn.execute("BEGIN")
+        conn.execute("CREATE TABLE t (x)")
+        _pool.release(conn)
+        # Released connections are rolled back
+        self.assertFalse(conn.in_transaction)
+        conn = _pool.acquire()
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute("SELECT * FROM t")
+
+    def test_idle_eviction(self):
+        _pool = pool.ConnectionPool('test', self.path, idle_timeout=0)
+        _pool.release(_pool.acquire())
+        _pool.evict_idle()
+        self.assertEqual(_pool.stats()['idle'], 0)
+        self.assertEqual(_pool.stats()['evicted'], 1)
+
+    def test_retune(self):
+        settings = {'synchronous': 0}
+        def on_connect(conn):
+            conn.execute("PRAGMA synchronous = %d" % settings['synchronous'])
+        _pool = pool.ConnectionPool('test', self.path, on_connect=on_connect)
+        idle, borrowed = _pool.acquire(), _pool.acquire()
+        _pool.release(idle)
+        self.assertEqual(borrowed.dbname, 'test')
+        settings['synchronous'] = 2
+        _pool.retune()
+        # Connections opened before are not given out again
+        _pool.release(borrowed)
+        self.assertEqual(_pool.stats()['idle'], 0)
+        conn = _pool.acquire()
+        self.assertIsNot(conn, idle)
+        self.assertIsNot(conn, borrowed)
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 2)
+        _pool.release(conn)
+
+    def test_drain(self):
+        _pool = pool.ConnectionPool('test', self.path)
+        conn = _pool.acquire()
+        self.assertFalse(_pool.drain(timeout=0.01))
+        with self.assertRaises(pool.PoolClosedError):
+            _pool.acquire()
+        _pool.release(conn)
+        self.assertEqual(_pool.stats()['in_use'], 0)
+        self.assertEqual(_pool.stats()['idle'], 0)
+        self.assertTrue(_pool.drain(timeout=0))
@@ -0,0 +1,170 @@
+"""This module tests the wire protocol (protocol.py)
+"""
+
+import unittest
+import socket
+import zlib
+import threading
+import asyncio
+
+import protocol
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestFields, TestChannel, TestAsyncChannel, TestCompression
+
+class TestFields(unittest.TestCase):
+    def test_fields(self):
+        fields = ['ludo', 'pa$$word', '', 'élève']
+        payload = protocol.pack_fields(*fields)
+        self.assertEqual(protocol.unpack_fields(payload), fields)
+        # A truncated payload must be rejected
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.unpack_fields(payload[:-1])
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.unpack_fields(protocol.pack_fields(b'\xff'))
+
+    def test_values(self):
+        values = [None, 0, -2**63, 2**63 - 1, 1.5, '', 'élève', b'\x00\xff']
+        payload = protocol.pack_execute(42, values)
+        self.assertEqual(protocol.unpack_execute(payload), (42, values))
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.unpack_execute(payload[:-1])
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.pack_values([2**64])
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.pack_values([object()])
+
+    def test_rows(self):
+        rows = [[1, 'a', None], [2, 'b', 2.5], []]
+        payload = protocol.pack_rows(rows)
+        self.assertEqual(protocol.unpack_rows(payload), rows)
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.unpack_rows(payload + b'x')
+
+
+class TestChannel(unittest.TestCase):
+    def test_channel(self):
+        left, right = socket.socketpair()
+        with left, right:
+            sender = protocol.Channel(left)
+            receiver = protocol.Channel(right)
+
+            sender.send(MSG_QUERY, "SELECT 1;", 7)
+            frame = receiver.recv()
+            self.assertEqual(frame.msg_type, MSG_QUERY)
+            self.assertEqual(frame.request_id, 7)
+            self.assertEqual(frame.status, STATUS_OK)
+            self.assertEqual(frame.payload, b"SELECT 1;")
+
+            # A payload much larger than the socket buffers
+            big = b'x' * (4 * 1024 * 1024)
+            thread = threading.Thread(target=sender.send,
+                args=(MSG_RESULT, big, 8, STATUS_ERROR))
+            thread.start()
+            frame = receiver.recv()
+            thread.join()
+            self.assertEqual(frame.status, STATUS_ERROR)
+            self.assertEqual(len(frame.payload), len(big))
+            self.assertEqual(frame.payload, big)
+
+            # End of stream
+            left.close()
+            self.assertIsNone(receiver.recv())
+
+    def test_buffered(self):
+        left, right = socket.socketpair()
+        with left, right:
+            receiver = protocol.Channel(right)
+            # Frames received by a single system call, then one straddling
+            # the end of the receive buffer, then one larger than it
+            sizes = [0, 10, 100, RECV_BUFFER_SIZE - 200, 300,
+                RECV_BUFFER_SIZE * 3]
+            data = b''.join(protocol.HEADER.pack(size, MSG_ROWS, 0, i, 0) +
+                bytes([i]) * size for i, size in enumerate(sizes))
+            thread = threading.Thread(target=left.sendall, args=(data,))
+            thread.start()
+            frame = receiver.recv()
+            self.assertEqual(frame.payload, b'')
+            self.assertTrue(receiver.buffered)
+            for i, size in enumerate(sizes[1:], 1):
+                frame = receiver.recv()
+                self.assertEqual(frame.request_id, i)
+                self.assertEqual(frame.payload, bytes([i]) * size)
+            thread.join()
+            self.assertFalse(receiver.buffered)
+            self.assertEqual(receiver.bytes_received, len(data))
+
+            # Truncated frame
+            left.sendall(protocol.HEADER.pack(10, MSG_ROWS, 0, 1, 0) + b'abc')
+            left.close()
+            with self.assertRaises(protocol.ProtocolError):
+                receiver.recv()
+            receiver.close()
+
+    def test_buffer_pool(self):
+        pool = protocol.BufferPool(16, max_buffers=1)
+        left, right = socket.socketpair()
+        with left, right:
+            channel = protocol.Channel(left, pool)
+            buffer = channel._buffer
+            channel.close()
+            self.assertIs(pool.acquire(), buffer)
+            self.assertEqual(len(pool.acquire()), 16)
+
+
+class TestAsyncChannel(unittest.TestCase):
+    def test_async_channel(self):
+        async def exchange():
+            left, right = socket.socketpair()
+            sender = protocol.AsyncChannel(*await asyncio.open_connection(sock=left))
+            receiver = protocol.AsyncChannel(*await asyncio.open_connection(sock=right))
+            await sender.send(MSG_STATEMENT, protocol.pack_fields('a', 'b'), 3)
+            frame = await receiver.recv()
+            await sender.close()
+            eof = await receiver.recv()
+            await receiver.close()
+            return frame, eof
+
+        frame, eof = asyncio.run(exchange())
+        self.assertEqual(frame.msg_type, MSG_STATEMENT)
+        self.assertEqual(frame.request_id, 3)
+        self.assertEqual(protocol.unpack_fields(frame.payload), ['a', 'b'])
+        self.assertIsNone(eof)
+
+
+class TestCompression(unittest.TestCase):
+    def test_choose(self):
+        self.assertEqual(protocol.choose_compression('lzma,zlib'), 'lzma')
+        self.assertEqual(protocol.choose_compression('lz4, ZLIB'), 'zlib')
+        self.assertEqual(protocol.choose_compression('zlib', ('lzma',)), '')
+        self.assertEqual(protocol.choose_compression(''), '')
+
+    def test_channel(self):
+        table = ("| 1 | abc" + " " * 100 + "|\n") * 1000
+        for method in protocol.COMPRESSION_FLAGS:
+            left, right = socket.socketpair()
+            with left, right:
+                sender = protocol.Channel(left)
+                sender.compression = protocol.Compression(method)
+                receiver = protocol.Channel(right)
+                thread = threading.Thread(target=sender.send,
+                    args=(MSG_ROWS, table, 1))
+                thread.start()
+                frame = receiver.recv()
+                thread.join()
+                self.assertEqual(frame.flags, protocol.COMPRESSION_FLAGS[method])
+                self.assertEqual(frame.payload.decode(), table)
+                # Small payloads are sent as they are
+                sender.send(MSG_RESULT, "done", 1)
+                frame = receiver.recv()
+                self.assertEqual(frame.flags, 0)
+                self.assertEqual(frame.payload, b"done")
+
+    def test_invalid(self):
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decompress(protocol.FLAG_ZLIB, b'not zlib')
+        truncated = zlib.compress(b'x' * 10000)[:-4]
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decompress(protocol.FLAG_ZLIB, truncated)
@@ -0,0 +1,44 @@
+"""This module tests the statement router (router.py)
+"""
+
+import unittest
+import re
+
+import router
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestStatementRouter,
+
+class TestStatementRouter(unittest.TestCase):
+    entries = ["SHOW DATABASES;", "show  databases ;", "USE tweets", "use a;",
+        "CREATE DATABASE tweets;", "DROP DATABASE tweets;", "DROP TABLE t;",
+        "ADD USER ludo PASSWORD secret;", "DELETE USER ludo;",
+        "DELETE FROM users;", "SET FORMAT csv;", "SELECT 1;", "", "  USE a;",
+        "SHOW CACHE;", "SHOW TABLES;", "USE"]
+
+    def test_same_as_scan(self):
+        """The router finds what trying every pattern finds."""
+        for entry in self.entries:
+            expected = None
+            for key, pattern in STATEMENTS.items():
+                if re.fullmatch(pattern, entry, re.IGNORECASE | re.VERBOSE):
+                    expected = key
+                    break
+            self.assertEqual(router.statements.match(entry)[0], expected, entry)
+
+    def test_groups(self):
+        key, match = router.statements.match("ADD USER ludo PASSWORD secret;")
+        self.assertEqual(key, 'add-user')
+        self.assertEqual(match.group('username'), 'ludo')
+        self.assertEqual(router.statements.match_key('use-database',
+            'USE tweets;').group('dbname'), 'tweets')
+        self.assertIsNone(router.statements.match_key('use-database', 'SELECT 1;'))
+        self.assertIsNone(router.statements.match_key('unknown', 'USE tweets;'))
+
+    def test_client_statements(self):
+        key, match = router.client_statements.match(
+            "LOAD DATA 'a.csv' INTO TABLE t IGNORE 1 LINES;")
+        self.assertEqual(key, 'load-data')
+        self.assertEqual(match.group('path'), 'a.csv')
@@ -3,8 +3,12 @@
 
 import unittest
 import os
+import socket
+import threading
+import time
 
 import server
+import connection
 
 def get_tests() -> tuple:
     return TestServer,
@@ -34,6 +38,22 @@ class TestServer(unittest.TestCase):
         # Check if 'tweet' table exists
         self.assertFalse(_server.is_database_exist('tweet'))
 
+        # Metadata changes are seen at once and written to the database
+        _server.insert_new_user('ludo', 'ludo')
+        _server.insert_new_database('tweet')
+        self.assertTrue(_server.is_user_exist('ludo', 'ludo'))
+        self.assertFalse(_server.is_user_exist('ludo', 'oops'))
+        self.assertTrue(_server.is_database_exist('tweet'))
+        self.assertEqual([row[1] for row in _server.select_databases()],
+            ['fastdb_info', 'tweet'])
+        _server.metadata.load()
+        self.assertTrue(_server.is_user_exist('ludo', 'ludo'))
+        self.assertTrue(_server.is_database_exist('tweet'))
+        _server.delete_user('ludo')
+        _server.delete_database_entry('tweet')
+        self.assertFalse(_server.is_user_exist('ludo', 'ludo'))
+        self.assertFalse(_server.is_database_exist('tweet'))
+
         # Close database connection
         _server.close_db_connection()
         self.assertIsNone(_server.db_conn)
@@ -58,3 +78,125 @@ class TestServer(unittest.TestCase):
         self.assertIsNotNone(_server.socket)
         _server.close_socket()
         self.assertIsNone(_server.socket)
+
+    def test_shutdown(self):
+        """run() returns once shutdown() is called."""
+        for mode in server.SERVER_MODES:
+            _server = server.FDB_Server('127.0.0.1', 0, mode)
+            if os.path.exists(server.SERVER_DATABASE):
+                os.remove(os.path.realpath(server.SERVER_DATABASE))
+            _server.create_tables()
+            _server.close_db_connection()
+            thread = threading.Thread(target=_server.run)
+            thread.start()
+            try:
+                # Wait until a client can connect
+                deadline = time.monotonic() + 5
+                while True:
+                    try:
+                        address = _server.socket.getsockname()
+                        socket.create_connection(address, timeout=1).close()
+                        break
+                    except (AttributeError, OSError):
+                        if time.monotonic() > deadline:
+                            raise
+                        time.sleep(0.01)
+            finally:
+                _server.shutdown()
+                thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertIsNone(_server.socket)
+
+    def test_processes(self):
+        """Metadata changes made by a process are seen by the others."""
+        for mode in server.SERVER_MODES:
+            _server = server.FDB_Server('127.0.0.1', 0, mode, processes=2)
+            if os.path.exists(server.SERVER_DATABASE):
+                os.remove(os.path.realpath(server.SERVER_DATABASE))
+            _server.create_tables()
+            _server.insert_new_user('ludo', 'ludo')
+            _server.close_db_connection()
+            thread = threading.Thread(target=_server.run)
+            thread.start()
+            try:
+                self.assertTrue(_server.ready.wait(10))
+                port = _server.socket.getsockname()[1]
+                conns = [connection.Connection('127.0.0.1', port)
+                    for i in range(6)]
+                for conn in conns:
+                    conn.connect()
+                    conn.login('ludo', 'ludo')
+                result = conns[0].query("CREATE DATABASE shared;").result()
+                self.assertTrue(result.ok)
+                conns[0].query("ADD USER other PASSWORD other;").result()
+                for conn in conns:
+                    self.assertTrue(conn.query("USE shared;").result().ok)
+                    conn.close()
+                # Connections are spread over the processes, and so are
+                # the logins with a session token
+                for i in range(6):
+                    with connection.Connection('127.0.0.1', port) as conn:
+                        conn.connect()
+                        conn.login('other', 'other')
+                        token = conn.token
+                for i in range(6):
+                    with connection.Connection('127.0.0.1', port) as conn:
+                        conn.connect()
+                        conn.login('other', token=token)
+                        self.assertTrue(conn.query("SHOW DATABASES;")
+                            .result().ok)
+                with connection.Connection('127.0.0.1', port) as conn:
+                    conn.connect()
+                    conn.login('ludo', 'ludo')
+                    conn.query("DELETE USER other;").result()
+                    conn.query("DROP DATABASE shared;").result()
+                for i in range(6):
+                    with connection.Connection('127.0.0.1', port) as conn:
+                        conn.connect()
+                        with self.assertRaises(connection.LoginError):
+                            conn.login('other', 'other')
+                    with connection.Connection('127.0.0.1', port) as conn:
+                        conn.connect()
+                        with self.assertRaises(connection.LoginError):
+                            conn.login('other', token=token)
+            finally:
+                _server.shutdown()
+                thread.join(10)
+            self.assertFalse(thread.is_alive())
+
+    def test_max_connections(self):
+        """Connections beyond max_connections wait for a session to end."""
+        for mode in server.SERVER_MODES:
+            _server = server.FDB_Server('127.0.0.1', 0, mode,
+                max_connections=1)
+            if os.path.exists(server.SERVER_DATABASE):
+                os.remove(os.path.realpath(server.SERVER_DATABASE))
+            _server.create_tables()
+            _server.insert_new_user('ludo', 'ludo')
+            _server.close_db_connection()
+            thread = threading.Thread(target=_server.run)
+            thread.start()
+            try:
+                self.assertTrue(_server.ready.wait(10))
+                port = _server.socket.getsockname()[1]
+                first = connection.Connection('127.0.0.1', port)
+                first.connect()
+                first.login('ludo', 'ludo')
+                second = connection.Connection('127.0.0.1', port)
+                second.connect()
+                waiting = threading.Thread(target=second.login,
+                    args=('ludo', 'ludo'))
+                waiting.start()
+                waiting.join(0.3)
+                self.assertTrue(waiting.is_alive())
+                self.assertEqual(_server.metrics.snapshot()['gauges']
+                    ['admission_waiting'], 1)
+                first.close()
+                waiting.join(5)
+                self.assertFalse(waiting.is_alive())
+                self.assertTrue(second.query("SHOW DATABASES;").result().ok)
+                second.close()
+            finally:
+                _server.shutdown()
+                thread.join(10)
+            self.assertFalse(thread.is_alive())
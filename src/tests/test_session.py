@@ -0,0 +1,487 @@
+"""This module tests the session manager (session.py)
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+
+import protocol
+import session
+import prepared
+import metrics
+import admission
+import slowlog
+import writes
+import cursors
+from pool import ConnectionPool
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestStreaming, TestPreparedStatements, TestBulkLoad, TestProfiling, \
+        TestWrites, TestCursors, TestLimits, TestDropDatabase
+
+class _FakeServer:
+    batch_size = 10
+    slow_log = None
+    writes = None
+    statement_timeout = None
+    max_result_size = 0
+    result_cache = None
+
+    def __init__(self):
+        self.metrics = metrics.Metrics()
+        self.queries = admission.QuerySlots()
+        self.cursors = cursors.CursorManager(self.metrics, max_per_session=2)
+
+def _query(sql:str, request_id=1):
+    return protocol.Frame(MSG_QUERY, 0, request_id, STATUS_OK, sql.encode())
+
+def _statement(key:str, sql:str):
+    return protocol.Frame(MSG_STATEMENT, 0, 1, STATUS_OK,
+        protocol.pack_fields(key, sql))
+
+class _SessionTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=DATABASE_EXT)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _create_session(self):
+        _session = session.BaseSession(_FakeServer())
+        _session._pool = ConnectionPool('test', self.path)
+        conn = _session._acquire()
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.executemany("INSERT INTO t VALUES (?)", [(i,) for i in range(25)])
+        _session._release(conn)
+        return _session
+
+
+class TestStreaming(_SessionTestCase):
+    def test_chunks(self):
+        _session = self._create_session()
+        replies = list(_session.handle(_query("SELECT * FROM t;")))
+        self.assertEqual([r[0] for r in replies],
+            [MSG_ROWS, MSG_ROWS, MSG_ROWS, MSG_RESULT])
+        self.assertIn("25 rows in set", replies[-1][1])
+        self.assertEqual(replies[-1][2], STATUS_OK)
+        rows = dict(_session.server.metrics.status_rows())
+        self.assertEqual(rows['query_execute_count'], 1)
+        self.assertEqual(rows['query_render_count'], 1)
+
+    def test_cancel(self):
+        _session = self._create_session()
+        replies = list(_session.handle(_query("SELECT * FROM t;"),
+            lambda: True))
+        self.assertEqual([r[0] for r in replies], [MSG_ROWS, MSG_RESULT])
+        self.assertIn(SUCCESS['query-cancelled'] % 10, replies[-1][1])
+
+    def test_error(self):
+        _session = self._create_session()
+        replies = list(_session.handle(_query("SELECT * FROM nope;")))
+        self.assertEqual(len(replies), 1)
+        self.assertEqual(replies[0][0], MSG_RESULT)
+        self.assertEqual(replies[0][2], STATUS_ERROR)
+        # Invalid UTF-8 gets an error reply, the session goes on
+        for msg_type, payload in ((MSG_QUERY, b'SELECT \xff;'),
+                (MSG_PREPARE, b'SELECT \xff;'),
+                (MSG_STATEMENT, protocol.pack_fields(b'\xff', b'x'))):
+            replies = list(_session.handle(protocol.Frame(msg_type, 0, 1,
+                STATUS_OK, payload)))
+            self.assertEqual(replies[-1][2], STATUS_ERROR)
+            self.assertIn("Invalid UTF-8", replies[-1][1])
+        # Statement frames hold a key and a statement
+        for fields in ((), ('show-status',), ('show-status', 'x', 'y')):
+            replies = list(_session.handle(protocol.Frame(MSG_STATEMENT, 0,
+                1, STATUS_OK, protocol.pack_fields(*fields))))
+            self.assertEqual(replies[-1][2], STATUS_ERROR)
+            self.assertIn("Invalid statement frame", replies[-1][1])
+        replies = list(_session.handle(_query("SELECT * FROM t;")))
+        self.assertIn("25 rows in set", replies[-1][1])
+
+    def test_transaction(self):
+        _session = self._create_session()
+        list(_session.handle(_query("BEGIN;")))
+        # The connection stays with the session until the end of the
+        # transaction
+        self.assertIsNotNone(_session.db_conn)
+        list(_session.handle(_query("DELETE FROM t;")))
+        list(_session.handle(_query("ROLLBACK;")))
+        self.assertIsNone(_session.db_conn)
+        replies = list(_session.handle(_query("SELECT * FROM t;")))
+        self.assertIn("25 rows in set", replies[-1][1])
+
+
+class TestPreparedStatements(_SessionTestCase):
+    def _prepare(self, _session, sql:str) -> tuple:
+        frame = protocol.Frame(MSG_PREPARE, 0, 1, STATUS_OK, sql.encode())
+        (msg_type, payload, status), = _session.handle(frame)
+        self.assertEqual(msg_type, MSG_PREPARED)
+        return protocol.PREPARED.unpack(payload)
+
+    def _execute(self, _session, statement_id:int, params) -> list:
+        frame = protocol.Frame(MSG_EXECUTE, 0, 1, STATUS_OK,
+            protocol.pack_execute(statement_id, params))
+        return list(_session.handle(frame))
+
+    def test_prepare(self):
+        _session = self._create_session()
+        sql = "INSERT INTO t VALUES (?)"
+        statement_id, nb_params = self._prepare(_session, sql)
+        self.assertEqual(nb_params, 1)
+        # Same text, same statement
+        self.assertEqual(self._prepare(_session, sql), (statement_id, 1))
+        self.assertEqual(_session._statements.stats(),
+            {'size': 1, 'hits': 1, 'misses': 1})
+        for value in range(100, 105):
+            replies = self._execute(_session, statement_id, [value])
+            self.assertEqual(replies[-1][2], STATUS_OK)
+
+        statement_id, nb_params = self._prepare(_session,
+            "SELECT * FROM t WHERE x >= ?")
+        replies = self._execute(_session, statement_id, [100])
+        self.assertIn("5 rows in set", replies[-1][1])
+
+    def test_errors(self):
+        _session = self._create_session()
+        replies = self._execute(_session, 1234, [])
+        self.assertEqual(replies[-1][2], STATUS_ERROR)
+        statement_id, nb_params = self._prepare(_session,
+            "SELECT * FROM t WHERE x = ?")
+        replies = self._execute(_session, statement_id, [])
+        self.assertEqual(replies[-1][2], STATUS_ERROR)
+        frame = protocol.Frame(MSG_PREPARE, 0, 1, STATUS_OK, b"SELECT * FROM nope")
+        (msg_type, payload, status), = _session.handle(frame)
+        self.assertEqual(status, STATUS_ERROR)
+
+    def test_eviction(self):
+        _session = self._create_session()
+        _session._statements = prepared.StatementCache(max_size=1)
+        first, nb_params = self._prepare(_session, "SELECT 1")
+        self._prepare(_session, "SELECT 2")
+        replies = self._execute(_session, first, [])
+        self.assertIn(ERROR['unknown-statement'] % first, replies[-1][1])
+
+    def test_is_select(self):
+        """A SELECT is streamed the same way, prepared or not."""
+        _session = self._create_session()
+        sql = "\n  select * FROM t WHERE x >= 20"
+        replies = list(_session.handle(_query(sql + ";")))
+        statement_id, nb_params = self._prepare(_session, sql)
+        self.assertEqual([r[0] for r in replies],
+            [r[0] for r in self._execute(_session, statement_id, [])])
+        self.assertEqual([r[0] for r in replies], [MSG_ROWS, MSG_RESULT])
+        self.assertIn("5 rows in set", replies[-1][1])
+        self.assertFalse(prepared.is_select("SELECTED"))
+
+    def test_parameters(self):
+        for sql, nb_params in (("SELECT ?3, ?", 4),
+                ("SELECT '?''?', \"?\", [?] -- ?", 0),
+                ("SELECT :a, :a, @b /* ? */", 2)):
+            self.assertEqual(prepared.parameters(sql), nb_params)
+        _session = self._create_session()
+        statement_id, nb_params = self._prepare(_session,
+            "EXPLAIN SELECT * FROM t WHERE x >= ?")
+        self.assertEqual(nb_params, 1)
+        replies = self._execute(_session, statement_id, [100])
+        self.assertEqual(replies[-1][2], STATUS_OK)
+
+
+class TestBulkLoad(_SessionTestCase):
+    def _load(self, _session, sql:str, batches:list, commit_batch_size=0):
+        frames = [protocol.Frame(MSG_LOAD, 0, 1, STATUS_OK,
+            protocol.pack_fields(sql, commit_batch_size))]
+        for batch in batches:
+            frames.append(protocol.Frame(MSG_LOAD_ROWS, 0, 1, STATUS_OK,
+                protocol.pack_rows(batch)))
+        frames.append(protocol.Frame(MSG_LOAD_END, 0, 1, STATUS_OK, b''))
+        replies = []
+        for frame in frames:
+            replies.extend(_session.handle(frame))
+        # Only the end of the load gets a reply
+        self.assertEqual(len(replies), 1)
+        return replies[0]
+
+    def _count(self, _session) -> str:
+        return list(_session.handle(_query("SELECT count(*) FROM t;")))[0][1]
+
+    def test_load(self):
+        _session = self._create_session()
+        batches = [[[i] for i in range(j, j + 10)] for j in range(100, 200, 10)]
+        msg_type, message, status = self._load(_session,
+            "INSERT INTO t VALUES (?)", batches, commit_batch_size=25)
+        self.assertEqual(status, STATUS_OK)
+        self.assertIn("100 rows loaded", message)
+        self.assertIn("| 125 |", self._count(_session))
+        self.assertIsNone(_session.db_conn)
+
+    def test_errors(self):
+        _session = self._create_session()
+        conn = _session._acquire()
+        conn.execute("CREATE UNIQUE INDEX tx ON t (x)")
+        _session._release(conn)
+        # The second batch fails: the first one is committed
+        msg_type, message, status = self._load(_session,
+            "INSERT INTO t VALUES (?)", [[[100]], [[101], [0]], [[102]]],
+            commit_batch_size=1)
+        self.assertEqual(status, STATUS_ERROR)
+        self.assertIn("(1 rows loaded)", message)
+        self.assertIn("| 26 |", self._count(_session))
+        msg_type, message, status = self._load(_session, "INSERT INTO nope "
+            "VALUES (?)", [[[1]]])
+        self.assertEqual(status, STATUS_ERROR)
+        self.assertIn("no such table", message)
+
+
+class TestProfiling(_SessionTestCase):
+    def _statement(self, _session, stmt:str) -> str:
+        key = 'profile'
+        frame = protocol.Frame(MSG_STATEMENT, 0, 1, STATUS_OK,
+            protocol.pack_fields(key, stmt))
+        return list(_session.handle(frame))[-1][1]
+
+    def test_profile(self):
+        _session = self._create_session()
+        self.assertIn(SUCCESS['profile-changed'] % 'ON',
+            self._statement(_session, "PROFILE ON;"))
+        message = list(_session.handle(_query("SELECT * FROM t;")))[-1][1]
+        for phase in slowlog.PHASES:
+            self.assertIn(phase.capitalize() + ": ", message)
+        self._statement(_session, "PROFILE OFF;")
+        message = list(_session.handle(_query("SELECT * FROM t;")))[-1][1]
+        self.assertNotIn("Execute: ", message)
+
+    def test_slow_log(self):
+        _session = self._create_session()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            _session.server.slow_log = slowlog.SlowQueryLog(0, path)
+            _session.server.slow_log.start()
+            _session._username = 'ludo'
+            list(_session.handle(_query("SELECT * FROM t WHERE x > 3;")))
+            _session.server.slow_log.close()
+            with open(path, encoding="utf-8") as _file:
+                record = _file.read()
+        finally:
+            os.remove(path)
+        self.assertIn("User: ludo", record)
+        self.assertIn("Rows: 21", record)
+        self.assertIn("# Plan: SCAN t", record)
+        self.assertTrue(record.endswith("SELECT * FROM t WHERE x > 3;\n"))
+
+
+class TestWrites(_SessionTestCase):
+    def test_write_queue(self):
+        _session = self._create_session()
+        _session.server.writes = writes.WriteManager(_session.server.metrics)
+        try:
+            replies = list(_session.handle(_query("DELETE FROM t WHERE x < 5;")))
+            self.assertIn("Query done", replies[-1][1])
+            replies = list(_session.handle(_query("INSERT INTO t VALUES ('a', 'b');")))
+            self.assertEqual(replies[-1][2], STATUS_ERROR)
+            # Writes in a transaction stay on the connection of the session
+            list(_session.handle(_query("BEGIN;")))
+            list(_session.handle(_query("DELETE FROM t;")))
+            list(_session.handle(_query("ROLLBACK;")))
+            replies = list(_session.handle(_query("SELECT * FROM t;")))
+            self.assertIn("20 rows in set", replies[-1][1])
+            stats = _session.server.writes.stats()['test']
+            self.assertEqual((stats['writes'], stats['failed']), (1, 1))
+        finally:
+            _session.server.writes.close_all()
+
+
+class TestCursors(_SessionTestCase):
+    def _run(self, _session, key:str, sql:str) -> list:
+        return list(_session.handle(_statement(key, sql)))
+
+    def test_fetch(self):
+        _session = self._create_session()
+        _session._output_format = 'csv'
+        cursors = _session.server.cursors
+        replies = self._run(_session, 'declare-cursor',
+            "DECLARE c CURSOR FOR SELECT x FROM t ORDER BY x;")
+        self.assertIn(SUCCESS['cursor-declared'] % 'c', replies[-1][1])
+        # 12 rows: chunks of batch_size rows
+        replies = self._run(_session, 'fetch-cursor', "FETCH NEXT 12 FROM c;")
+        self.assertEqual([r[0] for r in replies], [MSG_ROWS, MSG_ROWS,
+            MSG_RESULT])
+        self.assertIn("12 rows fetched", replies[-1][1])
+        self.assertNotIn(SUCCESS['cursor-end'] % 'c', replies[-1][1])
+        # Going on where the last one stopped
+        replies = self._run(_session, 'fetch-cursor', "FETCH 20 FROM c;")
+        rows = ''.join(r[1] for r in replies[:-1]).split()
+        self.assertEqual(rows[1:], [str(x) for x in range(12, 25)])
+        self.assertIn(SUCCESS['cursor-end'] % 'c', replies[-1][1])
+        self.assertEqual(cursors.get(_session, 'c').nb_rows, 25)
+
+        replies = self._run(_session, 'show-cursors', "SHOW CURSORS;")
+        self.assertIn("end", replies[-1][1])
+        replies = self._run(_session, 'close-cursor', "CLOSE c;")
+        self.assertIn(SUCCESS['cursor-closed'] % 'c', replies[-1][1])
+        self.assertEqual(cursors.stats(), {'open': 0, 'sessions': 0})
+        self.assertEqual(_session._pool.stats()['in_use'], 0)
+
+    def test_errors(self):
+        _session = self._create_session()
+        for key, sql, error in (
+                ('fetch-cursor', "FETCH FROM c;", ERROR['unknown-cursor'] % 'c'),
+                ('close-cursor', "CLOSE c;", ERROR['unknown-cursor'] % 'c'),
+                ('declare-cursor', "DECLARE c CURSOR FOR DELETE FROM t;",
+                    ERROR['cursor-not-select']),
+                ('declare-cursor', "DECLARE c CURSOR FOR SELECT * FROM nope;",
+                    "no such table")):
+            replies = self._run(_session, key, sql)
+            self.assertEqual(replies[-1][2], STATUS_ERROR)
+            self.assertIn(error, replies[-1][1])
+        for name in ('a', 'b'):
+            self._run(_session, 'declare-cursor',
+                "DECLARE %s CURSOR FOR SELECT * FROM t;" % name)
+        replies = self._run(_session, 'declare-cursor',
+            "DECLARE a CURSOR FOR SELECT * FROM t;")
+        self.assertIn(ERROR['cursor-exists'] % 'a', replies[-1][1])
+        replies = self._run(_session, 'declare-cursor',
+            "DECLARE c CURSOR FOR SELECT * FROM t;")
+        self.assertIn(ERROR['too-many-cursors'] % 2, replies[-1][1])
+        _session.server.cursors.close_session(_session)
+        self.assertEqual(_session._pool.stats()['in_use'], 0)
+
+    def test_pool(self):
+        """A session holding all its cursors does not use up the pool."""
+        _session = self._create_session()
+        _session.server.cursors = cursors.CursorManager(
+            _session.server.metrics)
+        other = session.BaseSession(_session.server)
+        other._pool = _session._pool
+        for i in range(MAX_SESSION_CURSORS):
+            replies = self._run(_session, 'declare-cursor',
+                "DECLARE c%d CURSOR FOR SELECT * FROM t;" % i)
+            self.assertEqual(replies[-1][2], STATUS_OK)
+        # As many cursors as the pool has connections, none borrowed
+        self.assertGreaterEqual(MAX_SESSION_CURSORS, POOL_MAX_SIZE)
+        self.assertEqual(_session._pool.stats()['in_use'], 0)
+        for each in (other, _session):
+            replies = list(each.handle(_query("SELECT * FROM t;")))
+            self.assertIn("25 rows in set", replies[-1][1])
+        _session.server.cursors.close_session(_session)
+
+    def test_reap(self):
+        _session = self._create_session()
+        manager = cursors.CursorManager(_session.server.metrics,
+            idle_timeout=0)
+        _session.server.cursors = manager
+        self._run(_session, 'declare-cursor',
+            "DECLARE c CURSOR FOR SELECT * FROM t;")
+        manager._last_sweep -= SHUTDOWN_POLL_INTERVAL
+        self.assertEqual(manager.reap(), 1)
+        replies = self._run(_session, 'fetch-cursor', "FETCH FROM c;")
+        self.assertIn(ERROR['unknown-cursor'] % 'c', replies[-1][1])
+        self.assertEqual(_session._pool.stats()['in_use'], 0)
+        self.assertEqual(dict(_session.server.metrics.status_rows())
+            ['cursors_reaped'], 1)
+
+
+class TestLimits(_SessionTestCase):
+    def test_result_size(self):
+        _session = self._create_session()
+        _session._output_format = 'csv'
+        _session.server.max_result_size = 40
+        try:
+            replies = list(_session.handle(_query("SELECT * FROM t;")))
+            # The first chunk only fits
+            self.assertEqual([r[0] for r in replies], [MSG_ROWS, MSG_RESULT])
+            self.assertEqual(replies[-1][2], STATUS_ERROR)
+            self.assertIn(ERROR['result-too-large'] % (40, 10),
+                replies[-1][1])
+        finally:
+            _session.server.max_result_size = 0
+
+    def test_user_queries(self):
+        _session = self._create_session()
+        _session._username = 'ludo'
+        _session.server.queries = admission.QuerySlots(1)
+        # Another session of the user runs a query
+        _session.server.queries.acquire('ludo')
+        replies = list(_session.handle(_query("SELECT * FROM t;")))
+        self.assertIn(ERROR['too-many-queries'] % ('ludo', 1), replies[-1][1])
+        _session.server.queries.release('ludo')
+        replies = list(_session.handle(_query("SELECT * FROM t;")))
+        self.assertEqual(replies[-1][2], STATUS_OK)
+        self.assertEqual(_session.server.queries.stats(),
+            {'running': 0, 'rejected': 1})
+
+    def test_statement_timeout(self):
+        _session = self._create_session()
+        _session.server.statement_timeout = 0.05
+        try:
+            replies = list(_session.handle(_query("WITH RECURSIVE n(x) AS "
+                "(SELECT 1 UNION ALL SELECT x + 1 FROM n) "
+                "SELECT count(*) FROM n;")))
+            self.assertEqual(replies[-1][2], STATUS_ERROR)
+            self.assertIn(ERROR['statement-timeout'] % 0.05, replies[-1][1])
+            # The connection is still usable
+            replies = list(_session.handle(_query("SELECT * FROM t;")))
+            self.assertIn("25 rows in set", replies[-1][1])
+        finally:
+            _session.server.statement_timeout = None
+
+
+class _DropServer(_FakeServer):
+    """Server of a database being dropped, whose pool drains or not."""
+    def __init__(self, drained:bool):
+        super().__init__()
+        self.pools = self
+        self.dropped = []
+        self._drained = drained
+
+    def is_database_exist(self, dbname:str) -> bool:
+        return dbname not in self.dropped
+
+    def delete_database_entry(self, dbname:str):
+        self.dropped.append(dbname)
+
+    def drain(self, dbname:str) -> bool:
+        return self._drained
+
+
+class TestDropDatabase(unittest.TestCase):
+    def setUp(self):
+        os.makedirs(DATABASES_DIR, exist_ok=True)
+        self.path = DATABASES_DIR + 'fastdb_drop_test' + DATABASE_EXT
+        open(self.path, 'w').close()
+
+    def tearDown(self):
+        for path in (self.path, self.path + '-shm'):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def _drop(self, server) -> tuple:
+        _session = session.BaseSession(server)
+        return list(_session.handle(_statement('drop-database',
+            "DROP DATABASE fastdb_drop_test;")))[-1]
+
+    def test_in_use(self):
+        """Files still used by a connection are kept."""
+        reply = self._drop(_DropServer(False))
+        self.assertEqual(reply[2], STATUS_ERROR)
+        self.assertIn(ERROR['database-in-use'] % 'fastdb_drop_test',
+            reply[1])
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_remove_error(self):
+        os.mkdir(self.path + '-shm')
+        server = _DropServer(True)
+        reply = self._drop(server)
+        self.assertEqual(reply[2], STATUS_ERROR)
+        self.assertIn("Cannot remove the files", reply[1])
+        self.assertEqual(server.dropped, ['fastdb_drop_test'])
+        os.rmdir(self.path + '-shm')
+        reply = self._drop(_DropServer(True))
+        self.assertEqual(reply[2], STATUS_OK)
+        self.assertFalse(os.path.exists(self.path))
@@ -0,0 +1,46 @@
+"""This module tests the slow query log (slowlog.py)
+"""
+
+import unittest
+import tempfile
+import json
+import os
+
+import slowlog
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestSlowQueryLog,
+
+class TestSlowQueryLog(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _log(self, log_format:str) -> str:
+        profile = slowlog.Profile()
+        profile.execute, profile.fetch, profile.rows = 0.5, 0.25, 3
+        slow_log = slowlog.SlowQueryLog(0.5, self.path, log_format)
+        self.assertTrue(slow_log.is_slow(profile))
+        slow_log.start()
+        slow_log.log("SELECT * FROM t", 'db', 'ludo', profile, ['SCAN t'])
+        slow_log.close()
+        with open(self.path, encoding="utf-8") as _file:
+            return _file.read()
+
+    def test_text(self):
+        record = self._log('text')
+        self.assertIn("User: ludo  Database: db  Rows: 3\n", record)
+        self.assertIn("# Total: 0.750  Execute: 0.500  Fetch: 0.250", record)
+        self.assertTrue(record.endswith("# Plan: SCAN t\nSELECT * FROM t;\n"))
+
+    def test_json(self):
+        record = json.loads(self._log('json'))
+        self.assertEqual(record['message'], "SELECT * FROM t")
+        self.assertEqual(record['rows'], 3)
+        self.assertEqual(record['total'], 0.75)
+        self.assertEqual(record['plan'], ['SCAN t'])
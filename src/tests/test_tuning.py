@@ -0,0 +1,67 @@
+"""This module tests the tuning profiles (tuning.py) and their storage in
+the server metadata (metadata.py)
+"""
+
+import unittest
+import sqlite3
+
+import tuning
+import metadata
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestTuning, TestMetadataTuning
+
+class TestTuning(unittest.TestCase):
+    def test_check_pragma(self):
+        self.assertEqual(tuning.check_pragma('Synchronous', 'NORMAL'), 'normal')
+        self.assertEqual(tuning.check_pragma('cache_size', '-4096'), '-4096')
+        self.assertEqual(tuning.check_pragma('mmap_size', 0), '0')
+        for name, value in (('synchronous', 'sometimes'),
+                ('mmap_size', '-1'), ('busy_timeout', 'x'),
+                ('journal_mode', 'wal; DROP TABLE t')):
+            with self.assertRaises(sqlite3.Error):
+                tuning.check_pragma(name, value)
+        with self.assertRaises(sqlite3.Error):
+            tuning.check_pragma('writable_schema', 1)
+        with self.assertRaises(sqlite3.Error):
+            tuning.check_profile('turbo')
+
+    def test_apply(self):
+        conn = sqlite3.connect(':memory:')
+        values = tuning.pragmas('fast', {'cache_size': '-1024'})
+        self.assertEqual(values['synchronous'], 'off')
+        tuning.apply(conn, values)
+        rows = dict(tuning.current(conn, ['cache_size', 'synchronous',
+            'temp_store']))
+        self.assertEqual(rows, {'cache_size': -1024, 'synchronous': 0,
+            'temp_store': 2})
+
+
+class TestMetadataTuning(unittest.TestCase):
+    tables = {'users': 'users', 'databases': 'databases'}
+
+    def test_migrate(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, "
+            "username TEXT, password TEXT)")
+        # Table of an older version, without the tuning columns
+        conn.execute("CREATE TABLE databases (id INTEGER PRIMARY KEY, "
+            "dbname TEXT)")
+        conn.execute("INSERT INTO databases (dbname) VALUES ('tweets')")
+        conn.commit()
+        cache = metadata.MetadataCache(conn, self.tables)
+        cache.migrate()
+        cache.migrate()
+        cache.load()
+        self.assertEqual(cache.tuning('tweets'), (DEFAULT_TUNING_PROFILE, {}))
+
+        cache.set_tuning('tweets', 'fast', {'cache_size': '-1024'})
+        self.assertEqual(cache.tuning('tweets'),
+            ('fast', {'cache_size': '-1024'}))
+        cache.load()
+        self.assertEqual(cache.tuning('tweets'),
+            ('fast', {'cache_size': '-1024'}))
+        cache.delete_database('tweets')
+        self.assertEqual(cache.tuning('tweets'), (DEFAULT_TUNING_PROFILE, {}))
@@ -2,13 +2,15 @@
 """
 
 import unittest 
+import tempfile
+import json
 import os
 
 import utils
 
 def get_tests() -> tuple:
     """Returns all test classes."""
-    return TestSQL_Checker, TestLogger
+    return TestSQL_Checker, TestLogger, TestTextTable
 
 class TestSQL_Checker(unittest.TestCase):
     def _create_checker(self):
@@ -50,3 +52,69 @@ class TestLogger(unittest.TestCase):
 
         # Remove created file
         os.remove(os.path.realpath(test_file))
+
+    def test_rotation(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'log.txt')
+        logger = utils.Logger(path, max_bytes=100, backup_count=2)
+        logger.open_file('a')
+        for i in range(30):
+            self.assertTrue(logger.write_line("line %02d\n" % i))
+        logger.close_file()
+        files = sorted(os.listdir(directory))
+        self.assertEqual(files, ['log.txt', 'log.txt.1', 'log.txt.2'])
+        with open(path) as _file:
+            self.assertTrue(_file.read().endswith("line 29\n"))
+        for name in files:
+            self.assertLessEqual(os.path.getsize(os.path.join(directory,
+                name)), 100)
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    def test_json_and_drops(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        logger = utils.Logger(path, max_queue=1, log_format='json')
+        # Not opened: nothing is queued
+        self.assertFalse(logger.write_record("lost"))
+        logger.open_file('w')
+        # The writer thread may not have taken the first record yet
+        written = sum(logger.write_record("Client connected\n", event='connect')
+            for i in range(1000))
+        self.assertEqual(written + logger.dropped, 1000)
+        logger.close_file()
+        with open(path) as _file:
+            records = [json.loads(line) for line in _file]
+        os.remove(path)
+        self.assertEqual(len(records), written)
+        self.assertEqual(records[0]['message'], "Client connected")
+        self.assertEqual(records[0]['event'], 'connect')
+
+
+class TestTextTable(unittest.TestCase):
+    rows = [(1, 'abc', None), (22222, 'x', 3.5), ('q', '', 0)]
+    expected = ("\n+-------+-----+------+"
+                "\n| 1     | abc | None |"
+                "\n+-------+-----+------+"
+                "\n| 22222 | x   | 3.5  |"
+                "\n+-------+-----+------+"
+                "\n| q     |     | 0    |"
+                "\n+-------+-----+------+")
+
+    def test_table(self):
+        table = utils.TextTable()
+        self.assertEqual(str(table), "")
+        table.add_rows(self.rows)
+        self.assertEqual(str(table), self.expected)
+        # Formatting leaves the data untouched
+        self.assertEqual(table._array, [list(row) for row in self.rows])
+
+    def test_streaming_table(self):
+        table = utils.StreamingTextTable(sample_size=2)
+        self.assertEqual(table.format(self.rows[:2]) + table.format(self.rows[2:]),
+            self.expected)
+        # Widths come from the sample only
+        table = utils.StreamingTextTable(sample_size=1)
+        result = table.format(self.rows)
+        self.assertTrue(result.startswith("\n+---+-----+------+"))
+        self.assertIn("| 22222 | x   | 3.5  |", result)
@@ -0,0 +1,92 @@
+"""This module tests the write queues (writes.py)
+"""
+
+import unittest
+import tempfile
+import threading
+import sqlite3
+import os
+
+import writes
+import metrics
+from pool import ConnectionPool
+from config import *
+
+def get_tests() -> tuple:
+    """Returns all test classes."""
+    return TestWriteQueue,
+
+def _insert(value):
+    def write(conn):
+        return conn.execute("INSERT INTO t VALUES (?)", (value,)).rowcount
+    return write
+
+class TestWriteQueue(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=DATABASE_EXT)
+        os.close(fd)
+        self.pool = ConnectionPool('test', self.path, on_connect=lambda conn:
+            conn.execute("PRAGMA busy_timeout = 0"))
+        conn = self.pool.acquire()
+        conn.execute("CREATE TABLE t (x INTEGER UNIQUE)")
+        self.pool.release(conn)
+        self.metrics = metrics.Metrics()
+
+    def tearDown(self):
+        self.pool.drain(0)
+        os.remove(self.path)
+
+    def _count(self) -> int:
+        conn = self.pool.acquire()
+        try:
+            return conn.execute("SELECT count(*) FROM t").fetchone()[0]
+        finally:
+            self.pool.release(conn)
+
+    def test_is_queued(self):
+        self.assertTrue(writes.is_queued("  insert into t values (1)"))
+        self.assertTrue(writes.is_queued("CREATE TABLE u (x)"))
+        self.assertFalse(writes.is_queued("BEGIN"))
+        self.assertFalse(writes.is_queued("SELECT * FROM t"))
+        self.assertFalse(writes.is_queued("INSERTED"))
+
+    def test_group_commit(self):
+        write_queue = writes.WriteQueue(self.pool, self.metrics, group_size=8,
+            group_delay=0.05)
+        futures = [write_queue.submit(_insert(i)) for i in range(20)]
+        # The duplicate fails alone
+        futures.append(write_queue.submit(_insert(3)))
+        self.assertEqual([future.result() for future in futures[:-1]],
+            [1] * 20)
+        with self.assertRaises(sqlite3.IntegrityError):
+            futures[-1].result()
+        write_queue.close()
+        self.assertEqual(self._count(), 20)
+        stats = write_queue.stats()
+        self.assertEqual((stats['writes'], stats['failed']), (20, 1))
+        # The failed write is not counted in the metrics either
+        self.assertEqual(dict(self.metrics.status_rows())['writes'], 20)
+        self.assertLess(stats['batches'], 21)
+        with self.assertRaises(sqlite3.OperationalError):
+            write_queue.submit(_insert(100))
+
+    def test_busy_retry(self):
+        write_queue = writes.WriteQueue(self.pool, self.metrics, retries=2)
+        holder = sqlite3.connect(self.path, isolation_level=None,
+            check_same_thread=False)
+        holder.execute("BEGIN IMMEDIATE")
+        with self.assertRaises(sqlite3.OperationalError) as context:
+            write_queue.submit(_insert(1)).result()
+        self.assertIn("is busy (3 attempts)", str(context.exception))
+        write_queue.close()
+        # The lock is released while the writer waits
+        write_queue = writes.WriteQueue(self.pool, self.metrics, retries=50)
+        timer = threading.Timer(0.02, holder.rollback)
+        timer.start()
+        self.assertEqual(write_queue.submit(_insert(1)).result(), 1)
+        timer.join()
+        holder.close()
+        write_queue.close()
+        counters = self.metrics.snapshot()['counters']
+        self.assertGreaterEqual(counters['write_retries'], 3)
+        self.assertEqual(counters['write_busy_errors'], 1)
@@ -0,0 +1,79 @@
+"""SQLite tuning profiles.
+
+Each database has a profile (config.TUNING_PROFILES), maybe with some
+of its PRAGMAs overridden, stored in the databases table of the server
+database. They are applied to every new connection:
+
+    ALTER DATABASE tweets SET PROFILE fast;
+    ALTER DATABASE tweets SET cache_size = -65536;
+    SHOW TUNING;
+
+Setting a profile clears the overrides. PRAGMA values cannot be bound as
+parameters, so they are checked here before being put in a statement.
+"""
+
+import json
+import sqlite3
+
+from config import *
+
+_KEYWORDS = {
+    'journal_mode': ('delete', 'truncate', 'persist', 'memory', 'wal', 'off'),
+    'synchronous': ('off', 'normal', 'full', 'extra'),
+    'temp_store': ('default', 'file', 'memory'),
+}
+# Integer PRAGMAs and their smallest value
+_INTEGERS = {'cache_size': None, 'mmap_size': 0, 'busy_timeout': 0}
+
+
+def check_pragma(name:str, value) -> str:
+    """Returns the value as written in a PRAGMA statement, or raises
+    sqlite3.Error if the PRAGMA or its value is not allowed."""
+    name = name.lower()
+    if name in _KEYWORDS:
+        value = str(value).lower()
+        if value not in _KEYWORDS[name]:
+            raise sqlite3.Error(ERROR['invalid-pragma'] % (name, value))
+        return value
+    if name in _INTEGERS:
+        try:
+            number = int(value)
+        except ValueError:
+            raise sqlite3.Error(ERROR['invalid-pragma'] % (name, value))
+        minimum = _INTEGERS[name]
+        if minimum is not None and number < minimum:
+            raise sqlite3.Error(ERROR['invalid-pragma'] % (name, value))
+        return str(number)
+    raise sqlite3.Error(ERROR['unknown-pragma'] % name)
+
+def check_profile(profile:str) -> str:
+    profile = profile.lower()
+    if profile not in TUNING_PROFILES:
+        raise sqlite3.Error(ERROR['unknown-profile'] % profile)
+    return profile
+
+def pragmas(profile:str, overrides=None) -> dict:
+    """PRAGMAs of a profile, with the given overrides."""
+    values = dict(TUNING_PROFILES.get(profile,
+        TUNING_PROFILES[DEFAULT_TUNING_PROFILE]))
+    values.update(overrides or {})
+    return values
+
+def apply(conn:sqlite3.Connection, values:dict):
+    """Run the PRAGMAs on a connection, journal_mode first: the others
+    may depend on it."""
+    for name in sorted(values, key=lambda name: name != 'journal_mode'):
+        conn.execute("PRAGMA %s = %s" % (name, check_pragma(name,
+            values[name])))
+
+def current(conn:sqlite3.Connection, names) -> list:
+    """Returns (name, value) rows of the PRAGMAs of a connection."""
+    return [(name, conn.execute("PRAGMA %s" % name).fetchone()[0])
+        for name in names]
+
+def dump_overrides(overrides:dict) -> str:
+    """Text stored in the databases table."""
+    return json.dumps(overrides, sort_keys=True) if overrides else ''
+
+def load_overrides(text:str) -> dict:
+    return json.loads(text) if text else {}
@@ -3,8 +3,10 @@
 This module contains:
     -> SQL_Checker (class) : used to check if a given SQL statement 
                              is valid.
-    -> Logger (class)      : output status 
+    -> Logger (class)      : output status from a background thread
     -> TextTable (class)   : output data into a table
+    -> StreamingTextTable (class) : output data into a table, chunk 
+                             by chunk
     -> is_valid_ip         : check if a given IP address is valid
     -> hash_password       : hash a password 
     -> parse_client_args   : parse command line client arguments
@@ -15,6 +17,14 @@ import sqlite3
 import argparse
 import hashlib 
 import re 
+import os
+import json
+import queue
+import threading
+import datetime
+import time
+
+import config
 
 class SQL_Checker:
     """This is used to check if an SQL query is valid."""
@@ -40,10 +50,34 @@ class SQL_Checker:
 
 
 class Logger:
-    """Used to output state/status in the file."""
-    def __init__(self, filename:str):
+    """Used to output state/status in the file.
+
+    Lines are queued and written by a background thread, by batches,
+    so callers never wait for the disk. The file is flushed every
+    flush_interval seconds and rotated (file.1, file.2...) once larger
+    than max_bytes. When max_queue lines are waiting, new ones are
+    dropped and counted.
+    """
+    def __init__(self, filename:str, max_queue=config.LOG_QUEUE_SIZE,
+            batch_size=config.LOG_BATCH_SIZE,
+            flush_interval=config.LOG_FLUSH_INTERVAL,
+            max_bytes=config.LOG_MAX_BYTES, backup_count=config.LOG_BACKUP_COUNT,
+            log_format=config.DEFAULT_LOG_FORMAT):
+        if log_format not in config.LOG_FORMATS:
+            raise ValueError("Invalid format. Expected %s, got %s" %
+                (str(config.LOG_FORMATS), str(log_format)))
         self._file = None 
         self._filename = filename
+        self._queue = queue.Queue(max(1, max_queue))
+        self._batch_size = max(1, batch_size)
+        self._flush_interval = flush_interval
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._format = log_format
+        self._thread = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self._dropped = 0
 
     @property
     def filename(self):
@@ -53,6 +87,11 @@ class Logger:
     def opened(self):
         return self._file and not self._file.closed 
 
+    @property
+    def dropped(self):
+        """Number of lines dropped because the queue was full."""
+        return self._dropped
+
     def open_file(self, mode, encoding_="utf-8"):
         modes = ('r', 'a', 'w')
         if not mode in modes:
@@ -62,15 +101,111 @@ class Logger:
             self._file = open(self.filename, mode, encoding=encoding_)
         else:
             raise RuntimeError("Logger file already opened")
+        if mode != 'r':
+            self._size = self._file.tell()
+            self._thread = threading.Thread(target=self._write_lines,
+                name='fastdb-logger', daemon=True)
+            self._thread.start()
 
     def close_file(self):
+        """Write the lines still queued, then close the file."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
         if self._file:
             self._file.close()
             self._file = None
 
-    def write_line(self, line:str):
-        if self._file:
-            self._file.write(line)
+    def write_line(self, line:str, echo=False) -> bool:
+        """Queue a line, printed on stdout too if echo.
+
+        Never blocks. Returns False if the line was dropped.
+        """
+        if not self._file:
+            return False
+        try:
+            self._queue.put_nowait((line, echo))
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            return False
+        return True
+
+    def write_record(self, message:str, echo=False, **fields) -> bool:
+        """Queue a message. In 'json' format, it is written with the time
+        and the given fields as one JSON object per line."""
+        if self._format == 'json':
+            record = {'time': datetime.datetime.now().isoformat(
+                timespec='milliseconds'), 'message': message.strip()}
+            record.update(fields)
+            line = json.dumps(record, default=str) + "\n"
+            return self.write_line(line, echo and message)
+        return self.write_line(message, echo)
+
+    def _write_lines(self):
+        """Writer thread: write queued lines until None is received."""
+        last_flush = time.monotonic()
+        dirty = False
+        stop = False
+        while not stop:
+            timeout = max(0.0, last_flush + self._flush_interval - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout if dirty else None)
+            except queue.Empty:
+                item = False
+            batch = []
+            echoed = []
+            while item:
+                line, echo = item
+                batch.append(line)
+                if echo:
+                    echoed.append(echo if isinstance(echo, str) else line)
+                if len(batch) >= self._batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if item is None:
+                stop = True
+            if batch:
+                self._write(batch)
+                dirty = True
+            for line in echoed:
+                print(line)
+            if dirty and (stop or
+                    time.monotonic() - last_flush >= self._flush_interval):
+                self._file.flush()
+                last_flush = time.monotonic()
+                dirty = False
+
+    def _write(self, lines:list):
+        """Write a batch of lines, rotating the file when it gets full."""
+        if not self._max_bytes:
+            self._file.write(''.join(lines))
+            return
+        start = 0
+        for i, line in enumerate(lines):
+            size = len(line.encode("utf-8"))
+            if self._size and self._size + size > self._max_bytes:
+                self._file.write(''.join(lines[start:i]))
+                self._rotate()
+                start = i
+            self._size += size
+        self._file.write(''.join(lines[start:]))
+
+    def _rotate(self):
+        """file -> file.1 -> file.2... keeping backup_count files."""
+        self._file.close()
+        if self._backup_count > 0:
+            for i in range(self._backup_count - 1, 0, -1):
+                source = "%s.%d" % (self._filename, i)
+                if os.path.exists(source):
+                    os.replace(source, "%s.%d" % (self._filename, i + 1))
+            os.replace(self._filename, self._filename + ".1")
+        self._file = open(self._filename, 'w', encoding=self._file.encoding)
+        self._size = 0
 
     def __del__(self):
         self.close_file()
@@ -114,34 +249,55 @@ class TextTable:
 
     def _format(self) -> str:
         """Format the array to display it properly."""
-        def get_fields_size() -> list:
-            """Compute maximum string length for each column."""
-            if not self._array:
-                return []
-            sub_arr_length = len(self._array[0])
-            sizes = [0] * sub_arr_length
-            for i in range(len(self._array)):
-                for j in range(sub_arr_length):
-                    sizes[j] = max(sizes[j], len(str(self._array[i][j])))
-            return sizes
-
-        result = ""
-        sizes = get_fields_size()
-        sizes_len = len(sizes)
-        if sizes:
-            line = "\n+"
-            for i in range(sizes_len):
-                line += ('-' * (sizes[i] + 2)) + "+"
-            result += line 
-            for i in range(len(self._array)):
-                    result += "\n| "
-                    for j in range(sizes_len):
-                        elt = str(self._array[i][j])
-                        elt += " " * (sizes[j] - len(elt))
-                        self._array[i][j] = elt 
-                    result += " | ".join([elt for elt in self._array[i]])
-                    result += " |" + line 
-        return result
+        columns = _stringify_columns(self._array)
+        sizes = [max(map(len, column)) for column in columns]
+        if not sizes:
+            return ""
+        line = _border(sizes)
+        return "\n" + line + _format_rows(columns, sizes, line)
+
+
+class StreamingTextTable:
+    """Represent data as a table, a chunk of rows at a time.
+
+    Column widths are computed once, from the first chunk, or its first
+    sample_size rows: rows are not held back until a full sample has
+    arrived. Later cells wider than their column overflow it instead of
+    shifting the whole table.
+    """
+    def __init__(self, sample_size=1000):
+        self._sample_size = max(1, sample_size)
+        self._sizes = None
+        self._line = ""
+
+    def format(self, rows:list) -> str:
+        """Format a chunk of rows. The first chunk opens the table."""
+        columns = _stringify_columns(rows)
+        if not columns:
+            return ""
+        head = ""
+        if self._sizes is None:
+            sample = [column[:self._sample_size] for column in columns]
+            self._sizes = [max(map(len, column)) for column in sample]
+            self._line = _border(self._sizes)
+            head = "\n" + self._line
+        return head + _format_rows(columns, self._sizes, self._line)
+
+
+def _stringify_columns(rows:list) -> list:
+    """Returns the cells of the rows as strings, column by column."""
+    return [list(map(str, column)) for column in zip(*rows)]
+
+def _border(sizes:list) -> str:
+    return "+" + "+".join(['-' * (size + 2) for size in sizes]) + "+"
+
+def _format_rows(columns:list, sizes:list, line:str) -> str:
+    """Format rows, each one followed by a border line."""
+    padded = [[cell.ljust(size) for cell in column]
+        for column, size in zip(columns, sizes)]
+    separator = " |\n" + line + "\n| "
+    return "\n| " + separator.join([" | ".join(row) for row in zip(*padded)]) \
+        + " |\n" + line
 
 
 # Useful functions
@@ -160,22 +316,82 @@ def hash_password(algo:str, data:str):
 def parse_client_args():
     """Parse client command line arguments.
     
-    Returns given address, port and user.
+    Returns given address, port, user, SQL file to run, pipeline depth,
+    compression methods and level.
     """
     parser = argparse.ArgumentParser()
-    parser.usage = 'server.py --addr=ADDRESS --port=PORT --user=USERNAME'
+    parser.usage = 'client.py --addr=ADDRESS --port=PORT --user=USERNAME ' \
+        '[--file=SCRIPT.sql] [--pipeline=N] [--compression=zlib,lzma|none] ' \
+        '[--compression-level=N]'
     parser.add_argument('-a', '--addr', dest="host", required=True, type=str)
     parser.add_argument('-p', '--port', dest="port", required=True, type=int)
     parser.add_argument('-u', '--user', dest="user", required=True, type=str)
-    return parser.parse_args()
+    parser.add_argument('-f', '--file', dest="file", default=None, type=str)
+    parser.add_argument('-n', '--pipeline', dest="pipeline",
+        default=config.PIPELINE_DEPTH, type=int)
+    _add_compression_args(parser)
+    args = parser.parse_args()
+    args.compression = _compression_methods(args.compression)
+    return args
 
 def parse_server_args():
     """Parse server command line arguments.
 
-    Returns given address and port.
+    Returns given address, port, server mode, number of workers, fetch
+    batch size, result cache size, compression methods and level,
+    metrics port, slow query time and log file, log format, the number
+    of writes committed at once and of server processes, and the limits
+    of admission control.
     """
     parser = argparse.ArgumentParser()
-    parser.usage = 'server.py --addr=ADDRESS --port=PORT'
+    parser.usage = 'server.py --addr=ADDRESS --port=PORT [--mode=MODE] ' \
+        '[--workers=N] [--batch-size=N] [--result-cache=BYTES] ' \
+        '[--compression=zlib,lzma|none] [--compression-level=N] ' \
+        '[--metrics-port=PORT] [--slow-query-time=SECONDS] ' \
+        '[--slow-query-log=FILE] [--log-format=text|json] [--group-commit=N] ' \
+        '[--processes=N] [--max-connections=N] [--max-user-queries=N] ' \
+        '[--statement-timeout=SECONDS] [--max-result-size=BYTES]'
     parser.add_argument('-a', '--addr', dest="host", required=True, type=str)
     parser.add_argument('-p', '--port', dest="port", required=True, type=int)
-    return parser.parse_args() 
+    parser.add_argument('-m', '--mode', dest="mode", choices=config.SERVER_MODES,
+        default=config.DEFAULT_SERVER_MODE, type=str)
+    parser.add_argument('-w', '--workers', dest="workers",
+        default=config.ASYNC_WORKERS, type=int)
+    parser.add_argument('-b', '--batch-size', dest="batch_size",
+        default=config.FETCH_BATCH_SIZE, type=int)
+    parser.add_argument('-c', '--result-cache', dest="result_cache",
+        default=config.RESULT_CACHE_SIZE, type=int)
+    parser.add_argument('--metrics-port', dest="metrics_port",
+        default=config.METRICS_PORT, type=int)
+    parser.add_argument('--slow-query-time', dest="slow_query_time",
+        default=config.SLOW_QUERY_TIME, type=float)
+    parser.add_argument('--slow-query-log', dest="slow_query_log",
+        default=config.SLOW_QUERY_LOG_FILE, type=str)
+    parser.add_argument('--log-format', dest="log_format",
+        choices=config.LOG_FORMATS, default=config.DEFAULT_LOG_FORMAT, type=str)
+    parser.add_argument('--group-commit', dest="group_commit",
+        default=config.WRITE_GROUP_SIZE, type=int)
+    parser.add_argument('--processes', dest="processes", default=1, type=int)
+    parser.add_argument('--max-connections', dest="max_connections",
+        default=config.MAX_CONNECTIONS, type=int)
+    parser.add_argument('--max-user-queries', dest="max_user_queries",
+        default=config.MAX_USER_QUERIES, type=int)
+    parser.add_argument('--statement-timeout', dest="statement_timeout",
+        default=config.STATEMENT_TIMEOUT, type=float)
+    parser.add_argument('--max-result-size', dest="max_result_size",
+        default=config.MAX_RESULT_SIZE, type=int)
+    _add_compression_args(parser)
+    args = parser.parse_args()
+    args.compression = _compression_methods(args.compression)
+    return args
+
+def _add_compression_args(parser):
+    parser.add_argument('--compression', dest="compression",
+        default=','.join(config.COMPRESSION_METHODS), type=str)
+    parser.add_argument('--compression-level', dest="compression_level",
+        default=config.COMPRESSION_LEVEL, type=int)
+
+def _compression_methods(value:str) -> tuple:
+    """Methods of a --compression argument ('none' for no compression)."""
+    return tuple(method.strip().lower() for method in value.split(',')
+        if method.strip() and method.strip().lower() != 'none') 
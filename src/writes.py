@@ -0,0 +1,254 @@
+"""Write scheduler.
+
+Sessions writing to the same database file used to race for its lock and
+get "database is locked" back. Now reads still run concurrently, each on
+a connection of the pool, but plain writes (INSERT, UPDATE, DELETE,
+REPLACE, CREATE, DROP, ALTER) outside of a client transaction are queued
+and run in order by one writer thread per database.
+
+The writer commits up to group_size queued writes at once (group commit):
+each write runs in its own savepoint, so a failing one does not undo the
+others, and its session gets its result after the COMMIT. Starting and
+committing the transaction are retried, with an exponential backoff, when
+the database is busy (a client transaction or a bulk load holding the
+lock).
+
+Client transactions (BEGIN ... COMMIT) and bulk loads keep writing on
+their own connection.
+"""
+
+import concurrent.futures
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from config import *
+
+_queued_regex = re.compile(
+    r"^\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b", re.IGNORECASE)
+# SQLite primary result codes of a busy or locked database
+_BUSY_CODES = (5, 6)
+
+
+def is_queued(sql:str) -> bool:
+    """Check if a statement goes through the write queue."""
+    return _queued_regex.match(sql) is not None
+
+def is_busy(error:sqlite3.Error) -> bool:
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in _BUSY_CODES
+    return str(error).startswith(('database is locked',
+        'database table is locked'))
+
+
+class WriteQueue:
+    """Writes to a database, run in order by a writer thread."""
+    def __init__(self, pool, metrics, group_size=WRITE_GROUP_SIZE,
+            group_delay=WRITE_GROUP_DELAY, retries=WRITE_RETRIES):
+        self._pool = pool
+        self._metrics = metrics
+        self._group_size = max(1, group_size)
+        self._group_delay = group_delay
+        self._retries = retries
+        # (function, future, time it was queued), None to stop
+        self._queue = queue.Queue(WRITE_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = None
+        self._writes = 0
+        self._failed = 0
+        self._batches = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    @property
+    def pool(self):
+        return self._pool
+
+    def submit(self, func) -> concurrent.futures.Future:
+        """Queue func(conn), run in a transaction of the writer.
+
+        Returns a future set to what it returns once committed, or to the
+        sqlite3.Error it raised.
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                raise sqlite3.OperationalError(ERROR['unknown-database'] %
+                    self._pool.dbname)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name='fastdb-writer-%s' % self._pool.dbname, daemon=True)
+                self._thread.start()
+            self._queue.put((func, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        """Stop the writer once the writes already queued are done."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _next_group(self) -> list:
+        """Wait for writes, and returns up to group_size of them. The
+        last item is None when the queue is closed."""
+        group = [self._queue.get()]
+        deadline = time.perf_counter() + self._group_delay
+        while group[-1] is not None and len(group) < self._group_size:
+            try:
+                if self._group_delay > 0:
+                    group.append(self._queue.get(timeout=max(0.0,
+                        deadline - time.perf_counter())))
+                else:
+                    group.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return group
+
+    def _run(self):
+        while True:
+            group = self._next_group()
+            stop = group[-1] is None
+            if stop:
+                group.pop()
+            if group:
+                self._commit_group(group)
+            if stop:
+                break
+
+    def _retry(self, conn, sql:str):
+        """Run sql, again while the database is busy, waiting longer each
+        time."""
+        delay = WRITE_RETRY_DELAY
+        for attempt in range(self._retries + 1):
+            try:
+                return conn.execute(sql)
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise
+                if attempt == self._retries:
+                    self._metrics.inc('write_busy_errors')
+                    raise sqlite3.OperationalError(ERROR['database-busy'] %
+                        (self._pool.dbname, attempt + 1))
+                self._metrics.inc('write_retries')
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, WRITE_RETRY_MAX_DELAY)
+
+    def _commit_group(self, group:list):
+        start = time.perf_counter()
+        for func, future, queued in group:
+            wait = start - queued
+            self._metrics.observe('write_wait', wait)
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+        results = []
+        try:
+            conn = self._pool.acquire()
+        except sqlite3.Error as e:
+            self._fail(group, e)
+            return
+        try:
+            self._retry(conn, "BEGIN IMMEDIATE")
+            for func, future, queued in group:
+                conn.execute("SAVEPOINT fastdb_write")
+                try:
+                    results.append((future, func(conn), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO fastdb_write")
+                    results.append((future, None, e))
+                conn.execute("RELEASE fastdb_write")
+            self._retry(conn, "COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            self._fail(group, e)
+            return
+        finally:
+            self._pool.release(conn)
+        self._batches += 1
+        self._metrics.inc('write_batches')
+        self._metrics.observe('write_commit', time.perf_counter() - start)
+        written = 0
+        for future, result, error in results:
+            if error is None:
+                written += 1
+                future.set_result(result)
+            else:
+                self._failed += 1
+                future.set_exception(error)
+        self._writes += written
+        # Writes rolled back to their savepoint are not counted
+        self._metrics.inc('writes', written)
+
+    def _fail(self, group:list, error:sqlite3.Error):
+        self._failed += len(group)
+        for func, future, queued in group:
+            future.set_exception(error)
+
+    def stats(self) -> dict:
+        done = self._writes + self._failed
+        return {
+            'queued': self._queue.qsize(),
+            'writes': self._writes,
+            'failed': self._failed,
+            'batches': self._batches,
+            'avg_group': round(done / self._batches, 2) if self._batches else 0,
+            'avg_wait_ms': round(self._total_wait / done * 1000, 3)
+                if done else 0.0,
+            'max_wait_ms': round(self._max_wait * 1000, 3),
+        }
+
+
+class WriteManager:
+    """Server-wide registry of write queues, one per database."""
+    def __init__(self, metrics, group_size=WRITE_GROUP_SIZE,
+            group_delay=WRITE_GROUP_DELAY, retries=WRITE_RETRIES):
+        self._metrics = metrics
+        self._group_size = group_size
+        self._group_delay = group_delay
+        self._retries = retries
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def get(self, pool) -> WriteQueue:
+        """Returns the write queue of the database of a pool."""
+        with self._lock:
+            write_queue = self._queues.get(pool.dbname)
+            if write_queue is None or write_queue.pool is not pool:
+                # A database dropped then created again gets a new pool
+                if write_queue is not None:
+                    write_queue.close()
+                write_queue = WriteQueue(pool, self._metrics,
+                    self._group_size, self._group_delay, self._retries)
+                self._queues[pool.dbname] = write_queue
+            return write_queue
+
+    def drain(self, dbname:str):
+        """Run the writes queued for a database, then forget its queue."""
+        with self._lock:
+            write_queue = self._queues.pop(dbname, None)
+        if write_queue is not None:
+            write_queue.close()
+
+    def close_all(self):
+        with self._lock:
+            queues = list(self._queues.values())
+            self._queues.clear()
+        for write_queue in queues:
+            write_queue.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            queues = dict(self._queues)
+        return {dbname: write_queue.stats()
+            for dbname, write_queue in queues.items()}